@@ -146,9 +146,9 @@ cd "$source_dir"/log_parser/package || exit 1
 zip -q -r9 "$build_dist_dir"/log_parser.zip .
 cd "$source_dir"/log_parser || exit 1
 mkdir -p lib
-echo "cp $source_dir/lib/waflibv2.py $source_dir/lib/solution_metrics.py $source_dir/lib/boto3_util.py $source_dir/lib/cw_metrics_util.py $source_dir/lib/logging_util.py $source_dir/lib/s3_util.py lib"
-cp -rf "$source_dir"/lib/waflibv2.py "$source_dir"/lib/solution_metrics.py "$source_dir"/lib/boto3_util.py "$source_dir"/lib/cw_metrics_util.py "$source_dir"/lib/logging_util.py "$source_dir"/lib/s3_util.py lib
-zip -g -r "$build_dist_dir"/log_parser.zip log_parser.py partition_s3_logs.py add_athena_partitions.py build_athena_queries.py lambda_log_parser.py athena_log_parser.py lib
+echo "cp $source_dir/lib/waflibv2.py $source_dir/lib/ip_util.py $source_dir/lib/cidr_index.py $source_dir/lib/solution_metrics.py $source_dir/lib/boto3_util.py $source_dir/lib/cw_metrics_util.py $source_dir/lib/logging_util.py $source_dir/lib/s3_util.py $source_dir/lib/stage_metrics.py $source_dir/lib/memory_profiler.py lib"
+cp -rf "$source_dir"/lib/waflibv2.py "$source_dir"/lib/ip_util.py "$source_dir"/lib/cidr_index.py "$source_dir"/lib/solution_metrics.py "$source_dir"/lib/boto3_util.py "$source_dir"/lib/cw_metrics_util.py "$source_dir"/lib/logging_util.py "$source_dir"/lib/s3_util.py "$source_dir"/lib/stage_metrics.py "$source_dir"/lib/memory_profiler.py lib
+zip -g -r "$build_dist_dir"/log_parser.zip log_parser.py partition_s3_logs.py add_athena_partitions.py build_athena_queries.py lambda_log_parser.py athena_log_parser.py requester_state.py expiry_sweeper.py geoip_db.py ip_set_intents.py lib
 
 
 echo "------------------------------------------------------------------------------"
@@ -161,8 +161,8 @@ cd "$source_dir"/reputation_lists_parser/package || exit 1
 zip -q -r9 "$build_dist_dir"/reputation_lists_parser.zip .
 cd "$source_dir"/reputation_lists_parser || exit 1
 mkdir -p lib
-echo "cp $source_dir/lib/waflibv2.py $source_dir/lib/solution_metrics.py $source_dir/lib/boto3_util.py $source_dir/lib/cfn_response.py $source_dir/lib/cw_metrics_util.py  $source_dir/lib/logging_util.py lib"
-cp -rf "$source_dir"/lib/waflibv2.py "$source_dir"/lib/solution_metrics.py "$source_dir"/lib/boto3_util.py "$source_dir"/lib/cfn_response.py "$source_dir"/lib/cw_metrics_util.py "$source_dir"/lib/logging_util.py lib
+echo "cp $source_dir/lib/waflibv2.py $source_dir/lib/ip_util.py $source_dir/lib/cidr_index.py $source_dir/lib/solution_metrics.py $source_dir/lib/boto3_util.py $source_dir/lib/cfn_response.py $source_dir/lib/cw_metrics_util.py  $source_dir/lib/logging_util.py $source_dir/lib/stage_metrics.py $source_dir/lib/memory_profiler.py lib"
+cp -rf "$source_dir"/lib/waflibv2.py "$source_dir"/lib/ip_util.py "$source_dir"/lib/cidr_index.py "$source_dir"/lib/solution_metrics.py "$source_dir"/lib/boto3_util.py "$source_dir"/lib/cfn_response.py "$source_dir"/lib/cw_metrics_util.py "$source_dir"/lib/logging_util.py "$source_dir"/lib/stage_metrics.py "$source_dir"/lib/memory_profiler.py lib
 zip -g -r "$build_dist_dir"/reputation_lists_parser.zip reputation_lists.py lib
 
 
@@ -176,8 +176,8 @@ cd "$source_dir"/custom_resource/package || exit 1
 zip -q -r9 "$build_dist_dir"/custom_resource.zip .
 cd "$source_dir"/custom_resource || exit 1
 mkdir -p lib
-echo "cp $source_dir/lib/waflibv2.py $source_dir/lib/solution_metrics.py $source_dir/lib/boto3_util.py $source_dir/lib/s3_util.py $source_dir/lib/cfn_response.py  $source_dir/lib/logging_util.py lib"
-cp -rf "$source_dir"/lib/waflibv2.py "$source_dir"/lib/solution_metrics.py "$source_dir"/lib/boto3_util.py "$source_dir"/lib/s3_util.py "$source_dir"/lib/cfn_response.py "$source_dir"/lib/logging_util.py lib
+echo "cp $source_dir/lib/waflibv2.py $source_dir/lib/ip_util.py $source_dir/lib/solution_metrics.py $source_dir/lib/boto3_util.py $source_dir/lib/s3_util.py $source_dir/lib/cfn_response.py  $source_dir/lib/logging_util.py lib"
+cp -rf "$source_dir"/lib/waflibv2.py "$source_dir"/lib/ip_util.py "$source_dir"/lib/solution_metrics.py "$source_dir"/lib/boto3_util.py "$source_dir"/lib/s3_util.py "$source_dir"/lib/cfn_response.py "$source_dir"/lib/logging_util.py lib
 zip -g -r "$build_dist_dir"/custom_resource.zip custom_resource.py resource_manager.py log_group_retention.py lib operations
 
 
@@ -191,8 +191,8 @@ cd "$source_dir"/helper/package || exit 1
 zip -q -r9 "$build_dist_dir"/helper.zip ./*
 cd "$source_dir"/helper || exit 1
 mkdir -p lib
-echo "cp $source_dir/lib/waflibv2.py $source_dir/lib/boto3_util.py $source_dir/lib/s3_util.py $source_dir/lib/cfn_response.py $source_dir/lib/logging_util.py lib"
-cp -rf "$source_dir"/lib/waflibv2.py "$source_dir"/lib/boto3_util.py "$source_dir"/lib/s3_util.py "$source_dir"/lib/cfn_response.py "$source_dir"/lib/logging_util.py lib
+echo "cp $source_dir/lib/waflibv2.py $source_dir/lib/ip_util.py $source_dir/lib/boto3_util.py $source_dir/lib/s3_util.py $source_dir/lib/cfn_response.py $source_dir/lib/logging_util.py lib"
+cp -rf "$source_dir"/lib/waflibv2.py "$source_dir"/lib/ip_util.py "$source_dir"/lib/boto3_util.py "$source_dir"/lib/s3_util.py "$source_dir"/lib/cfn_response.py "$source_dir"/lib/logging_util.py lib
 zip -g -r "$build_dist_dir"/helper.zip helper.py stack_requirements.py lib
 
 
@@ -223,8 +223,8 @@ cd "$source_dir"/ip_retention_handler/package || exit 1
 zip -q -r9 "$build_dist_dir"/ip_retention_handler.zip ./*
 cd "$source_dir"/ip_retention_handler || exit 1
 mkdir -p lib
-echo "cp $source_dir/lib/waflibv2.py $source_dir/lib/solution_metrics.py $source_dir/lib/sns_util.py $source_dir/lib/dynamodb_util.py $source_dir/lib/boto3_util.py  $source_dir/lib/logging_util.py lib"
-cp -rf "$source_dir"/lib/waflibv2.py "$source_dir"/lib/solution_metrics.py "$source_dir"/lib/sns_util.py "$source_dir"/lib/dynamodb_util.py $source_dir/lib/boto3_util.py "$source_dir"/lib/logging_util.py lib
+echo "cp $source_dir/lib/waflibv2.py $source_dir/lib/ip_util.py $source_dir/lib/solution_metrics.py $source_dir/lib/sns_util.py $source_dir/lib/dynamodb_util.py $source_dir/lib/boto3_util.py  $source_dir/lib/logging_util.py $source_dir/lib/stage_metrics.py $source_dir/lib/memory_profiler.py lib"
+cp -rf "$source_dir"/lib/waflibv2.py "$source_dir"/lib/ip_util.py "$source_dir"/lib/solution_metrics.py "$source_dir"/lib/sns_util.py "$source_dir"/lib/dynamodb_util.py $source_dir/lib/boto3_util.py "$source_dir"/lib/logging_util.py "$source_dir"/lib/stage_metrics.py "$source_dir"/lib/memory_profiler.py lib
 zip -g -r "$build_dist_dir"/ip_retention_handler.zip set_ip_retention.py remove_expired_ip.py lib
 
 echo "------------------------------------------------------------------------------"
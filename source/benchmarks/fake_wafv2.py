@@ -0,0 +1,318 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+In-memory stand-in for the wafv2 boto3 client, injected as the module level
+`client` of lib.waflibv2 so IP set update strategies (batching, diffing,
+sharding, throttling) can be compared without calling WAF:
+
+    fake = FakeWAFv2Client(seed=1, latency=0.05, throttle_rate=0.1)
+    ip_set = fake.create_ip_set(Name='flood-v4', Scope='REGIONAL', IPAddressVersion='IPV4', Addresses=[])
+    with fake.install():
+        WAFLIBv2().sync_ip_set(log, 'REGIONAL', 'flood-v4', ip_set['Summary']['ARN'], addresses)
+    fake.calls['update_ip_set'], fake.simulated_seconds
+
+IP sets keep a lock token and the per IP set address limit. Latency, throttling
+(WAFLimitsExceededException, also raised above `calls_per_second`) and optimistic
+lock conflicts are injected on demand. Every injection is drawn from `seed`, the
+operation, the IP set and the number of calls it already got, so a scenario
+gives the same calls and errors whatever the order of concurrent calls.
+"""
+
+import time
+import uuid
+import random
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from lib.ip_util import parse_address, IP_VERSION_NAMES
+
+ACCOUNT_ID = '123456789012'
+REGION = 'us-east-1'
+SCOPES = {'REGIONAL': 'regional', 'CLOUDFRONT': 'global'}
+DEFAULT_IP_SET_ADDRESS_LIMIT = 10000
+DEFAULT_IP_SET_COUNT_LIMIT = 100
+DEFAULT_LIST_LIMIT = 100
+
+
+def get_waflibv2_exceptions():
+    """
+    Exception classes of the wafv2 client of lib.waflibv2: the errors raised by the
+    fake are caught by the same handlers as the errors of WAF
+    """
+    from lib import waflibv2
+    return waflibv2.client.exceptions
+
+
+class FakeWAFv2Client(object):
+    """
+    wafv2 client holding IP sets and logging configurations in memory.
+
+    latency: seconds added per call, a number or {operation: seconds}. It is added to
+        `simulated_seconds`, and slept as well when `sleep` is given.
+    throttle_rate: share of the calls failing with WAFLimitsExceededException.
+    conflict_rate: share of the IP set writes finding the lock token changed by
+        another writer (WAFOptimisticLockException).
+    calls_per_second: calls allowed per second of `clock`, None for no quota.
+    """
+
+    def __init__(self, seed=0, latency=0, throttle_rate=0, conflict_rate=0, calls_per_second=None,
+                 ip_set_address_limit=DEFAULT_IP_SET_ADDRESS_LIMIT, ip_set_count_limit=DEFAULT_IP_SET_COUNT_LIMIT,
+                 sleep=None, clock=time.monotonic, exceptions=None):
+        self.seed = seed
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.conflict_rate = conflict_rate
+        self.calls_per_second = calls_per_second
+        self.ip_set_address_limit = ip_set_address_limit
+        self.ip_set_count_limit = ip_set_count_limit
+        self.sleep = sleep
+        self.clock = clock
+        self.exceptions = exceptions or get_waflibv2_exceptions()
+        self.lock = threading.Lock()
+        # (scope, id) -> {'Name', 'Id', 'ARN', 'Description', 'IPAddressVersion', 'Addresses', 'LockToken', 'Version'}
+        self.ip_sets = {}
+        self.logging_configurations = {}
+        self.web_acls = {scope: [] for scope in SCOPES}
+        # operation -> [error code], raised by the next calls of the operation before any other injection
+        self.scripted_errors = {}
+        self.created = 0
+        self.quota_window = None
+        self.quota_calls = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = Counter()
+            self.errors = Counter()
+            self.call_counts = Counter()
+            self.simulated_seconds = 0.0
+            self.addresses_written = 0
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Scenario helpers
+    # ------------------------------------------------------------------------------------------------------------------
+    @contextmanager
+    def install(self):
+        """
+        Use the fake as the wafv2 client of lib.waflibv2. Cached IP set snapshots are
+        dropped on both ends, their lock tokens belong to another client.
+        """
+        from lib import waflibv2
+        previous = waflibv2.client
+        waflibv2.client = self
+        waflibv2.IP_SET_SNAPSHOTS.clear()
+        try:
+            yield self
+        finally:
+            waflibv2.client = previous
+            waflibv2.IP_SET_SNAPSHOTS.clear()
+
+    def inject_error(self, operation, code, times=1):
+        """
+        Fail the next `times` calls of `operation` with the error `code`
+        """
+        with self.lock:
+            self.scripted_errors.setdefault(operation, []).extend([code] * times)
+
+    def touch_ip_set(self, ip_set_id, scope='REGIONAL'):
+        """
+        Change the lock token of an IP set, as a write of another client would
+        """
+        with self.lock:
+            self.bump_lock_token(self.ip_sets[(scope, ip_set_id)])
+
+    def get_addresses(self, ip_set_id, scope='REGIONAL'):
+        return list(self.ip_sets[(scope, ip_set_id)]['Addresses'])
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Simulation
+    # ------------------------------------------------------------------------------------------------------------------
+    def draw(self, operation, key):
+        """
+        Deterministic number in [0, 1) for the n-th call of `operation` on `key`
+        """
+        n = self.call_counts[(operation, key)]
+        self.call_counts[(operation, key)] += 1
+        return random.Random('%s:%s:%s:%d' % (self.seed, operation, key, n)).random()
+
+    def get_latency(self, operation):
+        if isinstance(self.latency, dict):
+            return self.latency.get(operation, 0)
+        return self.latency
+
+    def is_over_quota(self):
+        if self.calls_per_second is None:
+            return False
+        window = int(self.clock())
+        if window != self.quota_window:
+            self.quota_window = window
+            self.quota_calls = 0
+        self.quota_calls += 1
+        return self.quota_calls > self.calls_per_second
+
+    def error(self, operation, code, message=''):
+        self.errors[code] += 1
+        return self.exceptions.from_code(code)({'Error': {'Code': code, 'Message': message}}, operation)
+
+    def wait(self, operation):
+        """
+        Sleep the latency of a call, outside of the lock so concurrent calls overlap
+        """
+        latency = self.get_latency(operation)
+        if latency and self.sleep:
+            self.sleep(latency)
+
+    def begin(self, operation, key=''):
+        """
+        Account for a call and raise the scripted, quota or throttling error it gets
+        """
+        self.calls[operation] += 1
+        self.simulated_seconds += self.get_latency(operation)
+
+        scripted = self.scripted_errors.get(operation)
+        if scripted:
+            raise self.error(operation, scripted.pop(0), 'Injected error')
+        if self.is_over_quota():
+            raise self.error(operation, 'WAFLimitsExceededException', 'Too many requests')
+        if self.throttle_rate and self.draw(operation, key) < self.throttle_rate:
+            raise self.error(operation, 'WAFLimitsExceededException', 'Throttled')
+
+    def new_id(self):
+        self.created += 1
+        return str(uuid.UUID(int=random.Random('%s:id:%d' % (self.seed, self.created)).getrandbits(128)))
+
+    def bump_lock_token(self, ip_set):
+        ip_set['Version'] += 1
+        ip_set['LockToken'] = str(uuid.UUID(int=random.Random('%s:%s:%d' % (
+            self.seed, ip_set['Id'], ip_set['Version'])).getrandbits(128)))
+
+    def find_ip_set(self, operation, scope, name, ip_set_id):
+        if scope not in SCOPES:
+            raise self.error(operation, 'WAFInvalidParameterException', 'Invalid scope %s' % scope)
+        ip_set = self.ip_sets.get((scope, ip_set_id))
+        if ip_set is None or ip_set['Name'] != name:
+            raise self.error(operation, 'WAFNonexistentItemException', 'IP set %s does not exist' % ip_set_id)
+        return ip_set
+
+    def check_addresses(self, operation, version, addresses):
+        if len(addresses) > self.ip_set_address_limit:
+            raise self.error(operation, 'WAFLimitsExceededException',
+                             'IP sets hold at most %d addresses' % self.ip_set_address_limit)
+        for address in addresses:
+            parsed = parse_address(address) if '/' in address else None
+            if parsed is None or IP_VERSION_NAMES[parsed[0]] != version:
+                raise self.error(operation, 'WAFInvalidParameterException', 'Invalid %s address %s' % (
+                    version, address))
+
+    def check_lock_token(self, operation, ip_set, lock_token):
+        if self.conflict_rate and self.draw(operation + ':conflict', ip_set['Id']) < self.conflict_rate:
+            self.bump_lock_token(ip_set)
+        if lock_token != ip_set['LockToken']:
+            raise self.error(operation, 'WAFOptimisticLockException', 'Lock token of %s is stale' % ip_set['Id'])
+
+    def summarize(self, ip_set):
+        return {key: ip_set[key] for key in ('Name', 'Id', 'Description', 'LockToken', 'ARN')}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # wafv2 API
+    # ------------------------------------------------------------------------------------------------------------------
+    def create_ip_set(self, Name, Scope, IPAddressVersion, Addresses, Description='', Tags=None):
+        self.wait('create_ip_set')
+        with self.lock:
+            self.begin('create_ip_set', Name)
+            if Scope not in SCOPES:
+                raise self.error('create_ip_set', 'WAFInvalidParameterException', 'Invalid scope %s' % Scope)
+            if any(ip_set['Name'] == Name for (scope, _), ip_set in self.ip_sets.items() if scope == Scope):
+                raise self.error('create_ip_set', 'WAFDuplicateItemException', 'IP set %s exists' % Name)
+            if sum(1 for scope, _ in self.ip_sets if scope == Scope) >= self.ip_set_count_limit:
+                raise self.error('create_ip_set', 'WAFLimitsExceededException',
+                                 'At most %d IP sets per scope' % self.ip_set_count_limit)
+            self.check_addresses('create_ip_set', IPAddressVersion, Addresses)
+            ip_set_id = self.new_id()
+            ip_set = {
+                'Name': Name,
+                'Id': ip_set_id,
+                'ARN': 'arn:aws:wafv2:%s:%s:%s/ipset/%s/%s' % (REGION, ACCOUNT_ID, SCOPES[Scope], Name, ip_set_id),
+                'Description': Description,
+                'IPAddressVersion': IPAddressVersion,
+                'Addresses': list(Addresses),
+                'Version': 0
+            }
+            self.bump_lock_token(ip_set)
+            self.ip_sets[(Scope, ip_set_id)] = ip_set
+            return {'Summary': self.summarize(ip_set)}
+
+    def get_ip_set(self, Name, Scope, Id):
+        self.wait('get_ip_set')
+        with self.lock:
+            self.begin('get_ip_set', Id)
+            ip_set = self.find_ip_set('get_ip_set', Scope, Name, Id)
+            description = {key: ip_set[key] for key in ('Name', 'Id', 'ARN', 'Description', 'IPAddressVersion')}
+            return {'IPSet': dict(description, Addresses=list(ip_set['Addresses'])), 'LockToken': ip_set['LockToken']}
+
+    def update_ip_set(self, Name, Scope, Id, Addresses, LockToken, Description=None):
+        self.wait('update_ip_set')
+        with self.lock:
+            self.begin('update_ip_set', Id)
+            ip_set = self.find_ip_set('update_ip_set', Scope, Name, Id)
+            self.check_addresses('update_ip_set', ip_set['IPAddressVersion'], Addresses)
+            self.check_lock_token('update_ip_set', ip_set, LockToken)
+            ip_set['Addresses'] = list(Addresses)
+            if Description is not None:
+                ip_set['Description'] = Description
+            self.bump_lock_token(ip_set)
+            self.addresses_written += len(Addresses)
+            return {'NextLockToken': ip_set['LockToken']}
+
+    def delete_ip_set(self, Name, Scope, Id, LockToken):
+        self.wait('delete_ip_set')
+        with self.lock:
+            self.begin('delete_ip_set', Id)
+            ip_set = self.find_ip_set('delete_ip_set', Scope, Name, Id)
+            self.check_lock_token('delete_ip_set', ip_set, LockToken)
+            del self.ip_sets[(Scope, Id)]
+            return {}
+
+    def list_ip_sets(self, Scope, NextMarker=None, Limit=DEFAULT_LIST_LIMIT):
+        self.wait('list_ip_sets')
+        with self.lock:
+            self.begin('list_ip_sets', Scope)
+            summaries = sorted((self.summarize(ip_set) for (scope, _), ip_set in self.ip_sets.items()
+                                if scope == Scope), key=lambda summary: summary['Name'])
+            start = int(NextMarker) if NextMarker else 0
+            response = {'IPSets': summaries[start:start + Limit]}
+            if start + Limit < len(summaries):
+                response['NextMarker'] = str(start + Limit)
+            return response
+
+    def list_web_acls(self, Scope, NextMarker=None, Limit=DEFAULT_LIST_LIMIT):
+        self.wait('list_web_acls')
+        with self.lock:
+            self.begin('list_web_acls', Scope)
+            return {'WebACLs': list(self.web_acls.get(Scope, []))}
+
+    def put_logging_configuration(self, LoggingConfiguration):
+        self.wait('put_logging_configuration')
+        with self.lock:
+            self.begin('put_logging_configuration', LoggingConfiguration['ResourceArn'])
+            self.logging_configurations[LoggingConfiguration['ResourceArn']] = LoggingConfiguration
+            return {'LoggingConfiguration': LoggingConfiguration}
+
+    def get_logging_configuration(self, ResourceArn):
+        self.wait('get_logging_configuration')
+        with self.lock:
+            self.begin('get_logging_configuration', ResourceArn)
+            if ResourceArn not in self.logging_configurations:
+                raise self.error('get_logging_configuration', 'WAFNonexistentItemException',
+                                 'No logging configuration for %s' % ResourceArn)
+            return {'LoggingConfiguration': self.logging_configurations[ResourceArn]}
+
+    def delete_logging_configuration(self, ResourceArn):
+        self.wait('delete_logging_configuration')
+        with self.lock:
+            self.begin('delete_logging_configuration', ResourceArn)
+            if self.logging_configurations.pop(ResourceArn, None) is None:
+                raise self.error('delete_logging_configuration', 'WAFNonexistentItemException',
+                                 'No logging configuration for %s' % ResourceArn)
+            return {}
@@ -0,0 +1,127 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Import time of the Lambda entry points, the share of the cold start spent before
+the handler runs. Every entry point is imported in a new interpreter with
+`python -X importtime`; the report gives the total import time, the slowest
+modules it imports ([module, cumulative milliseconds]) and the AWS clients created
+while importing (none expected, lib.boto3_util creates them on first use).
+
+Run from the source directory:
+
+    python -m benchmarks.import_bench --entry-points log_parser metrics --budget-ms 800 --output report.jsonl
+
+The exit status is 1 when an entry point takes more than --budget-ms to import.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from benchmarks.report import build_result, write_report, read_report, compare_to_baseline
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Handler module -> directory of the function, as deployed by the stack
+ENTRY_POINTS = {
+    'log_parser': 'log_parser',
+    'partition_s3_logs': 'log_parser',
+    'add_athena_partitions': 'log_parser',
+    'helper': 'helper',
+    'reputation_lists': 'reputation_lists_parser',
+    'custom_resource': 'custom_resource',
+    'remove_expired_ip': 'ip_retention_handler',
+    'set_ip_retention': 'ip_retention_handler',
+    'metrics': 'metrics',
+    'timer': 'timer',
+}
+DEFAULT_TOP_MODULES = 10
+
+IMPORT_SCRIPT = """
+import json
+import {module}
+from lib.boto3_util import CLIENTS
+print(json.dumps(sorted('%s:%s' % key for key in CLIENTS)))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    (module, nesting level, self microseconds, cumulative microseconds) of the
+    `-X importtime` lines, in the order Python reports them
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), level, int(self_us), int(cumulative_us)))
+    return modules
+
+
+def import_entry_point(module, directory):
+    """
+    Import time of `module` in a new interpreter: ([(module, level, self_us, cumulative_us)],
+    clients created while importing)
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([SOURCE_DIR, os.path.join(SOURCE_DIR, directory)]))
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT.format(module=module)],
+                               cwd=os.path.join(SOURCE_DIR, directory), env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError("Failed to import %s: %s" % (module, completed.stderr.strip().splitlines()[-1]))
+    return parse_importtime(completed.stderr), json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_entry_point(module, repeat=3, top_modules=DEFAULT_TOP_MODULES, budget_ms=None):
+    """
+    Import `module` `repeat` times and report the fastest import
+    """
+    best = None
+    for _ in range(repeat):
+        modules, clients = import_entry_point(module, ENTRY_POINTS[module])
+        total_us = next(cumulative for name, level, _, cumulative in modules if name == module and level == 0)
+        if best is None or total_us < best[0]:
+            best = (total_us, modules, clients)
+
+    total_us, modules, clients = best
+    # Modules imported directly by the entry point, or by a module of this repository
+    slowest = sorted(((name, cumulative) for name, level, _, cumulative in modules
+                      if level == 1 or (name.startswith('lib.') and level > 0)),
+                     key=lambda item: item[1], reverse=True)[:top_modules]
+    seconds = total_us / 1e6
+    return build_result('import_time', seconds, entry_point=module, directory=ENTRY_POINTS[module],
+                        modules_imported=len(modules), clients_at_import=clients,
+                        slowest_modules=[[name, round(cumulative / 1000, 3)] for name, cumulative in slowest],
+                        over_budget=budget_ms is not None and seconds * 1000 > budget_ms)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the import time of the Lambda entry points.')
+    parser.add_argument('--entry-points', nargs='+', choices=sorted(ENTRY_POINTS), default=sorted(ENTRY_POINTS))
+    parser.add_argument('--repeat', type=int, default=3, help='Imports per entry point, the fastest is reported')
+    parser.add_argument('--top-modules', type=int, default=DEFAULT_TOP_MODULES,
+                        help='Slowest imported modules reported per entry point')
+    parser.add_argument('--budget-ms', type=float, help='Import time allowed per entry point')
+    parser.add_argument('--output', help='Append the JSON Lines report to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON Lines report to compare the results with')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = [run_entry_point(module, args.repeat, args.top_modules, args.budget_ms)
+               for module in args.entry_points]
+    write_report(results, args.output)
+
+    if args.baseline:
+        for comparison in compare_to_baseline(results, read_report(args.baseline)):
+            sys.stderr.write(json.dumps(comparison, sort_keys=True) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    sys.exit(1 if any(result['over_budget'] for result in main()) else 0)
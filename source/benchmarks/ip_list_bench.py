@@ -0,0 +1,229 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Time and allocation benchmark of the IP list operations run on lists near the
+WAF IP set limit (10k) or the size of reputation feeds (100k):
+
+    ips_ordered_merge             WAFLIBv2.ips_ordered_merge
+    merge_and_truncate_addresses  WAFLIBv2.merge_and_truncate_addresses, plain and aggregated
+    set_ip_cidr                   WAFLIBv2.which_ip_version + set_ip_cidr over raw IPs
+    make_ip_list                  RemoveExpiredIP.make_ip_list
+    process_url_list              reputation_lists.process_url_list
+
+Operations that replaced an earlier list based version are also run as
+`reference`, the earlier version, so both can be compared on the same lists.
+
+Run from the source directory:
+
+    python -m benchmarks.ip_list_bench --sizes 1000 10000 100000 --output report.jsonl --baseline baseline.jsonl
+
+`seconds` is the best of --repeat runs. `allocated_bytes` is the traced memory
+peak of one run and `allocations` the number of memory blocks it left allocated
+(its result and the address parse cache it filled), both measured with tracemalloc
+in a separate run.
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import tracemalloc
+from ipaddress import ip_address, ip_network, IPv4Network, IPv6Network
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('STAGE_METRICS_ENABLED', 'false')
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for lambda_dir in ('ip_retention_handler', 'reputation_lists_parser'):
+    sys.path.insert(0, os.path.join(SOURCE_DIR, lambda_dir))
+
+from aws_lambda_powertools import Logger
+from lib.waflibv2 import WAFLIBv2
+from lib.ip_util import parse_address, format_cidr
+from remove_expired_ip import RemoveExpiredIP
+from reputation_lists import process_url_list
+from benchmarks.report import run_timed, build_result, write_report, read_report, compare_to_baseline
+
+BENCHMARKS = ('ips_ordered_merge', 'merge_and_truncate_addresses', 'set_ip_cidr', 'make_ip_list',
+              'process_url_list')
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_IPV6_RATIO = 0.2
+IP_RANGE_LIMIT = 10000
+
+
+def generate_ips(count, seed=0, ipv6_ratio=DEFAULT_IPV6_RATIO, cidr=False):
+    """
+    `count` distinct random IPv4/IPv6 addresses, as /32 and /128 CIDRs when `cidr`
+    """
+    rng = random.Random(seed)
+    ips = set()
+    while len(ips) < count:
+        if rng.random() < ipv6_ratio:
+            ip = '2001:db8:%x:%x::%x' % (rng.getrandbits(16), rng.getrandbits(16), rng.getrandbits(16))
+            ips.add(ip + '/128' if cidr else ip)
+        else:
+            ip = '%d.%d.%d.%d' % (rng.randint(1, 223), rng.getrandbits(8), rng.getrandbits(8), rng.getrandbits(8))
+            ips.add(ip + '/32' if cidr else ip)
+    return sorted(ips, key=lambda _: rng.random())
+
+
+def generate_feed(count, seed=0):
+    """
+    Reputation feed of `count` entries: raw IPs, CIDRs, duplicates and a few non IP lines
+    """
+    rng = random.Random(seed)
+    unique = generate_ips(int(count * 0.9), seed, ipv6_ratio=0)
+    feed = [ip if rng.random() < 0.7 else '%s/%d' % (ip.rsplit('.', 1)[0] + '.0', 24) for ip in unique]
+    feed.extend(rng.choice(unique) for _ in range(count - len(feed) - count // 100))
+    feed.extend('not-an-ip-%d' % i for i in range(count // 100))
+    return feed
+
+
+def reference_set_ip_cidr(log, ips):
+    """
+    which_ip_version + set_ip_cidr as they were before lib.ip_util
+    """
+    result = []
+    for source_ip in ips:
+        try:
+            ip_type = "IPV%s" % ip_address(source_ip.strip()).version
+        except ValueError:
+            continue
+        result.append(source_ip.strip() + "/" + ("32" if ip_type == "IPV4" else "128"))
+    return result
+
+
+def reference_make_ip_list(log, waf_ip_list, ddb_ip_list):
+    """
+    RemoveExpiredIP.make_ip_list as it was before lib.ip_util: set algebra on the strings
+    """
+    remove_ip_list = list(set(waf_ip_list) & set(ddb_ip_list))
+    if not remove_ip_list:
+        return [], []
+    return list(set(waf_ip_list) - set(ddb_ip_list)), remove_ip_list
+
+
+def reference_process_url_list(log, current_list):
+    """
+    process_url_list as it was before lib.ip_util
+    """
+    process_list = []
+    for source_ip in current_list:
+        try:
+            ip_type = "IPV%s" % ip_address(source_ip).version
+            if ip_type == "IPV4":
+                process_list.append(IPv4Network(source_ip).with_prefixlen)
+            elif ip_type == "IPV6":
+                process_list.append(IPv6Network(source_ip).with_prefixlen)
+        except Exception:
+            try:
+                if ip_network(source_ip):
+                    process_list.append(source_ip)
+            except Exception:
+                pass
+    return process_list
+
+
+def build_cases(log, size, seed):
+    """
+    (benchmark, implementation, function) of every case on lists of `size` entries
+    """
+    waflib = WAFLIBv2()
+    aggregating_waflib = WAFLIBv2()
+    aggregating_waflib.aggregation_policy = {}
+    remove_expired_ip = RemoveExpiredIP({}, log)
+
+    current_list = generate_ips(size, seed, cidr=True)
+    new_addresses = generate_ips(max(1, size // 10), seed + 1, cidr=True) + current_list[:size // 10]
+    raw_ips = generate_ips(size, seed + 2)
+    expired = current_list[::10] + generate_ips(max(1, size // 100), seed + 3, cidr=True)
+    feed = generate_feed(size, seed + 4)
+
+    return [
+        ('ips_ordered_merge', 'current', lambda: waflib.ips_ordered_merge(new_addresses, current_list)),
+        ('merge_and_truncate_addresses', 'current',
+         lambda: waflib.merge_and_truncate_addresses(log, new_addresses, current_list, IP_RANGE_LIMIT)),
+        ('merge_and_truncate_addresses', 'aggregated',
+         lambda: aggregating_waflib.merge_and_truncate_addresses(log, new_addresses, current_list, IP_RANGE_LIMIT)),
+        ('set_ip_cidr', 'reference', lambda: reference_set_ip_cidr(log, raw_ips)),
+        ('set_ip_cidr', 'current',
+         lambda: [waflib.set_ip_cidr(log, ip) for ip in raw_ips if waflib.which_ip_version(log, ip)]),
+        ('make_ip_list', 'reference', lambda: reference_make_ip_list(log, current_list, expired)),
+        ('make_ip_list', 'current', lambda: remove_expired_ip.make_ip_list(log, current_list, expired)),
+        ('process_url_list', 'reference', lambda: reference_process_url_list(log, feed)),
+        ('process_url_list', 'current', lambda: process_url_list(log, feed)),
+    ]
+
+
+def clear_caches():
+    """
+    Drop the parsed addresses cached by lib.ip_util, so every run parses its input
+    """
+    parse_address.cache_clear()
+    format_cidr.cache_clear()
+
+
+def measure_allocations(function):
+    """
+    (traced memory peak in bytes, memory blocks left allocated) of one call of `function`
+    """
+    clear_caches()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    del result
+    return peak - start, blocks
+
+
+def run_size(size, seed, repeat, benchmarks):
+    log = Logger(service='benchmark', level=os.getenv('LOG_LEVEL', 'WARNING'))
+    results = []
+    for benchmark, implementation, function in build_cases(log, size, seed):
+        if benchmark not in benchmarks:
+            continue
+        seconds = run_timed(function, repeat, setup=clear_caches)
+        allocated_bytes, allocations = measure_allocations(function)
+        results.append(build_result(benchmark, seconds, size, 'entries', implementation=implementation,
+                                    size=size, seed=seed, allocated_bytes=allocated_bytes,
+                                    allocations=allocations))
+    return results
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the IP list operations on synthetic lists.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(DEFAULT_SIZES), help='Entries per list')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark, the best time is reported')
+    parser.add_argument('--output', help='Append the JSON Lines report to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON Lines report to compare the results with')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+    for size in args.sizes:
+        results.extend(run_size(size, args.seed, args.repeat, args.benchmarks))
+    write_report(results, args.output)
+
+    if args.baseline:
+        for comparison in compare_to_baseline(results, read_report(args.baseline)):
+            sys.stderr.write(json.dumps(comparison, sort_keys=True) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+API calls and wall time of the WAFLIBv2 IP set update strategies against the
+in-memory FakeWAFv2Client:
+
+    sync     replace the addresses of the IP set (sync_ip_sets)
+    patch    add the new addresses to the IP set (patch_ip_sets)
+    sharded  replace the addresses of a logical IP set split over --shards IP sets
+
+Run from the source directory:
+
+    python -m benchmarks.ip_set_update_bench --addresses 1000 10000 --churn 0.01 0.1 \\
+        --throttle-rate 0.05 --conflict-rate 0.1 --latency 0.02 --output report.jsonl
+
+Every scenario starts from IP sets holding `addresses` addresses and applies
+--rounds updates changing `churn` of them. Injected errors are drawn from --seed,
+so a scenario makes the same calls on every run.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('STAGE_METRICS_ENABLED', 'false')
+
+from aws_lambda_powertools import Logger
+from lib import waflibv2
+from lib.waflibv2 import WAFLIBv2
+from benchmarks.fake_wafv2 import FakeWAFv2Client
+from benchmarks.report import build_result, write_report, read_report, compare_to_baseline
+
+STRATEGIES = ('sync', 'patch', 'sharded')
+DEFAULT_ADDRESSES = (1000, 10000)
+DEFAULT_CHURN = (0.01, 0.1)
+SCOPE = 'REGIONAL'
+
+
+def generate_addresses(count, start=0):
+    """
+    `count` distinct IPv4 /32 addresses from 10.0.0.0/8, starting at index `start`
+    """
+    return ['10.%d.%d.%d/32' % ((i >> 16) & 255, (i >> 8) & 255, i & 255) for i in range(start, start + count)]
+
+
+def create_ip_sets(fake, count, addresses):
+    """
+    (name, arn) of `count` IP sets holding `addresses`, split over them as shards
+    """
+    shards = []
+    parts = WAFLIBv2().shard_addresses(addresses, count)
+    for index, part in enumerate(parts):
+        summary = fake.create_ip_set(Name='benchmark-v4-%d' % index, Scope=SCOPE, IPAddressVersion='IPV4',
+                                     Addresses=part, Description='benchmark')['Summary']
+        shards.append((summary['Name'], summary['ARN']))
+    return shards
+
+
+def run_scenario(strategy, addresses, churn, rounds=5, shards=4, seed=0, latency=0, throttle_rate=0,
+                 conflict_rate=0, sleep=None):
+    """
+    Apply `rounds` updates with `strategy` and return the result of the scenario
+    """
+    log = Logger(service='benchmark', level=os.getenv('LOG_LEVEL', 'CRITICAL'))
+    fake = FakeWAFv2Client(seed=seed, latency=latency, throttle_rate=throttle_rate, conflict_rate=conflict_rate,
+                           sleep=sleep)
+    current = generate_addresses(addresses)
+    ip_sets = create_ip_sets(fake, shards if strategy == 'sharded' else 1, current)
+    fake.reset_stats()
+
+    waflib = WAFLIBv2()
+    changed = max(1, int(addresses * churn))
+    failures = 0
+    previous_limiter = waflibv2.rate_limiter
+    waflibv2.rate_limiter = False
+    try:
+        with fake.install():
+            start = time.perf_counter()
+            for round_index in range(rounds):
+                new_addresses = generate_addresses(changed, addresses + round_index * changed)
+                if strategy == 'patch':
+                    name, arn = ip_sets[0]
+                    results = waflib.patch_ip_sets(log, SCOPE, [(name, arn, new_addresses)], addresses)
+                else:
+                    current = current[changed:] + new_addresses
+                    if strategy == 'sharded':
+                        results = waflib.sync_sharded_ip_sets(log, SCOPE, [(ip_sets, current)], addresses)
+                    else:
+                        name, arn = ip_sets[0]
+                        results = waflib.sync_ip_sets(log, SCOPE, [(name, arn, current)])
+                failures += sum(1 for result in results if result['Error'])
+            seconds = time.perf_counter() - start
+    finally:
+        waflibv2.rate_limiter = previous_limiter
+
+    return build_result(
+        'ip_set_update', seconds, rounds, 'rounds', strategy=strategy, addresses=addresses, churn=churn,
+        shards=len(ip_sets), seed=seed, latency=latency, throttle_rate=throttle_rate, conflict_rate=conflict_rate,
+        api_calls=sum(fake.calls.values()), calls=dict(fake.calls), errors=dict(fake.errors),
+        failed_updates=failures, addresses_written=fake.addresses_written,
+        simulated_api_seconds=round(fake.simulated_seconds, 6))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the IP set update strategies on a fake WAF.')
+    parser.add_argument('--strategies', nargs='+', choices=STRATEGIES, default=list(STRATEGIES))
+    parser.add_argument('--addresses', nargs='+', type=int, default=list(DEFAULT_ADDRESSES),
+                        help='Addresses held by the IP sets')
+    parser.add_argument('--churn', nargs='+', type=float, default=list(DEFAULT_CHURN),
+                        help='Share of the addresses changed by every update')
+    parser.add_argument('--rounds', type=int, default=5, help='Updates per scenario')
+    parser.add_argument('--shards', type=int, default=4, help='IP sets of the sharded strategy')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0, help='Seconds per WAF API call')
+    parser.add_argument('--sleep', action='store_true', help='Sleep the latency instead of only accounting it')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='Share of throttled calls')
+    parser.add_argument('--conflict-rate', type=float, default=0, help='Share of writes with a stale lock token')
+    parser.add_argument('--output', help='Append the JSON Lines report to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON Lines report to compare the results with')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = [run_scenario(strategy, addresses, churn, args.rounds, args.shards, args.seed, args.latency,
+                            args.throttle_rate, args.conflict_rate, time.sleep if args.sleep else None)
+               for strategy in args.strategies for addresses in args.addresses for churn in args.churn]
+    write_report(results, args.output)
+
+    if args.baseline:
+        for comparison in compare_to_baseline(results, read_report(args.baseline)):
+            sys.stderr.write(json.dumps(comparison, sort_keys=True) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Seeded generators of synthetic gzip access logs in the formats read by the log
+parser: ALB access logs, CloudFront standard logs and WAF NDJSON logs.
+
+A configurable share of the lines (attacker_ratio) comes from a small pool of
+attacker IPs that hammer a few URIs and mostly get error responses; the rest
+is benign traffic spread over a large pool of client IPs. The same seed always
+produces the same file.
+"""
+
+import gzip
+import json
+import random
+import datetime
+
+LOG_TYPES = ('alb', 'cloudfront', 'waf')
+
+DEFAULT_START_TIME = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+DEFAULT_DURATION_MINUTES = 5
+DEFAULT_ATTACKER_RATIO = 0.1
+DEFAULT_ATTACKERS = 100
+DEFAULT_CLIENTS = 50000
+DEFAULT_IPV6_RATIO = 0.1
+WRITE_BATCH_LINES = 10000
+
+BENIGN_URIS = ('/', '/index.html', '/products', '/products/42', '/cart', '/static/app.js',
+               '/static/style.css', '/api/v1/items', '/search', '/about')
+ATTACKER_URIS = ('/login', '/wp-login.php', '/admin', '/.env', '/api/v1/auth', '/xmlrpc.php')
+BENIGN_CODES = ('200',) * 18 + ('301', '404')
+ATTACKER_CODES = ('403', '404', '401', '400', '405', '200')
+USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:121.0) Gecko/20100101 Firefox/121.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_2 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148',
+    'curl/8.4.0',
+    'python-requests/2.31.0',
+)
+COUNTRIES = ('US', 'DE', 'FR', 'BR', 'IN', 'JP', 'GB', 'CN', 'RU', 'NL')
+
+CLOUDFRONT_HEADER = (
+    '#Version: 1.0\n'
+    '#Fields: date time x-edge-location sc-bytes c-ip cs-method cs(Host) cs-uri-stem sc-status cs(Referer) '
+    'cs(User-Agent) cs-uri-query cs(Cookie) x-edge-result-type x-edge-request-id x-host-header cs-protocol '
+    'cs-bytes time-taken\n'
+)
+
+
+def random_ipv4(rng):
+    return '%d.%d.%d.%d' % (rng.randint(1, 223), rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254))
+
+
+def random_ipv6(rng):
+    return '2001:db8:%x:%x::%x' % (rng.randint(0, 0xffff), rng.randint(0, 0xffff), rng.randint(1, 0xffff))
+
+
+def build_ip_pool(rng, size, ipv6_ratio):
+    return [random_ipv6(rng) if rng.random() < ipv6_ratio else random_ipv4(rng) for _ in range(size)]
+
+
+class LogGenerator(object):
+    """
+    This class produces the lines of one synthetic access log. Lines are
+    generated in timestamp order over `duration_minutes` starting at `start_time`.
+    """
+
+    def __init__(self, log_type, seed=0, attacker_ratio=DEFAULT_ATTACKER_RATIO, attackers=DEFAULT_ATTACKERS,
+                 clients=DEFAULT_CLIENTS, ipv6_ratio=DEFAULT_IPV6_RATIO, start_time=DEFAULT_START_TIME,
+                 duration_minutes=DEFAULT_DURATION_MINUTES):
+        if log_type not in LOG_TYPES:
+            raise ValueError("Unsupported log type %s" % log_type)
+
+        self.log_type = log_type
+        self.rng = random.Random(seed)
+        self.attacker_ratio = attacker_ratio
+        self.attacker_ips = build_ip_pool(self.rng, attackers, ipv6_ratio)
+        self.client_ips = build_ip_pool(self.rng, clients, ipv6_ratio)
+        self.start_time = start_time
+        self.duration_seconds = duration_minutes * 60
+        self.format_line = {
+            'alb': self.alb_line,
+            'cloudfront': self.cloudfront_line,
+            'waf': self.waf_line,
+        }[log_type]
+
+    def next_request(self, index, lines):
+        """
+        Return (timestamp, ip, uri, status code, user agent) of the request at `index`
+        """
+        rng = self.rng
+        timestamp = self.start_time + datetime.timedelta(seconds=self.duration_seconds * index / lines)
+        if self.attacker_ips and rng.random() < self.attacker_ratio:
+            return (timestamp, rng.choice(self.attacker_ips), rng.choice(ATTACKER_URIS),
+                    rng.choice(ATTACKER_CODES), rng.choice(USER_AGENTS[3:]))
+        return (timestamp, rng.choice(self.client_ips), rng.choice(BENIGN_URIS),
+                rng.choice(BENIGN_CODES), rng.choice(USER_AGENTS))
+
+    def alb_line(self, timestamp, ip, uri, code, user_agent):
+        return ('https %s app/my-loadbalancer/50dc6c495c0c9188 %s:%d 10.0.0.1:80 0.001 0.004 0.000 %s %s 231 %d '
+                '"GET https://www.example.com:443%s HTTP/1.1" "%s" ECDHE-RSA-AES128-GCM-SHA256 TLSv1.2 '
+                'arn:aws:elasticloadbalancing:us-east-1:123456789012:targetgroup/my-targets/73e2d6bc24d8a067 '
+                '"Root=1-58337262-36d228ad5d99923122bbe354" "www.example.com" "-" 0 %s "forward" "-" "-" '
+                '"10.0.0.1:80" "%s" "-" "-"\n') % (
+            timestamp.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), ip, self.rng.randint(1024, 65535), code, code,
+            self.rng.randint(200, 20000), uri, user_agent, timestamp.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), code)
+
+    def cloudfront_line(self, timestamp, ip, uri, code, user_agent):
+        return '\t'.join((
+            timestamp.strftime('%Y-%m-%d'), timestamp.strftime('%H:%M:%S'), 'FRA6', str(self.rng.randint(200, 20000)),
+            ip, 'GET', 'd111111abcdef8.cloudfront.net', uri, code, '-', user_agent.replace(' ', '%20'), '-', '-',
+            'Miss', 'SOX4xwn4XV6Q4rgb7XiVGOHms_BGlTAC4KyHmureZmBNrjGdRLiNIQ==', 'www.example.com', 'https', '120',
+            '0.002')) + '\n'
+
+    def waf_line(self, timestamp, ip, uri, code, user_agent):
+        return json.dumps({
+            'timestamp': int(timestamp.timestamp() * 1000),
+            'formatVersion': 1,
+            'webaclId': 'arn:aws:wafv2:us-east-1:123456789012:regional/webacl/WAFSecurityAutomations/a1b2c3d4',
+            'terminatingRuleId': 'Default_Action',
+            'terminatingRuleType': 'REGULAR',
+            'action': 'ALLOW',
+            'httpSourceName': 'ALB',
+            'httpSourceId': '123456789012-app/my-loadbalancer/50dc6c495c0c9188',
+            'ruleGroupList': [],
+            'rateBasedRuleList': [],
+            'nonTerminatingMatchingRules': [],
+            'httpRequest': {
+                'clientIp': ip,
+                'country': self.rng.choice(COUNTRIES),
+                'headers': [
+                    {'name': 'Host', 'value': 'www.example.com'},
+                    {'name': 'User-Agent', 'value': user_agent}
+                ],
+                'uri': uri,
+                'args': '',
+                'httpVersion': 'HTTP/1.1',
+                'httpMethod': 'GET',
+                'requestId': '%032x' % self.rng.getrandbits(128)
+            }
+        }, separators=(',', ':')) + '\n'
+
+    def lines(self, count):
+        for index in range(count):
+            yield self.format_line(*self.next_request(index, count))
+
+
+def generate_log_file(path, log_type, lines, seed=0, compresslevel=6, **options):
+    """
+    Write `lines` synthetic log lines of `log_type` to the gzip file `path`.
+    `options` are passed to LogGenerator (attacker_ratio, attackers, clients...).
+    Returns the list of attacker IPs of the file.
+    """
+    generator = LogGenerator(log_type, seed=seed, **options)
+    with gzip.open(path, 'wt', compresslevel=compresslevel) as gzip_content:
+        if log_type == 'cloudfront':
+            gzip_content.write(CLOUDFRONT_HEADER)
+
+        batch = []
+        for line in generator.lines(lines):
+            batch.append(line)
+            if len(batch) == WRITE_BATCH_LINES:
+                gzip_content.write(''.join(batch))
+                batch = []
+        gzip_content.write(''.join(batch))
+
+    return generator.attacker_ips
+
+
+def build_parser_config(log_type, error_threshold=50, request_threshold=100, block_period=240, uri_list=None):
+    """
+    Log parser configuration in the format of the <stack>-app_log_conf.json and
+    <stack>-waf_log_conf.json files written by the custom resource
+    """
+    general = {'blockPeriod': block_period}
+    if log_type == 'waf':
+        general['requestThreshold'] = request_threshold
+    else:
+        general['errorThreshold'] = error_threshold
+        general['errorCodes'] = ['400', '401', '403', '404', '405']
+
+    return {'general': general, 'uriList': uri_list or {}}
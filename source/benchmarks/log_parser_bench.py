@@ -0,0 +1,188 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Throughput and memory benchmark of the Lambda log parser hot paths:
+read_log_file, get_outstanding_requesters, merge_outstanding_requesters and
+update_ip_set. S3 and WAF are replaced by in-memory stubs.
+
+Run from the source directory:
+
+    python -m benchmarks.log_parser_bench --lines 10000 1000000 --log-types alb waf \\
+        --output report.jsonl --baseline baseline.jsonl
+
+Every (log type, line count) case runs in a fresh process so the reported
+peak RSS belongs to that case only. Generated log files are cached in
+--work-dir and reused by later runs with the same parameters.
+"""
+
+import os
+import sys
+import copy
+import json
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# AWS clients are created on first use and S3 and WAF are stubbed, so none is called here;
+# the region only keeps an unexpected client creation from failing
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('STAGE_METRICS_ENABLED', 'false')
+os.environ.setdefault('MAX_AGE_TO_UPDATE', '30')
+os.environ.setdefault('LIMIT_IP_ADDRESS_RANGES_PER_IP_MATCH_CONDITION', '10000')
+os.environ.setdefault('IP_SET_NAME_HTTP_FLOODV4', 'benchmark-flood-v4')
+os.environ.setdefault('IP_SET_NAME_HTTP_FLOODV6', 'benchmark-flood-v6')
+os.environ.setdefault('IP_SET_ID_HTTP_FLOODV4', 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/flood-v4/1')
+os.environ.setdefault('IP_SET_ID_HTTP_FLOODV6', 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/flood-v6/2')
+os.environ.setdefault('IP_SET_NAME_SCANNERS_PROBESV4', 'benchmark-scanners-v4')
+os.environ.setdefault('IP_SET_NAME_SCANNERS_PROBESV6', 'benchmark-scanners-v6')
+os.environ.setdefault('IP_SET_ID_SCANNERS_PROBESV4', 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/scanners-v4/3')
+os.environ.setdefault('IP_SET_ID_SCANNERS_PROBESV6', 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/scanners-v6/4')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'log_parser'))
+
+from aws_lambda_powertools import Logger
+from lambda_log_parser import LambdaLogParser
+from benchmarks.log_generators import LOG_TYPES, generate_log_file, build_parser_config
+from benchmarks.report import run_timed, build_result, write_report, read_report, compare_to_baseline
+from benchmarks.stubs import StubS3, StubWAFLIBv2
+
+BUCKET_NAME = 'benchmark-bucket'
+BENCHMARKS = ('read_log_file', 'get_outstanding_requesters', 'merge_outstanding_requesters', 'update_ip_set')
+DEFAULT_LINES = (10000, 100000, 1000000)
+
+
+def create_parser(log, config):
+    parser = LambdaLogParser(log)
+    parser.s3_util = StubS3(log)
+    parser.waflib = StubWAFLIBv2()
+    parser.config = config
+    parser.configure_enrichment()
+    return parser
+
+
+def get_log_file(work_dir, log_type, lines, seed, attacker_ratio, attackers):
+    """
+    Path of the generated log file for these parameters, generating it if needed
+    """
+    path = os.path.join(work_dir, '%s-%d-seed%d-ratio%s-attackers%d.gz' % (
+        log_type, lines, seed, attacker_ratio, attackers))
+    if not os.path.exists(path):
+        partial_path = path + '.partial'
+        generate_log_file(partial_path, log_type, lines, seed=seed,
+                          attacker_ratio=attacker_ratio, attackers=attackers)
+        os.replace(partial_path, path)
+    return path
+
+
+def run_case(log_type, lines, seed, attacker_ratio, attackers, repeat, work_dir, benchmarks, thresholds):
+    """
+    Run the selected benchmarks on one generated log file and return their results.
+    Peak RSS is cumulative over the benchmarks of the case, in the order they run.
+    """
+    log = Logger(service='benchmark', level=os.getenv('LOG_LEVEL', 'WARNING'))
+    parser = create_parser(log, build_parser_config(log_type, **thresholds))
+    parameters = {'log_type': log_type, 'seed': seed, 'attacker_ratio': attacker_ratio, 'attackers': attackers}
+    parameters.update(thresholds)
+    source_path = get_log_file(work_dir, log_type, lines, seed, attacker_ratio, attackers)
+    local_path = os.path.join(work_dir, 'read-%d-%s' % (os.getpid(), os.path.basename(source_path)))
+    results = []
+
+    # read_log_file deletes its input, so every run reads a fresh copy
+    parsed = {}
+    seconds = run_timed(
+        lambda: parsed.update(zip(('counter', 'outstanding_requesters', 'bad_bot_ips'),
+                                  parser.read_log_file(local_path, log_type, 0))),
+        repeat, setup=lambda: shutil.copyfile(source_path, local_path))
+    if 'read_log_file' in benchmarks:
+        results.append(build_result('read_log_file', seconds, lines, **parameters))
+
+    counter = parsed['counter']
+    counter_entries = LambdaLogParser.get_counter_cardinality(counter)
+    outstanding = {}
+    seconds = run_timed(
+        lambda: outstanding.update(requesters=parser.get_outstanding_requesters(
+            log_type, counter, {'general': {}, 'uriList': {}})), repeat)
+    if 'get_outstanding_requesters' in benchmarks:
+        results.append(build_result('get_outstanding_requesters', seconds, counter_entries,
+                                    'counter_entries', lines=lines, **parameters))
+
+    outstanding_requesters = outstanding['requesters']
+    requesters = len(outstanding_requesters['general'])
+    output_key_name = 'benchmark-%s_log_out.json' % log_type
+
+    if 'merge_outstanding_requesters' in benchmarks:
+        # The remote state holds the same requesters, so every entry goes through the merge
+        parser.s3_util.put_object(BUCKET_NAME, output_key_name, json.dumps(outstanding_requesters))
+        merge_input = {}
+        seconds = run_timed(
+            lambda: parser.merge_outstanding_requesters(
+                BUCKET_NAME, 'benchmark.gz', log_type, output_key_name, merge_input['requesters']),
+            repeat, setup=lambda: merge_input.update(requesters=copy.deepcopy(outstanding_requesters)))
+        results.append(build_result('merge_outstanding_requesters', seconds, requesters, 'requesters',
+                                    lines=lines, **parameters))
+
+    if 'update_ip_set' in benchmarks:
+        update_input = {}
+        seconds = run_timed(
+            lambda: parser.update_ip_set(parser.flood, update_input['requesters']),
+            repeat, setup=lambda: update_input.update(requesters=copy.deepcopy(outstanding_requesters)))
+        results.append(build_result('update_ip_set', seconds, requesters, 'requesters',
+                                    lines=lines, **parameters))
+
+    return results
+
+
+def run_isolated(function, *args):
+    """
+    Run `function` in a new spawned process so peak RSS is not inherited from earlier cases
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the Lambda log parser on synthetic logs.')
+    parser.add_argument('--log-types', nargs='+', choices=LOG_TYPES, default=list(LOG_TYPES))
+    parser.add_argument('--lines', nargs='+', type=int, default=list(DEFAULT_LINES),
+                        help='Number of log lines of every generated file (10k to 10M)')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--attacker-ratio', type=float, default=0.1,
+                        help='Share of the log lines sent by attacker IPs')
+    parser.add_argument('--attackers', type=int, default=20, help='Number of attacker IPs')
+    parser.add_argument('--error-threshold', type=int, default=5, help='ALB and CloudFront errors per minute')
+    parser.add_argument('--request-threshold', type=int, default=10, help='WAF requests per minute')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark, the best time is reported')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'waf-log-parser-benchmark'),
+                        help='Directory of the generated log files')
+    parser.add_argument('--output', help='Append the JSON Lines report to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON Lines report to compare the results with')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Run all cases in this process (peak RSS is then cumulative)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    results = []
+    for log_type in args.log_types:
+        for lines in args.lines:
+            case = (log_type, lines, args.seed, args.attacker_ratio, args.attackers, args.repeat,
+                    args.work_dir, args.benchmarks,
+                    {'error_threshold': args.error_threshold, 'request_threshold': args.request_threshold})
+            results.extend(run_case(*case) if args.in_process else run_isolated(run_case, *case))
+
+    write_report(results, args.output)
+
+    if args.baseline:
+        for comparison in compare_to_baseline(results, read_report(args.baseline)):
+            sys.stderr.write(json.dumps(comparison, sort_keys=True) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    main()
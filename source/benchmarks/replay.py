@@ -0,0 +1,227 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Offline replay of the Lambda log parser over archived access logs, to tune
+thresholds and measure parser performance without touching AWS.
+
+Run from the source directory:
+
+    python -m benchmarks.replay 'logs/2024/01/*/*.gz' --log-type alb \\
+        --conf waf-stack-app_log_conf.json --state replay-state.json --workers 4
+
+Files are parsed in parallel (download, read, threshold), then merged into the
+local state file one by one in file name order and applied to in-memory IP
+sets, exactly as process_log_file does for every S3 event. Expiry uses the
+wall clock, as in the Lambda, so a single replay never expires its own blocks.
+
+The resulting block lists and a timing and memory report are printed as JSON.
+"""
+
+import os
+import sys
+import glob
+import json
+import argparse
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
+from aws_lambda_powertools import Logger
+from benchmarks.log_parser_bench import create_parser
+from benchmarks.log_generators import LOG_TYPES
+from lib.memory_profiler import get_peak_rss_bytes
+
+os.environ.setdefault('IP_SET_NAME_BAD_BOTV4', 'replay-bad-bot-v4')
+os.environ.setdefault('IP_SET_NAME_BAD_BOTV6', 'replay-bad-bot-v6')
+os.environ.setdefault('IP_SET_ID_BAD_BOTV4', 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/bad-bot-v4/5')
+os.environ.setdefault('IP_SET_ID_BAD_BOTV6', 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/bad-bot-v6/6')
+
+BUCKET_NAME = 'replay'
+STATE_KEY = 'replay_log_out.json'
+LOG_FILE_EXTENSIONS = ('.gz',)
+
+# One parser per worker process, created on first use
+worker_parser = None
+
+
+def expand_paths(paths):
+    """
+    Log files matching the given directories and glob patterns, sorted by name
+    so that time-stamped log file names are replayed in delivery order
+    """
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.update(os.path.join(root, name) for name in names if name.endswith(LOG_FILE_EXTENSIONS))
+        else:
+            files.update(p for p in glob.glob(path, recursive=True) if os.path.isfile(p))
+    return sorted(files)
+
+
+def parse_file(path, log_type, config):
+    """
+    Parse one log file and keep its outstanding requesters (worker process side)
+    """
+    global worker_parser
+    if worker_parser is None:
+        worker_parser = create_parser(create_logger(), config)
+    parser = worker_parser
+    parser.stage_timer.reset()
+    parser.configure_group_by(log_type)
+    parser.s3_util.put_file(BUCKET_NAME, path, path)
+
+    start = perf_counter()
+    counter, outstanding_requesters, bad_bot_ips = parser.parse_log_file(BUCKET_NAME, path, log_type)
+    if not parser.is_empty_counter(counter):
+        outstanding_requesters = parser.get_outstanding_requesters(log_type, counter, outstanding_requesters)
+    seconds = perf_counter() - start
+
+    lines = parser.stage_timer.get_value('LinesProcessed')
+    return {
+        'file': path,
+        'outstanding_requesters': outstanding_requesters,
+        'bad_bot_ips': bad_bot_ips,
+        'report': {
+            'file': path,
+            'lines': lines,
+            'seconds': round(seconds, 6),
+            'lines_per_second': round(lines / seconds, 3) if seconds > 0 else None,
+            'counter_entries': parser.get_counter_cardinality(counter),
+            'peak_rss_bytes': get_peak_rss_bytes(),
+        }
+    }
+
+
+def create_logger():
+    return Logger(service='replay', level=os.getenv('LOG_LEVEL', 'WARNING'))
+
+
+def load_state(parser, state_path):
+    if state_path and os.path.exists(state_path):
+        with open(state_path, 'rb') as state_file:
+            parser.s3_util.put_object(BUCKET_NAME, STATE_KEY, state_file.read())
+
+
+def save_state(parser, state_path):
+    if state_path and (BUCKET_NAME, STATE_KEY) in parser.s3_util.objects:
+        with open(state_path, 'wb') as state_file:
+            state_file.write(parser.s3_util.objects[(BUCKET_NAME, STATE_KEY)])
+
+
+def apply_result(parser, result, log_type, ip_set_type):
+    """
+    Merge the outstanding requesters of one file into the state and the IP sets,
+    following LambdaLogParser.process_log_file
+    """
+    outstanding_requesters = result['outstanding_requesters']
+    need_update = False
+    if outstanding_requesters['general'] or outstanding_requesters['uriList']:
+        outstanding_requesters, need_update = parser.merge_outstanding_requesters(
+            BUCKET_NAME, result['file'], log_type, STATE_KEY, outstanding_requesters)
+        if need_update:
+            parser.write_output(BUCKET_NAME, result['file'], STATE_KEY, outstanding_requesters)
+            parser.update_ip_set(ip_set_type, outstanding_requesters)
+
+    if result['bad_bot_ips']:
+        parser.bad_bot_ips_to_ip_set(result['bad_bot_ips'])
+    return need_update
+
+
+def get_block_lists(parser):
+    waflib = parser.waflib
+    names = {
+        'http_flood': ('IP_SET_ID_HTTP_FLOODV4', 'IP_SET_ID_HTTP_FLOODV6'),
+        'scanners_probes': ('IP_SET_ID_SCANNERS_PROBESV4', 'IP_SET_ID_SCANNERS_PROBESV6'),
+        'bad_bot': ('IP_SET_ID_BAD_BOTV4', 'IP_SET_ID_BAD_BOTV6'),
+    }
+    block_lists = {}
+    for name, (arn_v4, arn_v6) in names.items():
+        addresses_v4 = waflib.ip_sets.get(os.getenv(arn_v4))
+        addresses_v6 = waflib.ip_sets.get(os.getenv(arn_v6))
+        if addresses_v4 is not None or addresses_v6 is not None:
+            block_lists[name] = {'ipv4': sorted(addresses_v4 or []), 'ipv6': sorted(addresses_v6 or [])}
+    return block_lists
+
+
+def replay(files, log_type, config, state_path=None, workers=None, ip_set_type=None):
+    """
+    Replay `files` and return the block lists and the timing and memory report
+    """
+    start = perf_counter()
+    parser = create_parser(create_logger(), config)
+    if ip_set_type is None:
+        ip_set_type = parser.flood if log_type == 'waf' else parser.scanners
+    load_state(parser, state_path)
+
+    parse_start = perf_counter()
+    if workers == 1:
+        results = [parse_file(path, log_type, config) for path in files]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(parse_file, files, [log_type] * len(files), [config] * len(files)))
+    parse_seconds = perf_counter() - parse_start
+
+    merge_start = perf_counter()
+    updates = sum(apply_result(parser, result, log_type, ip_set_type) for result in results)
+    merge_seconds = perf_counter() - merge_start
+    save_state(parser, state_path)
+
+    lines = sum(result['report']['lines'] for result in results)
+    total_seconds = perf_counter() - start
+    return {
+        'block_lists': get_block_lists(parser),
+        'report': {
+            'files': len(files),
+            'lines': lines,
+            'state_updates': updates,
+            'parse_seconds': round(parse_seconds, 6),
+            'merge_seconds': round(merge_seconds, 6),
+            'total_seconds': round(total_seconds, 6),
+            'lines_per_second': round(lines / parse_seconds, 3) if parse_seconds > 0 else None,
+            'peak_rss_bytes': get_peak_rss_bytes(),
+            'worker_peak_rss_bytes': max((r['report']['peak_rss_bytes'] for r in results), default=0),
+            'per_file': [result['report'] for result in results],
+        }
+    }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Replay the Lambda log parser over local log files.')
+    parser.add_argument('paths', nargs='+', help='Log directories or glob patterns of gzip log files')
+    parser.add_argument('--log-type', choices=LOG_TYPES, required=True)
+    parser.add_argument('--conf', required=True,
+                        help='Parser configuration (<stack>-app_log_conf.json or <stack>-waf_log_conf.json)')
+    parser.add_argument('--state', help='Local state file (binary or legacy JSON), read if present and '
+                                        'updated at the end of the replay')
+    parser.add_argument('--ip-set-type', choices=('scanners', 'flood'),
+                        help='IP sets to update (default: flood for WAF logs, scanners otherwise)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Parallel parser processes')
+    parser.add_argument('--output', help='Write the JSON result to this file instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    files = expand_paths(args.paths)
+    if not files:
+        sys.stderr.write('No log file found in %s\n' % ' '.join(args.paths))
+        return 1
+
+    with open(args.conf) as conf_file:
+        config = json.load(conf_file)
+    ip_set_type = {'scanners': 1, 'flood': 2}.get(args.ip_set_type)
+
+    result = replay(files, args.log_type, config, args.state, args.workers, ip_set_type)
+
+    output = json.dumps(result, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        sys.stdout.write(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Machine readable benchmark reports: one JSON object per line (JSON Lines), so
+reports can be appended to, diffed and compared against a stored baseline.
+"""
+
+import json
+import sys
+import platform
+from time import perf_counter
+from lib.memory_profiler import get_peak_rss_bytes
+
+# Measurements of a result, every other field identifies the benchmark case
+MEASURED_FIELDS = ('seconds', 'peak_rss_bytes', 'python', 'allocated_bytes', 'allocations', 'api_calls', 'calls',
+                   'errors', 'failed_updates', 'addresses_written', 'simulated_api_seconds', 'modules_imported',
+                   'clients_at_import', 'slowest_modules', 'over_budget')
+
+
+def run_timed(function, repeat=1, setup=None):
+    """
+    Call `function` `repeat` times and return the best wall clock time in seconds.
+    `setup` is called before every run, outside of the timer.
+    """
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = perf_counter()
+        function()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def build_result(benchmark, seconds, items=None, item_name='lines', **parameters):
+    """
+    One report entry. Throughput is reported as `<item_name>_per_second`.
+    """
+    result = {
+        'benchmark': benchmark,
+        'seconds': round(seconds, 6),
+        'peak_rss_bytes': get_peak_rss_bytes(),
+        'python': platform.python_version(),
+    }
+    result.update(parameters)
+    if items is not None:
+        result[item_name] = items
+        result[item_name + '_per_second'] = round(items / seconds, 3) if seconds > 0 else None
+    return result
+
+
+def result_key(result):
+    """
+    Identity of a result across runs: the benchmark name plus its parameters
+    """
+    return tuple(sorted((k, str(v)) for k, v in result.items()
+                        if k not in MEASURED_FIELDS and not k.endswith('_per_second')))
+
+
+def write_report(results, output=None):
+    """
+    Write results as JSON Lines to the file `output`, or to stdout
+    """
+    lines = ''.join(json.dumps(result, sort_keys=True) + '\n' for result in results)
+    if output:
+        with open(output, 'a') as report:
+            report.write(lines)
+    else:
+        sys.stdout.write(lines)
+
+
+def read_report(path):
+    with open(path) as report:
+        return [json.loads(line) for line in report if line.strip()]
+
+
+def compare_to_baseline(results, baseline):
+    """
+    Return, for every result also present in `baseline`, the relative change of
+    wall clock time, peak RSS, and of allocations and WAF API calls when they are
+    measured (0.1 means 10% slower / bigger than baseline).
+    """
+    baseline_by_key = {result_key(result): result for result in baseline}
+    comparison = []
+    for result in results:
+        previous = baseline_by_key.get(result_key(result))
+        if previous is None:
+            continue
+        change = {
+            'benchmark': result['benchmark'],
+            'key': dict(result_key(result)),
+            'seconds_change': round(result['seconds'] / previous['seconds'] - 1, 4) if previous['seconds'] else None,
+            'peak_rss_change': round(result['peak_rss_bytes'] / previous['peak_rss_bytes'] - 1, 4)
+            if previous.get('peak_rss_bytes') else None,
+        }
+        if 'allocated_bytes' in result and previous.get('allocated_bytes'):
+            change['allocated_bytes_change'] = round(result['allocated_bytes'] / previous['allocated_bytes'] - 1, 4)
+        if 'api_calls' in result and previous.get('api_calls'):
+            change['api_calls_change'] = round(result['api_calls'] / previous['api_calls'] - 1, 4)
+        comparison.append(change)
+    return comparison
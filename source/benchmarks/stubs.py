@@ -0,0 +1,106 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+In-process stand-ins for the S3 and WAF helpers used by the log parser, so the
+parsing and merging code can be measured without any AWS call.
+"""
+
+import json
+import shutil
+import hashlib
+import datetime
+from botocore.exceptions import ClientError
+from lib.waflibv2 import WAFLIBv2
+
+
+class StubS3(object):
+    """
+    Drop-in replacement of lib.s3_util.S3 backed by an in-memory dict of
+    (bucket, key) -> bytes. Log files can also be registered by local path.
+    """
+
+    def __init__(self, log=None):
+        self.log = log
+        self.objects = {}
+        self.files = {}
+        self.last_modified = {}
+
+    def put_object(self, bucket_name, key_name, body, last_modified=None):
+        self.objects[(bucket_name, key_name)] = body if isinstance(body, bytes) else body.encode('utf-8')
+        self.last_modified[(bucket_name, key_name)] = last_modified or datetime.datetime.now(datetime.timezone.utc)
+
+    def put_file(self, bucket_name, key_name, local_file_path):
+        self.files[(bucket_name, key_name)] = local_file_path
+        self.last_modified[(bucket_name, key_name)] = datetime.datetime.now(datetime.timezone.utc)
+
+    def read_json_config_file_from_s3(self, bucket_name, key_name):
+        return json.loads(self.objects[(bucket_name, key_name)])
+
+    def download_file_from_s3(self, bucket_name, key_name, local_file_path):
+        if (bucket_name, key_name) in self.files:
+            shutil.copyfile(self.files[(bucket_name, key_name)], local_file_path)
+            return
+        with open(local_file_path, 'wb') as local_file:
+            local_file.write(self.objects[(bucket_name, key_name)])
+
+    def upload_file_to_s3(self, file_path, bucket_name, key_name, extra_args=None):
+        with open(file_path, 'rb') as local_file:
+            self.put_object(bucket_name, key_name, local_file.read())
+
+    def read_object(self, bucket_name, key_name):
+        if (bucket_name, key_name) in self.files:
+            with open(self.files[(bucket_name, key_name)], 'rb') as local_file:
+                body = local_file.read()
+        else:
+            body = self.objects[(bucket_name, key_name)]
+        return body, self.get_etag(bucket_name, key_name)
+
+    def put_object_body(self, bucket_name, key_name, body, content_type=None, if_match=None, if_none_match=None):
+        exists = (bucket_name, key_name) in self.objects
+        if (if_match and if_match != self.get_etag(bucket_name, key_name)) or (if_none_match and exists):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': 'At least one of the '
+                               'pre-conditions you specified did not hold'}}, 'PutObject')
+        self.put_object(bucket_name, key_name, body)
+        return {'ETag': self.get_etag(bucket_name, key_name)}
+
+    def get_etag(self, bucket_name, key_name):
+        if (bucket_name, key_name) not in self.objects:
+            return None
+        return '"%s"' % hashlib.md5(self.objects[(bucket_name, key_name)]).hexdigest()
+
+    def get_head_object(self, bucket_name, key_name):
+        if (bucket_name, key_name) not in self.last_modified:
+            return None
+        response = {'LastModified': self.last_modified[(bucket_name, key_name)]}
+        if (bucket_name, key_name) in self.objects:
+            response['ETag'] = self.get_etag(bucket_name, key_name)
+            response['ContentLength'] = len(self.objects[(bucket_name, key_name)])
+        return response
+
+
+class StubWAFLIBv2(WAFLIBv2):
+    """
+    WAFLIBv2 whose IP set writes are kept in memory instead of calling WAF.
+    Address parsing helpers (which_ip_version, set_ip_cidr...) are inherited.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.ip_sets = {}
+        self.calls = 0
+
+    def sync_ip_set(self, log, scope, name, ip_set_arn, addresses):
+        additions, removals = self.diff_addresses(self.ip_sets.get(ip_set_arn, []), addresses)
+        updated = bool(additions or removals)
+        if updated:
+            self.calls += 1
+            self.ip_sets[ip_set_arn] = list(addresses)
+        return {'Added': len(additions), 'Removed': len(removals), 'Updated': updated, 'Response': None}
+
+    def patch_ip_set(self, log, scope, name, ip_set_arn, addresses, ip_range_limit):
+        self.calls += 1
+        current = self.ip_sets.get(ip_set_arn, [])
+        known = set(current)
+        self.ip_sets[ip_set_arn] = (current + [a for a in addresses if a not in known])[:ip_range_limit]
+        return self.ip_sets[ip_set_arn]
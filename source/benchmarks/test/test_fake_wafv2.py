@@ -0,0 +1,105 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import unittest
+from unittest.mock import Mock, patch
+from botocore.exceptions import ClientError
+from lib.waflibv2 import WAFLIBv2
+from benchmarks.fake_wafv2 import FakeWAFv2Client
+from benchmarks.ip_set_update_bench import run_scenario
+
+
+def error_code(e):
+    return e.exception.response['Error']['Code']
+
+
+@patch('lib.waflibv2.rate_limiter', False)
+class TestFakeWAFv2Client(unittest.TestCase):
+    def setUp(self):
+        self.log = Mock()
+        self.fake = FakeWAFv2Client(seed=1, ip_set_address_limit=3)
+        self.summary = self.fake.create_ip_set(Name='flood-v4', Scope='REGIONAL', IPAddressVersion='IPV4',
+                                               Addresses=['192.0.2.1/32'])['Summary']
+
+    def test_lock_tokens_and_limits(self):
+        response = self.fake.get_ip_set(Name='flood-v4', Scope='REGIONAL', Id=self.summary['Id'])
+        self.assertEqual(response['LockToken'], self.summary['LockToken'])
+
+        update = self.fake.update_ip_set(Name='flood-v4', Scope='REGIONAL', Id=self.summary['Id'],
+                                         Addresses=['192.0.2.2/32'], LockToken=response['LockToken'])
+        self.assertNotEqual(update['NextLockToken'], response['LockToken'])
+
+        with self.assertRaises(ClientError) as e:
+            self.fake.update_ip_set(Name='flood-v4', Scope='REGIONAL', Id=self.summary['Id'],
+                                    Addresses=['192.0.2.3/32'], LockToken=response['LockToken'])
+        self.assertEqual(error_code(e), 'WAFOptimisticLockException')
+        with self.assertRaises(ClientError) as e:
+            self.fake.update_ip_set(Name='flood-v4', Scope='REGIONAL', Id=self.summary['Id'],
+                                    Addresses=['192.0.2.%d/32' % i for i in range(4)],
+                                    LockToken=update['NextLockToken'])
+        self.assertEqual(error_code(e), 'WAFLimitsExceededException')
+        with self.assertRaises(ClientError) as e:
+            self.fake.update_ip_set(Name='flood-v4', Scope='REGIONAL', Id=self.summary['Id'],
+                                    Addresses=['2001:db8::1/128'], LockToken=update['NextLockToken'])
+        self.assertEqual(error_code(e), 'WAFInvalidParameterException')
+        self.assertEqual(self.fake.get_addresses(self.summary['Id']), ['192.0.2.2/32'])
+
+    def test_waflib_runs_against_the_fake(self):
+        with self.fake.install():
+            result = WAFLIBv2().sync_ip_set(self.log, 'REGIONAL', 'flood-v4', self.summary['ARN'],
+                                            ['192.0.2.1/32', '192.0.2.5/32'])
+            # Another writer changed the IP set: the cached lock token is stale
+            self.fake.touch_ip_set(self.summary['Id'])
+            patched = WAFLIBv2().patch_ip_set(self.log, 'REGIONAL', 'flood-v4', self.summary['ARN'],
+                                              ['192.0.2.6/32'], 3)
+
+        self.assertEqual(result['Added'], 1)
+        self.assertIsNotNone(patched)
+        self.assertEqual(self.fake.get_addresses(self.summary['Id']), ['192.0.2.6/32', '192.0.2.1/32', '192.0.2.5/32'])
+        self.assertEqual(self.fake.errors, {'WAFOptimisticLockException': 1})
+        self.assertEqual(self.fake.calls['get_ip_set'], 2)
+
+    def test_scripted_errors(self):
+        self.fake.inject_error('get_ip_set', 'WAFInternalErrorException')
+
+        with self.fake.install():
+            self.assertIsNone(WAFLIBv2().get_ip_set_by_id(self.log, 'REGIONAL', 'flood-v4', self.summary['Id']))
+            self.assertIsNotNone(WAFLIBv2().get_ip_set_by_id(self.log, 'REGIONAL', 'flood-v4', self.summary['Id']))
+        self.assertEqual(self.fake.errors, {'WAFInternalErrorException': 1})
+
+    def test_injections_are_deterministic(self):
+        def run():
+            fake = FakeWAFv2Client(seed=7, throttle_rate=0.3, conflict_rate=0.3, latency=0.01)
+            summary = fake.create_ip_set(Name='flood-v4', Scope='REGIONAL', IPAddressVersion='IPV4',
+                                         Addresses=[])['Summary']
+            for i in range(20):
+                try:
+                    token = fake.get_ip_set(Name='flood-v4', Scope='REGIONAL', Id=summary['Id'])['LockToken']
+                    fake.update_ip_set(Name='flood-v4', Scope='REGIONAL', Id=summary['Id'],
+                                       Addresses=['192.0.2.%d/32' % i], LockToken=token)
+                except ClientError:
+                    pass
+            return dict(fake.calls), dict(fake.errors), fake.simulated_seconds, fake.get_addresses(summary['Id'])
+
+        first = run()
+        self.assertEqual(first, run())
+        self.assertGreater(first[1]['WAFLimitsExceededException'], 0)
+        self.assertGreater(first[1]['WAFOptimisticLockException'], 0)
+
+    def test_quota(self):
+        fake = FakeWAFv2Client(calls_per_second=2, clock=lambda: 100.5)
+        fake.list_ip_sets(Scope='REGIONAL')
+        fake.list_ip_sets(Scope='REGIONAL')
+        with self.assertRaises(ClientError) as e:
+            fake.list_ip_sets(Scope='REGIONAL')
+        self.assertEqual(error_code(e), 'WAFLimitsExceededException')
+
+    def test_update_scenario(self):
+        sync = run_scenario('sync', 100, 0.01, rounds=2)
+        sharded = run_scenario('sharded', 100, 0.01, rounds=2, shards=4)
+
+        self.assertEqual(sync['calls'], {'get_ip_set': 1, 'update_ip_set': 2})
+        self.assertEqual(sync, dict(run_scenario('sync', 100, 0.01, rounds=2), seconds=sync['seconds'],
+                                    rounds_per_second=sync['rounds_per_second'], peak_rss_bytes=sync['peak_rss_bytes']))
+        self.assertLess(sharded['addresses_written'], sync['addresses_written'])
+        self.assertEqual(sync['failed_updates'], 0)
@@ -0,0 +1,25 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import unittest
+from benchmarks import import_bench
+
+IMPORTTIME = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |     botocore.exceptions
+import time:       300 |        420 |   lib.boto3_util
+import time:        80 |        500 | handler
+"""
+
+
+class TestImportBench(unittest.TestCase):
+    def test_parse_importtime(self):
+        self.assertEqual(import_bench.parse_importtime(IMPORTTIME), [
+            ('botocore.exceptions', 2, 120, 120), ('lib.boto3_util', 1, 300, 420), ('handler', 0, 80, 500)])
+
+    def test_entry_point_creates_no_client_at_import(self):
+        result = import_bench.run_entry_point('remove_expired_ip', repeat=1, budget_ms=60000)
+
+        self.assertEqual(result['clients_at_import'], [])
+        self.assertGreater(result['seconds'], 0)
+        self.assertFalse(result['over_budget'])
+        self.assertNotIn('boto3', [name for name, _ in result['slowest_modules']])
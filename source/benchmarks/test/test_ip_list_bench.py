@@ -0,0 +1,39 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import unittest
+from unittest.mock import Mock
+from lib.ip_util import AddressSet
+from benchmarks import ip_list_bench
+from benchmarks.report import compare_to_baseline
+
+
+class TestIPListBench(unittest.TestCase):
+    def test_generated_lists(self):
+        ips = ip_list_bench.generate_ips(500, seed=1, cidr=True)
+
+        self.assertEqual(len(set(ips)), 500)
+        self.assertEqual(ips, ip_list_bench.generate_ips(500, seed=1, cidr=True))
+        self.assertTrue(any(':' in ip for ip in ips))
+        self.assertEqual(len(ip_list_bench.generate_feed(500)), 500)
+
+    def test_reference_and_current_agree(self):
+        results = {}
+        for benchmark, implementation, function in ip_list_bench.build_cases(Mock(), 300, 0):
+            results.setdefault(benchmark, {})[implementation] = function()
+
+        for benchmark in ('set_ip_cidr', 'process_url_list'):
+            self.assertEqual(set(AddressSet(results[benchmark]['reference'])),
+                             set(AddressSet(results[benchmark]['current'])))
+        reference_keep, reference_remove = results['make_ip_list']['reference']
+        keep, remove = results['make_ip_list']['current']
+        self.assertEqual((set(reference_keep), set(reference_remove)), (set(keep), set(remove)))
+
+    def test_report(self):
+        results = ip_list_bench.main(['--sizes', '200', '--repeat', '1', '--benchmarks', 'make_ip_list',
+                                      '--output', '/dev/null'])
+
+        self.assertEqual([result['implementation'] for result in results], ['reference', 'current'])
+        self.assertTrue(all(result['allocated_bytes'] > 0 and result['entries'] == 200 for result in results))
+        comparison = compare_to_baseline(results, results)
+        self.assertEqual({change['allocated_bytes_change'] for change in comparison}, {0})
@@ -0,0 +1,64 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import gzip
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+from benchmarks.log_generators import LOG_TYPES, LogGenerator, generate_log_file, build_parser_config
+from benchmarks.report import build_result, compare_to_baseline
+from benchmarks import log_parser_bench
+
+
+class TestLogGenerators(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.work_dir):
+            os.remove(os.path.join(self.work_dir, name))
+        os.rmdir(self.work_dir)
+
+    def test_same_seed_same_lines(self):
+        first = list(LogGenerator('alb', seed=7).lines(50))
+        second = list(LogGenerator('alb', seed=7).lines(50))
+        other = list(LogGenerator('alb', seed=8).lines(50))
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+
+    def test_unsupported_log_type(self):
+        with self.assertRaises(ValueError):
+            LogGenerator('elb')
+
+    def test_attacker_ratio(self):
+        generator = LogGenerator('waf', attacker_ratio=0.5, attackers=5)
+        attacker_ips = set(generator.attacker_ips)
+        ips = [generator.next_request(i, 1000)[1] for i in range(1000)]
+
+        self.assertAlmostEqual(sum(ip in attacker_ips for ip in ips) / 1000, 0.5, delta=0.1)
+
+    def test_generated_files_are_parsed(self):
+        for log_type in LOG_TYPES:
+            path = os.path.join(self.work_dir, log_type + '.gz')
+            attacker_ips = generate_log_file(path, log_type, 2000, attacker_ratio=0.5, attackers=3)
+            with gzip.open(path, 'rt') as gzip_content:
+                self.assertEqual(sum(1 for line in gzip_content if not line.startswith('#')), 2000)
+
+            parser = log_parser_bench.create_parser(Mock(), build_parser_config(log_type, 5, 10))
+            counter, _, _ = parser.read_log_file(path, log_type, 0)
+            outstanding = parser.get_outstanding_requesters(log_type, counter, {'general': {}, 'uriList': {}})
+
+            self.assertEqual(set(outstanding['general']), set(attacker_ips), log_type)
+
+    def test_compare_to_baseline(self):
+        baseline = [build_result('read_log_file', 2.0, 1000, log_type='alb')]
+        results = [build_result('read_log_file', 3.0, 1000, log_type='alb'),
+                   build_result('read_log_file', 1.0, 1000, log_type='waf')]
+
+        comparison = compare_to_baseline(results, baseline)
+
+        self.assertEqual(len(comparison), 1)
+        self.assertEqual(comparison[0]['seconds_change'], 0.5)
+        self.assertEqual(results[0]['lines_per_second'], round(1000 / 3.0, 3))
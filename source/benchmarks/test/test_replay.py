@@ -0,0 +1,44 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import os
+import shutil
+import tempfile
+import unittest
+from benchmarks import replay
+from benchmarks.log_generators import generate_log_file, build_parser_config
+from requester_state import decode_state
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.attacker_ips = set()
+        for i in range(2):
+            path = os.path.join(self.work_dir, 'logs', 'alb-%d.gz' % i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.attacker_ips.update(generate_log_file(path, 'alb', 2000, seed=i, attacker_ratio=0.5, attackers=2))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_expand_paths(self):
+        logs_dir = os.path.join(self.work_dir, 'logs')
+
+        self.assertEqual(len(replay.expand_paths([logs_dir])), 2)
+        self.assertEqual(replay.expand_paths([os.path.join(logs_dir, '*-1.gz')]),
+                         [os.path.join(logs_dir, 'alb-1.gz')])
+
+    def test_replay_blocks_attackers_and_writes_state(self):
+        state_path = os.path.join(self.work_dir, 'state.json')
+        files = replay.expand_paths([os.path.join(self.work_dir, 'logs')])
+
+        result = replay.replay(files, 'alb', build_parser_config('alb', error_threshold=5), state_path, workers=1)
+
+        blocked = result['block_lists']['scanners_probes']
+        self.assertEqual({ip.split('/')[0] for ip in blocked['ipv4'] + blocked['ipv6']}, self.attacker_ips)
+        self.assertEqual(result['report']['files'], 2)
+        self.assertEqual(result['report']['lines'], 4000)
+        self.assertGreater(result['report']['peak_rss_bytes'], 0)
+        with open(state_path, 'rb') as state_file:
+            self.assertEqual(set(decode_state(state_file.read())['general']), self.attacker_ips)
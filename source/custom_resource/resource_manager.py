@@ -403,7 +403,8 @@ class ResourceManager:
             web_acl_arn=event['ResourceProperties']['WAFWebACLArn'], 
             delivery_stream_arn=event['ResourceProperties']['DeliveryStreamArn'],
             is_bad_bot_waf_logs=event['ResourceProperties']['IsBadBotOnlyWAFLogs'] == 'true',
-            bad_bot_waf_logs_label=event['ResourceProperties']['BadBotWafLogLabel']
+            bad_bot_waf_logs_label=event['ResourceProperties']['BadBotWafLogLabel'],
+            logging_filters=event['ResourceProperties'].get('WafLogFilters')
         )
 
         self.log.debug("[waflib:put_logging_configuration] End")
@@ -395,4 +395,19 @@ def test_add_athena_partitions_invalid_json_response():
             'Payload': MagicMock(read=lambda: 'Invalid JSON'.encode('utf-8'))
         }
         with pytest.raises(json.JSONDecodeError):
-            resource_manager.add_athena_partitions(event)
\ No newline at end of file
+            resource_manager.add_athena_partitions(event)
+
+
+def test_put_logging_configuration_filters(configure_aws_waf_logs_create_event):
+    event = json.loads(json.dumps(configure_aws_waf_logs_create_event))
+    event['ResourceProperties']['WafLogFilters'] = \
+        '{"DefaultBehavior": "DROP", "Filters": [{"Behavior": "KEEP", "Actions": ["BLOCK"]}]}'
+    manager = ResourceManager(log)
+    manager.waflib = MagicMock()
+
+    manager.put_logging_configuration(event)
+
+    kwargs = manager.waflib.put_logging_configuration.call_args.kwargs
+    assert kwargs['logging_filters'] == \
+        '{"DefaultBehavior": "DROP", "Filters": [{"Behavior": "KEEP", "Actions": ["BLOCK"]}]}'
+    assert not kwargs['is_bad_bot_waf_logs']
@@ -624,6 +624,31 @@ export class AwsWafSecurityAutomationsStack extends Stack {
         constraintDescription:
           "Must be one of the following values: 1, 2, 5, or 10",
       }),
+
+      activateIPSetIntentQueue: new CfnParameter(
+        this,
+        "ActivateIPSetIntentQueueParam",
+        {
+          type: "String",
+          default: "no",
+          allowedValues: ["yes", "no"],
+          description: [
+            "Choose yes to have the log parser queue its IP set changes to a single writer instead of updating",
+            "the IP sets itself. The writer applies the changes of each IP set in order with one update, which",
+            "reduces conflicting updates when many log files are processed at the same time.",
+          ].join(" "),
+        },
+      ),
+      wafLogFilters: new CfnParameter(this, "WAFLogFiltersParam", {
+        type: "String",
+        default: "",
+        description: [
+          "If you chose Lambda Log Parser to activate HTTP Flood Protection, you can filter the WAF logs",
+          'with a JSON list of rules such as [{"Behavior":"DROP","Actions":["BLOCK"]}], or',
+          '{"DefaultBehavior":"DROP","Filters":[...]} to drop the requests no rule keeps. Dropped requests',
+          "are neither delivered nor counted by the log parser. Leave empty to log every request.",
+        ].join(" "),
+      }),
     };
 
     //=============================================================================================
@@ -766,6 +791,20 @@ export class AwsWafSecurityAutomationsStack extends Stack {
       ),
     });
 
+    const ipSetIntentQueueActivated = new CfnCondition(
+      this,
+      "IPSetIntentQueueActivated",
+      {
+        expression: Fn.conditionAnd(
+          logParser,
+          Fn.conditionEquals(
+            parameters.activateIPSetIntentQueue.valueAsString,
+            "yes",
+          ),
+        ),
+      },
+    );
+
     const createFirehoseAthenaStack = new CfnCondition(
       this,
       "CreateFirehoseAthenaStack",
@@ -1264,6 +1303,7 @@ export class AwsWafSecurityAutomationsStack extends Stack {
       webACLStack: this.webAcl,
       firehoseAthenaNestedStack: this.firehoseAthenaNestedStack,
       badBotLambdaLogParserActivated: badBotLambdaLogParserActivated,
+      wafLogFilters: parameters.wafLogFilters,
     });
 
     //=============================================================================================
@@ -1339,6 +1379,7 @@ export class AwsWafSecurityAutomationsStack extends Stack {
       solutionMapping: solutionMapping,
       httpFloodAthenaLogParser: httpFloodAthenaLogParser,
       logParser: logParser,
+      ipSetIntentQueueActivated: ipSetIntentQueueActivated,
       albEndpoint: albEndpoint,
       isAthenaQueryRunEveryMinute: isAthenaQueryRunEveryMinute,
       customResource: customResource,
@@ -2,7 +2,13 @@
 // SPDX-License-Identifier: Apache-2.0
 
 import { Construct } from "constructs";
-import { CfnCondition, CfnResource, CustomResource, Fn } from "aws-cdk-lib";
+import {
+  CfnCondition,
+  CfnParameter,
+  CfnResource,
+  CustomResource,
+  Fn,
+} from "aws-cdk-lib";
 import { IFunction } from "aws-cdk-lib/aws-lambda";
 import { distVersion, manifest } from "../../constants/waf-constants";
 import { WebaclNestedstack } from "../../nestedstacks/webacl/webacl-nestedstack";
@@ -15,6 +21,7 @@ export interface ConfigureAWSWAFLogsProps {
   helperFunction: IFunction;
   webACLStack: WebaclNestedstack;
   firehoseAthenaNestedStack: FirehoseAthenaNestedStack;
+  wafLogFilters: CfnParameter;
 }
 
 export class ConfigureAWSWAFLogs extends Construct {
@@ -60,6 +67,7 @@ export class ConfigureAWSWAFLogs extends Construct {
           "false",
         ).toString(),
         BadBotWafLogLabel: badBotWafLogLabel,
+        WafLogFilters: props.wafLogFilters.valueAsString,
       },
     });
 
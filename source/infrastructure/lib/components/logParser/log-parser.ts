@@ -8,6 +8,7 @@ import { LogsForPartition } from "../logsForPartition/logs-for-partition";
 import { CustomResourceLambda } from "../customResource/custom-resource-lambda";
 import { distVersion, manifest } from "../../constants/waf-constants";
 import {
+  CfnEventSourceMapping,
   CfnFunction,
   CfnPermission,
   IFunction,
@@ -26,6 +27,7 @@ import {
 } from "aws-cdk-lib";
 import { CfnRole } from "aws-cdk-lib/aws-iam";
 import { CfnRule } from "aws-cdk-lib/aws-events";
+import { CfnQueue } from "aws-cdk-lib/aws-sqs";
 import { WebaclNestedstack } from "../../nestedstacks/webacl/webacl-nestedstack";
 import Utils from "../../mappings/utils";
 
@@ -45,6 +47,7 @@ export interface LogParserProps {
   turnOnAppAccessLogBucketLogging: CfnCondition;
   httpFloodAthenaLogParser: CfnCondition;
   logParser: CfnCondition;
+  ipSetIntentQueueActivated: CfnCondition;
   albEndpoint: CfnCondition;
   isAthenaQueryRunEveryMinute: CfnCondition;
   badBotLambdaAccessLogActivated: CfnCondition;
@@ -65,6 +68,9 @@ export class LogParser extends Construct {
   public static readonly ID_WAF_CONF = "GenerateWafLogParserConfFile";
   public static readonly ID_LAMBDA_PARSER = "LambdaAthenaAppLogParser";
   public static readonly ID_WAF_LAMBDA_PARSER = "LambdaAthenaWAFLogParser";
+  public static readonly ID_EXPIRY_SWEEPER = "LambdaLogParserExpirySweeper";
+  public static readonly ID_IP_SET_WRITER = "LambdaLogParserIPSetWriter";
+  public static readonly ID_INTENT_QUEUE = "IPSetIntentQueue";
   public static readonly ID = "LogParser";
 
   private readonly logParserFunction: CfnFunction;
@@ -72,6 +78,17 @@ export class LogParser extends Construct {
   constructor(scope: Construct, id: string, props: LogParserProps) {
     super(scope, id);
 
+    // FIFO queue, one message group per IP set: the intents of an IP set are
+    // delivered in order and to one invocation at a time
+    const ipSetIntentQueue = new CfnQueue(this, LogParser.ID_INTENT_QUEUE, {
+      fifoQueue: true,
+      messageRetentionPeriod: 3600,
+      visibilityTimeout: 300,
+      sqsManagedSseEnabled: true,
+    });
+    ipSetIntentQueue.overrideLogicalId(LogParser.ID_INTENT_QUEUE);
+    ipSetIntentQueue.cfnOptions.condition = props.ipSetIntentQueueActivated;
+
     const lambdaRoleLogParser = new CfnRole(this, "LambdaRoleLogParser", {
       assumeRolePolicyDocument: {
         Statement: [
@@ -132,11 +149,26 @@ export class LogParser extends Construct {
                     Fn.sub(
                       "arn:${AWS::Partition}:s3:::${AppAccessLogBucket}/${AWS::StackName}-app_log_out.json",
                     ),
+                    Fn.sub(
+                      "arn:${AWS::Partition}:s3:::${AppAccessLogBucket}/${AWS::StackName}-app_log_out.json.shard-*",
+                    ),
                     Fn.sub(
                       "arn:${AWS::Partition}:s3:::${AppAccessLogBucket}/${AWS::StackName}-app_log_conf.json",
                     ),
                   ],
                 },
+                {
+                  Effect: "Allow",
+                  Action: "s3:ListBucket",
+                  Resource: [Fn.sub("arn:${AWS::Partition}:s3:::${AppAccessLogBucket}")],
+                  Condition: {
+                    StringLike: {
+                      "s3:prefix": Fn.sub(
+                        "${AWS::StackName}-app_log_out.json.shard-*",
+                      ),
+                    },
+                  },
+                },
                 {
                   Effect: "Allow",
                   Action: ["wafv2:GetIPSet", "wafv2:UpdateIPSet"],
@@ -246,11 +278,26 @@ export class LogParser extends Construct {
                     Fn.sub(
                       "arn:${AWS::Partition}:s3:::${WafLogBucket}/${AWS::StackName}-waf_log_out.json",
                     ),
+                    Fn.sub(
+                      "arn:${AWS::Partition}:s3:::${WafLogBucket}/${AWS::StackName}-waf_log_out.json.shard-*",
+                    ),
                     Fn.sub(
                       "arn:${AWS::Partition}:s3:::${WafLogBucket}/${AWS::StackName}-waf_log_conf.json",
                     ),
                   ],
                 },
+                {
+                  Effect: "Allow",
+                  Action: "s3:ListBucket",
+                  Resource: [Fn.sub("arn:${AWS::Partition}:s3:::${WafLogBucket}")],
+                  Condition: {
+                    StringLike: {
+                      "s3:prefix": Fn.sub(
+                        "${AWS::StackName}-waf_log_out.json.shard-*",
+                      ),
+                    },
+                  },
+                },
                 {
                   Effect: "Allow",
                   Action: ["wafv2:GetIPSet", "wafv2:UpdateIPSet"],
@@ -330,6 +377,66 @@ export class LogParser extends Construct {
           },
           Aws.NO_VALUE,
         ),
+        {
+          policyName: "WAFGetAllowlistIPSet",
+          policyDocument: {
+            Statement: [
+              {
+                Effect: "Allow",
+                Action: "wafv2:GetIPSet",
+                Resource: [
+                  Fn.getAtt(
+                    props.webACLStack.nestedStackResource!.logicalId,
+                    "Outputs." + WebaclNestedstack.WAFWhitelistSetV4Arn_OUTPUT,
+                  ),
+                  Fn.getAtt(
+                    props.webACLStack.nestedStackResource!.logicalId,
+                    "Outputs." + WebaclNestedstack.WAFWhitelistSetV6Arn_OUTPUT,
+                  ),
+                ],
+              },
+            ],
+          },
+        },
+        Fn.conditionIf(
+          props.ipSetIntentQueueActivated.logicalId,
+          {
+            PolicyName: "IPSetIntentQueueAccess",
+            PolicyDocument: {
+              Statement: [
+                {
+                  Effect: "Allow",
+                  Action: [
+                    "sqs:SendMessage",
+                    "sqs:ReceiveMessage",
+                    "sqs:DeleteMessage",
+                    "sqs:GetQueueAttributes",
+                  ],
+                  Resource: [ipSetIntentQueue.attrArn],
+                },
+              ],
+            },
+          },
+          Aws.NO_VALUE,
+        ),
+        {
+          // Shard IP sets are only used when a rule of the web ACL references them
+          policyName: "WAFGetWebACL",
+          policyDocument: {
+            Statement: [
+              {
+                Effect: "Allow",
+                Action: "wafv2:GetWebACL",
+                Resource: [
+                  Fn.getAtt(
+                    props.webACLStack.nestedStackResource!.logicalId,
+                    "Outputs." + WebaclNestedstack.WAFWebACLArn_OUTPUT,
+                  ),
+                ],
+              },
+            ],
+          },
+        },
         {
           policyName: "LogsAccess",
           policyDocument: {
@@ -562,6 +669,32 @@ export class LogParser extends Construct {
             ).toString(),
             Fn.ref("AWS::NoValue"),
           ).toString(),
+          IP_SET_ID_WHITELISTV4: Fn.getAtt(
+            props.webACLStack.nestedStackResource!.logicalId,
+            "Outputs." + WebaclNestedstack.WAFWhitelistSetV4Arn_OUTPUT,
+          ).toString(),
+          IP_SET_ID_WHITELISTV6: Fn.getAtt(
+            props.webACLStack.nestedStackResource!.logicalId,
+            "Outputs." + WebaclNestedstack.WAFWhitelistSetV6Arn_OUTPUT,
+          ).toString(),
+          IP_SET_NAME_WHITELISTV4: Fn.getAtt(
+            props.webACLStack.nestedStackResource!.logicalId,
+            "Outputs." + WebaclNestedstack.NameWAFWhitelistSetV4_OUTPUT,
+          ).toString(),
+          IP_SET_NAME_WHITELISTV6: Fn.getAtt(
+            props.webACLStack.nestedStackResource!.logicalId,
+            "Outputs." + WebaclNestedstack.NameWAFWhitelistSetV6_OUTPUT,
+          ).toString(),
+          WAF_WEB_ACL_ARN: Fn.getAtt(
+            props.webACLStack.nestedStackResource!.logicalId,
+            "Outputs." + WebaclNestedstack.WAFWebACLArn_OUTPUT,
+          ).toString(),
+          IP_SET_INTENT_QUEUE_URL: Fn.conditionIf(
+            props.ipSetIntentQueueActivated.logicalId,
+            ipSetIntentQueue.ref,
+            Fn.ref("AWS::NoValue"),
+          ).toString(),
+          WAF_LOG_FILTERS: props.param.wafLogFilters.valueAsString,
           WAF_BLOCK_PERIOD: props.param.wafBlockPeriod.valueAsString,
           ERROR_THRESHOLD: props.param.errorThreshold.valueAsString,
           REQUEST_THRESHOLD: props.param.requestThreshold.valueAsString,
@@ -743,6 +876,55 @@ export class LogParser extends Construct {
     lambdaInvokePermissionWafLogParserCloudWatch.cfnOptions.condition =
       props.httpFloodAthenaLogParser;
 
+    const lambdaLogParserExpirySweeper = new CfnRule(
+      this,
+      LogParser.ID_EXPIRY_SWEEPER,
+      {
+        description: "Security Automation - Log parser block expiry sweeper",
+        scheduleExpression: "rate(5 minutes)",
+        targets: [
+          {
+            arn: this.logParserFunction.attrArn,
+            id: LogParser.ID,
+            input: `{"resourceType": "${LogParser.ID_EXPIRY_SWEEPER}"}`,
+          },
+        ],
+      },
+    );
+    lambdaLogParserExpirySweeper.overrideLogicalId(LogParser.ID_EXPIRY_SWEEPER);
+    lambdaLogParserExpirySweeper.cfnOptions.condition = props.logParser;
+
+    const lambdaInvokePermissionLogParserExpirySweeper = new CfnPermission(
+      this,
+      "LambdaInvokePermissionLogParserExpirySweeper",
+      {
+        functionName: this.logParserFunction.ref,
+        action: "lambda:InvokeFunction",
+        principal: "events.amazonaws.com",
+        sourceArn: lambdaLogParserExpirySweeper.attrArn,
+      },
+    );
+    lambdaInvokePermissionLogParserExpirySweeper.overrideLogicalId(
+      "LambdaInvokePermissionLogParserExpirySweeper",
+    );
+    lambdaInvokePermissionLogParserExpirySweeper.cfnOptions.condition =
+      props.logParser;
+
+    const lambdaLogParserIPSetWriter = new CfnEventSourceMapping(
+      this,
+      LogParser.ID_IP_SET_WRITER,
+      {
+        enabled: true,
+        eventSourceArn: ipSetIntentQueue.attrArn,
+        functionName: this.logParserFunction.ref,
+        batchSize: 10,
+        functionResponseTypes: ["ReportBatchItemFailures"],
+      },
+    );
+    lambdaLogParserIPSetWriter.overrideLogicalId(LogParser.ID_IP_SET_WRITER);
+    lambdaLogParserIPSetWriter.cfnOptions.condition =
+      props.ipSetIntentQueueActivated;
+
     const generateWafLogParserConfFile = new CustomResource(
       this,
       LogParser.ID_WAF_CONF,
@@ -92,6 +92,30 @@ export class ReputationList extends Construct {
                     ),
                   ],
                 },
+                {
+                  Effect: "Allow",
+                  Action: "wafv2:GetIPSet",
+                  Resource: [
+                    Fn.getAtt(
+                      props.webACLStack.nestedStackResource!.logicalId,
+                      "Outputs." + WebaclNestedstack.WAFWhitelistSetV4Arn_OUTPUT,
+                    ),
+                    Fn.getAtt(
+                      props.webACLStack.nestedStackResource!.logicalId,
+                      "Outputs." + WebaclNestedstack.WAFWhitelistSetV6Arn_OUTPUT,
+                    ),
+                  ],
+                },
+                {
+                  Effect: "Allow",
+                  Action: "wafv2:GetWebACL",
+                  Resource: [
+                    Fn.getAtt(
+                      props.webACLStack.nestedStackResource!.logicalId,
+                      "Outputs." + WebaclNestedstack.WAFWebACLArn_OUTPUT,
+                    ),
+                  ],
+                },
               ],
             },
           },
@@ -201,6 +225,26 @@ export class ReputationList extends Construct {
               props.webACLStack.nestedStackResource!.logicalId,
               "Outputs." + WebaclNestedstack.NameReputationListsSetV6_OUTPUT,
             ).toString(),
+            IP_SET_ID_WHITELISTV4: Fn.getAtt(
+              props.webACLStack.nestedStackResource!.logicalId,
+              "Outputs." + WebaclNestedstack.WAFWhitelistSetV4Arn_OUTPUT,
+            ).toString(),
+            IP_SET_ID_WHITELISTV6: Fn.getAtt(
+              props.webACLStack.nestedStackResource!.logicalId,
+              "Outputs." + WebaclNestedstack.WAFWhitelistSetV6Arn_OUTPUT,
+            ).toString(),
+            IP_SET_NAME_WHITELISTV4: Fn.getAtt(
+              props.webACLStack.nestedStackResource!.logicalId,
+              "Outputs." + WebaclNestedstack.NameWAFWhitelistSetV4_OUTPUT,
+            ).toString(),
+            IP_SET_NAME_WHITELISTV6: Fn.getAtt(
+              props.webACLStack.nestedStackResource!.logicalId,
+              "Outputs." + WebaclNestedstack.NameWAFWhitelistSetV6_OUTPUT,
+            ).toString(),
+            WAF_WEB_ACL_ARN: Fn.getAtt(
+              props.webACLStack.nestedStackResource!.logicalId,
+              "Outputs." + WebaclNestedstack.WAFWebACLArn_OUTPUT,
+            ).toString(),
             SCOPE: Utils.getRegionScope(props.albEndpoint.logicalId),
             LOG_LEVEL: props.solutionMapping.findInMap("Data", "LogLevel"),
             URL_LIST:
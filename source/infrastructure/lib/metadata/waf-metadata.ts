@@ -100,7 +100,11 @@ export class WafMetadata extends Construct {
           },
           {
             Label: { default: "Advanced Settings" },
-            Parameters: [props.parameters.logGroupRetention.logicalId],
+            Parameters: [
+              props.parameters.logGroupRetention.logicalId,
+              props.parameters.activateIPSetIntentQueue.logicalId,
+              props.parameters.wafLogFilters.logicalId,
+            ],
           },
         ],
 
@@ -217,6 +221,12 @@ export class WafMetadata extends Construct {
           [props.parameters.timeWindowThreshold.logicalId]: {
             default: "Time Window Threshold (Minutes)",
           },
+          [props.parameters.activateIPSetIntentQueue.logicalId]: {
+            default: "Activate IP Set Writer Queue",
+          },
+          [props.parameters.wafLogFilters.logicalId]: {
+            default: "WAF Log Filters",
+          },
         },
       },
     };
@@ -107,4 +107,15 @@ describe("WAF end-to-end", () => {
   test("Outputs match", () => {
     expect(newTemplate.Outputs).toEqual(oldTemplate.Outputs);
   });
+
+  test("WAF log filters reach the logging configuration and the log parser", () => {
+    const wafLogFilters = { Ref: "WAFLogFiltersParam" };
+    expect(
+      newTemplate.Resources.ConfigureAWSWAFLogs.Properties.WafLogFilters,
+    ).toEqual(wafLogFilters);
+    expect(
+      newTemplate.Resources.LogParser.Properties.Environment.Variables
+        .WAF_LOG_FILTERS,
+    ).toEqual(wafLogFilters);
+  });
 });
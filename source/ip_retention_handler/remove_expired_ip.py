@@ -1,13 +1,13 @@
 #  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #  SPDX-License-Identifier: Apache-2.0
 
-from time import sleep
 from os import environ, getenv
 from datetime import datetime, UTC
-from boto3.dynamodb.types import TypeDeserializer
 from lib.waflibv2 import WAFLIBv2
+from lib.ip_util import canonicalize
 from lib.sns_util import SNS
 from lib.solution_metrics import send_metrics
+from lib.stage_metrics import StageTimer
 from aws_lambda_powertools import Logger
 
 logger = Logger(
@@ -16,7 +16,6 @@ logger = Logger(
 
 waflib = WAFLIBv2()
 
-DELAY_BETWEEN_UPDATES = 5
 
 class RemoveExpiredIP(object):
     """
@@ -30,6 +29,7 @@ class RemoveExpiredIP(object):
 
         self.event = event
         self.log = log
+        self.stage_timer = StageTimer(log, 'RemoveExpiredIP')
         self.log.debug(self.__class__.__name__ + " Class Event:\n{}".format(event))
         
     def is_none(self, value):
@@ -57,6 +57,8 @@ class RemoveExpiredIP(object):
         Convert a DynamoDB item to a regular dictionary
         """
         
+        # boto3 is only loaded by the invocations with DynamoDB data to deserialize
+        from boto3.dynamodb.types import TypeDeserializer
         deserializer = TypeDeserializer()
         deserialized_ddb_data = {k: deserializer.deserialize(v) for k, v in ddb_data.items()}
         return deserialized_ddb_data
@@ -88,21 +90,26 @@ class RemoveExpiredIP(object):
         remove_ip_list = []    
         keep_ip_list = []
 
-        log.info('[remove_expired_id: make_ip_list] waf_ip_list:\n'+ str(waf_ip_list))
-        log.info('[remove_expired_id: make_ip_list] ddb_ip_list:\n'+ str(ddb_ip_list))
-        
-        # Get ips that should be removed. They are in both waf_ip_list and ddb_ip_list.
-        remove_ip_list = list(set(waf_ip_list) & set(ddb_ip_list))
-        log.info('[remove_expired_id: make_ip_list] remove_ip_list:\n'+ str(remove_ip_list))
+        log.debug('[remove_expired_id: make_ip_list] waf_ip_list:\n%s', waf_ip_list)
+        log.debug('[remove_expired_id: make_ip_list] ddb_ip_list:\n%s', ddb_ip_list)
+        
+        # Ips in waf_ip_list but not ddb_ip_list are kept, ips in both are removed. The IP set holds
+        # canonical CIDRs: only the expired ips without an exact match are parsed, to their canonical form.
+        expired_ips = set(ddb_ip_list)
+        expired_ips.update([canonicalize(ip) for ip in expired_ips.difference(waf_ip_list)])
+        for ip in waf_ip_list:
+            if ip in expired_ips:
+                remove_ip_list.append(ip)
+            else:
+                keep_ip_list.append(ip)
+        log.debug('[remove_expired_id: make_ip_list] remove_ip_list:\n%s', remove_ip_list)
         
         # If no ips to be removed, return None - no need to update the ip set.
         if len(remove_ip_list) == 0:
             log.info('[remove_expired_id: make_ip_list] No IPs to remove. End')
             return [], []
             
-        # Get ips that should be kept. They are in waf_ip_list but not ddb_ip_list.
-        keep_ip_list = list(set(waf_ip_list) - set(ddb_ip_list))
-        log.info('[remove_expired_id: make_ip_list] keep_ip_list:\n'+ str(keep_ip_list))
+        log.debug('[remove_expired_id: make_ip_list] keep_ip_list:\n%s', keep_ip_list)
 
         log.info('[remove_expired_id: make_ip_list] End')
         
@@ -116,13 +123,11 @@ class RemoveExpiredIP(object):
         
         log.info('[remove_expired_id: update_ip_set] Start')
         
-        response = waflib.update_ip_set_by_id(log, scope, name, ip_set_id, keep_ip_list, lock_token, description)
+        with self.stage_timer.stage('WAFUpdate'):
+            response = waflib.update_ip_set_by_id(log, scope, name, ip_set_id, keep_ip_list, lock_token, description)
         
         log.info("[remove_expired_id: update_ip_set] response \n{}.".format(response))
         
-        # Sleep for a few seconds to mitigate AWS WAF Update API call throttling issue
-        sleep(DELAY_BETWEEN_UPDATES)
-        
         log.info('[remove_expired_id: update_ip_set] End')
         
         return response
@@ -192,6 +197,7 @@ def lambda_handler(event, context):
     Invoke functions to delete expired ips from waf ip set. 
     It is triggered by TTL DynamoDB Stream.
     """
+    reip = None
     try:
         logger.info('[remove_expired_id: lambda_handler] Start')
         logger.info("Lambda Handler Event: \n{}".format(event))
@@ -215,11 +221,15 @@ def lambda_handler(event, context):
             name = reip.is_none(str(desiralized_ddb_ip_set.get('IPSetName')))
             ip_set_id = reip.is_none(str(desiralized_ddb_ip_set.get('IPSetId')))
             ip_retention_period = reip.is_none(str(desiralized_ddb_ip_set.get('IPRetentionPeriodMinute')))
-            waf_ip_set = reip.get_ip_set(logger, scope, name, ip_set_id)
+            with reip.stage_timer.stage('WAFGet'):
+                waf_ip_set = reip.get_ip_set(logger, scope, name, ip_set_id)
             description = reip.is_none(waf_ip_set.get('IPSet',{}).get('Description'))
             waf_ip_list = reip.is_none(waf_ip_set.get('IPSet',{}).get('Addresses',[]))
             ddb_ip_list = reip.is_none(desiralized_ddb_ip_set.get('IPAdressList', []))
-            keep_ip_list, remove_ip_list = reip.make_ip_list(logger, waf_ip_list, ddb_ip_list)
+            with reip.stage_timer.stage('Diff'):
+                keep_ip_list, remove_ip_list = reip.make_ip_list(logger, waf_ip_list, ddb_ip_list)
+            reip.stage_timer.add_value('IPSetSize', len(waf_ip_list))
+            reip.stage_timer.add_value('RemovedIPs', len(remove_ip_list))
             
             # Stop if None - no need to update ip set
             if len(remove_ip_list) == 0:
@@ -232,7 +242,8 @@ def lambda_handler(event, context):
             
             # Send email notification to user if sns email is configured and ip set is successfully updated 
             if (environ.get('SNS_EMAIL').lower() == 'yes' and response.get('ResponseMetadata',{}).get('HTTPStatusCode') == 200):
-                response = reip.send_notification(logger, environ.get('SNS_TOPIC_ARN'), name, ip_set_id, ip_retention_period, context.function_name)
+                with reip.stage_timer.stage('Notify'):
+                    response = reip.send_notification(logger, environ.get('SNS_TOPIC_ARN'), name, ip_set_id, ip_retention_period, context.function_name)
         
             # send anonymized solution metrics
             reip.send_anonymized_usage_data(logger, remove_ip_list, name)
@@ -240,6 +251,9 @@ def lambda_handler(event, context):
     except Exception as error:
         logger.error(str(error))
         raise
+    finally:
+        if reip is not None:
+            reip.stage_timer.publish()
     
     logger.info('[remove_expired_id: lambda_handler] End')
     return response
@@ -133,6 +133,14 @@ def test_make_ip_list_no_removed_ips():
     assert len(remove_ip_list) == 0
 
 
+def test_make_ip_list_canonical_ipv6():
+    waf_ip_list = ['2001:db8::1/128', '2001:db8::2/128']
+    ddb_ip_list = ['2001:DB8:0:0::1/128']
+    keep_ip_list, remove_ip_list = reip.make_ip_list(log, waf_ip_list, ddb_ip_list)
+    assert keep_ip_list == ['2001:db8::2/128']
+    assert remove_ip_list == ['2001:db8::1/128']
+
+
 def test_send_notification(sns_topic):
     topic_arn = str(sns_topic)
     result = False
@@ -12,17 +12,25 @@
 ######################################################################################################################
 #!/bin/python
 
-import boto3
 import logging
+import threading
 from os import environ
-from botocore.config import Config
 
 log = logging.getLogger()
 
+# ('client' | 'resource', service name) -> boto3 client or resource shared by the process,
+# so a warm Lambda container creates each of them once
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
 def create_client(service_name, max_attempt=5, mode='standard', user_agent_extra=environ.get('USER_AGENT_EXTRA'), my_config = {}):
     """
     This function creates a boto3 client given a service and its configurations
     """
+    # boto3 takes a large share of the import time of a function, it is only loaded
+    # by the functions creating a client
+    import boto3
+    from botocore.config import Config
     try:
           config = Config(
                 user_agent_extra=user_agent_extra,
@@ -45,6 +53,8 @@ def create_resource(service_name, max_attempt=5, mode='standard', user_agent_ext
     """
     This function creates a boto3 resource given a service and its configurations
     """
+    import boto3
+    from botocore.config import Config
     try:
           config = Config(
                 user_agent_extra=user_agent_extra,
@@ -60,4 +70,60 @@ def create_resource(service_name, max_attempt=5, mode='standard', user_agent_ext
     except Exception as e:
         log.error("[boto3_util: create_resource] failed to create resource")
         log.error(e)
-        raise e
\ No newline at end of file
+        raise e
+
+
+def get_client(service_name):
+    """
+    This function returns the boto3 client of a service with the default configuration,
+    created on first use and then shared by the process
+    """
+    return get_memoized('client', service_name, create_client)
+
+
+def get_resource(service_name):
+    """
+    This function returns the boto3 resource of a service with the default configuration,
+    created on first use and then shared by the process
+    """
+    return get_memoized('resource', service_name, create_resource)
+
+
+def get_memoized(kind, service_name, factory):
+    key = (kind, service_name)
+    client = CLIENTS.get(key)
+    if client is None:
+        # boto3 sessions are not thread safe, clients are created one at a time
+        with CLIENTS_LOCK:
+            client = CLIENTS.get(key)
+            if client is None:
+                client = CLIENTS[key] = factory(service_name)
+    return client
+
+
+def reset_clients():
+    """
+    This function drops the shared clients and resources, the next use creates them again
+    """
+    with CLIENTS_LOCK:
+        CLIENTS.clear()
+
+
+class LazyClient(object):
+    """
+    This class stands for the shared client (or, with get_resource, resource) of a
+    service in module globals and attributes: the client is only created when one
+    of its attributes is first used.
+    """
+
+    def __init__(self, service_name, factory=get_client):
+        self.service_name = service_name
+        self.factory = factory
+
+    def __getattr__(self, name):
+        if name in ('service_name', 'factory') or name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.factory(self.service_name), name)
+
+    def __repr__(self):
+        return "LazyClient(%s)" % self.service_name
@@ -0,0 +1,120 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Longest prefix match index of CIDRs, used to keep allowlisted addresses out of
+the IP sets the solution blocks with.
+
+CIDRIndex is a binary radix tree per IP version: a CIDR is a path of prefix
+length bits from the root, so a lookup walks at most 32 (IPv4) or 128 (IPv6)
+nodes whatever the number of CIDRs. The allowlist index is built from the
+Whitelist IP sets and kept by warm containers for ALLOWLIST_CACHE_TTL seconds.
+"""
+
+from os import getenv
+from time import time
+from lib.ip_util import parse_address, format_cidr, MAX_PREFIX_LENGTH
+
+DEFAULT_ALLOWLIST_CACHE_TTL = 300
+
+# (scope, IP set arns) -> (loaded at, CIDRIndex)
+ALLOWLIST_INDEXES = {}
+
+# Node slots: child for bit 0, child for bit 1, prefix length of the CIDR ending at the node
+ZERO, ONE, TERMINAL = 0, 1, 2
+
+
+class CIDRIndex(object):
+    def __init__(self, addresses=()):
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.count = 0
+        for address in addresses:
+            self.add(address)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, address):
+        """
+        Index an IP or CIDR, False when it is not one
+        """
+        parsed = parse_address(address)
+        if parsed is None:
+            return False
+        version, value, prefix_length = parsed
+        max_prefix_length = MAX_PREFIX_LENGTH[version]
+        node = self.roots[version]
+        for depth in range(prefix_length):
+            bit = (value >> (max_prefix_length - 1 - depth)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[TERMINAL] is None:
+            node[TERMINAL] = prefix_length
+            self.count += 1
+        return True
+
+    def lookup(self, address):
+        """
+        Longest indexed CIDR containing the whole address (an IP or CIDR), None when there is none
+        """
+        parsed = parse_address(address)
+        if parsed is None:
+            return None
+        version, value, prefix_length = parsed
+        max_prefix_length = MAX_PREFIX_LENGTH[version]
+        node = self.roots[version]
+        match = node[TERMINAL]
+        for depth in range(prefix_length):
+            node = node[(value >> (max_prefix_length - 1 - depth)) & 1]
+            if node is None:
+                break
+            if node[TERMINAL] is not None:
+                match = node[TERMINAL]
+        if match is None:
+            return None
+        return format_cidr((version, value >> (max_prefix_length - match) << (max_prefix_length - match), match))
+
+    def covers(self, address):
+        return self.count > 0 and self.lookup(address) is not None
+
+
+def get_allowlist_ip_sets():
+    """
+    (name, arn) of the Whitelist IP sets configured for the function
+    """
+    return [(getenv('IP_SET_NAME_WHITELIST' + version), getenv('IP_SET_ID_WHITELIST' + version))
+            for version in ('V4', 'V6') if getenv('IP_SET_ID_WHITELIST' + version)]
+
+
+def get_allowlist_index(log, scope, waflib, now=None):
+    """
+    CIDRIndex of the Whitelist IP sets, empty when none is configured. A set that
+    cannot be read is skipped and the index is not cached, so it is read again
+    on the next invocation.
+    """
+    ip_sets = get_allowlist_ip_sets()
+    if not ip_sets:
+        return CIDRIndex()
+
+    now = time() if now is None else now
+    key = (scope, tuple(arn for _, arn in ip_sets))
+    cached = ALLOWLIST_INDEXES.get(key)
+    if cached and now - cached[0] < int(getenv('ALLOWLIST_CACHE_TTL', DEFAULT_ALLOWLIST_CACHE_TTL)):
+        return cached[1]
+
+    index = CIDRIndex()
+    complete = True
+    for name, arn in ip_sets:
+        response = waflib.get_ip_set(log, scope, name, arn)
+        if not response:
+            log.error("[cidr_index: get_allowlist_index] Failed to read allowlist IPSet %s" % str(name))
+            complete = False
+            continue
+        for address in response['IPSet']['Addresses']:
+            index.add(address)
+
+    if complete:
+        ALLOWLIST_INDEXES[key] = (now, index)
+    log.info("[cidr_index: get_allowlist_index] %d allowlisted CIDRs" % len(index))
+    return index
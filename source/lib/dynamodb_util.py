@@ -13,9 +13,9 @@
 
 # !/bin/python
 
-from lib.boto3_util import create_resource
+from lib.boto3_util import get_resource, LazyClient
 
-dynamodb_resource = create_resource('dynamodb')
+dynamodb_resource = LazyClient('dynamodb', get_resource)
 
 class DDB(object):
     def __init__(self, log, table_name):
@@ -0,0 +1,267 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+IP address handling shared by the handlers. An address or CIDR is parsed once
+into a compact (version, network int, prefix length) tuple, memoized with an
+LRU cache, and formatted back in canonical CIDR form (host bits cleared, IPv6
+compressed and lowercase), so equivalent spellings compare equal. Plain
+addresses and numeric prefixes are parsed as a single address, much cheaper
+than ip_network; host bits are cleared unless the parsing is strict, as for feed
+entries where '1.2.3.4/24' is rejected rather than widened.
+
+Single addresses, as the log parsers and the IP sets hold most of the time, skip
+the parser and its cache: an IPv4 address is only validated with inet_pton and
+suffixed with /32, an IPv6 address is compressed with inet_pton and inet_ntop and
+suffixed with /128. Anything they reject goes through the parser.
+
+AddressSet keeps addresses as sorted integer keys: IPv4 keys in an array, IPv6
+keys (wider than 64 bits) in a list. Union and difference are linear merges of
+the sorted keys. Entries that are not IPs are kept verbatim in their own sorted
+list so that nothing is silently dropped.
+"""
+
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+from ipaddress import ip_network, IPv4Address, IPv6Address
+from socket import inet_pton, inet_ntop, AF_INET, AF_INET6
+
+PARSE_CACHE_SIZE = 65536
+
+MAX_PREFIX_LENGTH = {4: 32, 6: 128}
+IP_VERSION_NAMES = {4: 'IPV4', 6: 'IPV6'}
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_address(address, strict=False):
+    """
+    (version, network int, prefix length) of an IP or CIDR, None when it is not one,
+    or when strict and the CIDR has host bits set
+    """
+    try:
+        address = address.strip()
+        ip, slash, prefix = address.partition('/')
+        if slash and not (prefix.isascii() and prefix.isdigit()):
+            # Netmask notation, left to ip_network
+            network = ip_network(address, strict=strict)
+            return network.version, int(network.network_address), network.prefixlen
+        parsed_ip = IPv6Address(ip) if ':' in ip else IPv4Address(ip)
+    except (ValueError, TypeError, AttributeError):
+        return None
+    max_prefix_length = parsed_ip.max_prefixlen
+    if not slash:
+        return parsed_ip.version, int(parsed_ip), max_prefix_length
+    prefix_length = int(prefix)
+    if prefix_length > max_prefix_length:
+        return None
+    value = int(parsed_ip)
+    host_mask = (1 << (max_prefix_length - prefix_length)) - 1
+    if value & host_mask:
+        if strict:
+            return None
+        value &= ~host_mask
+    return parsed_ip.version, value, prefix_length
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def format_cidr(parsed):
+    version, value, prefix_length = parsed
+    if version == 4:
+        return '%d.%d.%d.%d/%d' % (value >> 24, value >> 16 & 0xff, value >> 8 & 0xff, value & 0xff,
+                                   prefix_length)
+    return '%s/%d' % (IPv6Address(value), prefix_length)
+
+
+def range_to_cidrs(version, start, end):
+    """
+    (version, network int, prefix length) of the minimal CIDRs covering the addresses start..end
+    """
+    max_prefix_length = MAX_PREFIX_LENGTH[version]
+    cidrs = []
+    while start <= end:
+        # Largest block aligned on start that does not go past end
+        size = start & -start if start else 1 << max_prefix_length
+        while size > end - start + 1:
+            size >>= 1
+        cidrs.append((version, start, max_prefix_length - size.bit_length() + 1))
+        start += size
+    return cidrs
+
+
+def is_ipv4_address(ip):
+    """
+    True when ip is a dotted-quad IPv4 address, with no prefix nor surrounding spaces
+    """
+    try:
+        inet_pton(AF_INET, ip)
+    except (OSError, ValueError, TypeError):
+        return False
+    return True
+
+
+def compress_ipv6_address(ip):
+    """
+    Compressed form of an IPv6 address with no prefix, as ipaddress formats it. None when inet_pton
+    rejects it (scope ids among others) or when inet_ntop writes it with an embedded IPv4 address
+    """
+    try:
+        compressed = inet_ntop(AF_INET6, inet_pton(AF_INET6, ip))
+    except (OSError, ValueError, TypeError):
+        return None
+    return compressed if '.' not in compressed else None
+
+
+def get_cidr(address):
+    """
+    Canonical CIDR of an IP or CIDR, None when it is not one
+    """
+    try:
+        ip, slash, prefix = address.strip().partition('/')
+    except AttributeError:
+        return None
+    if ':' not in ip:
+        if (not slash or prefix == '32') and is_ipv4_address(ip):
+            return ip + '/32'
+    elif not slash or prefix == '128':
+        compressed = compress_ipv6_address(ip)
+        if compressed is not None:
+            return compressed + '/128'
+    parsed = parse_address(address)
+    return format_cidr(parsed) if parsed is not None else None
+
+
+def canonicalize(address):
+    """
+    Canonical CIDR of an address, the address itself when it is not an IP
+    """
+    cidr = get_cidr(address)
+    return cidr if cidr is not None else address
+
+
+def get_ip_version(address):
+    """
+    'IPV4' or 'IPV6', None when the address is not an IP
+    """
+    try:
+        ip = address.strip()
+    except AttributeError:
+        return None
+    if '/' not in ip:
+        if ':' not in ip:
+            if is_ipv4_address(ip):
+                return 'IPV4'
+        elif compress_ipv6_address(ip) is not None:
+            return 'IPV6'
+    parsed = parse_address(ip)
+    return IP_VERSION_NAMES[parsed[0]] if parsed is not None else None
+
+
+def to_key(parsed):
+    _, value, prefix_length = parsed
+    return value << 8 | prefix_length
+
+
+def from_key(key, version):
+    return version, key >> 8, key & 0xff
+
+
+def merge_union(left, right):
+    merged = []
+    i, j = 0, 0
+    while i < len(left) and j < len(right):
+        if left[i] < right[j]:
+            merged.append(left[i])
+            i += 1
+        elif right[j] < left[i]:
+            merged.append(right[j])
+            j += 1
+        else:
+            merged.append(left[i])
+            i += 1
+            j += 1
+    merged.extend(left[i:])
+    merged.extend(right[j:])
+    return merged
+
+
+def merge_difference(left, right):
+    kept = []
+    j = 0
+    for key in left:
+        while j < len(right) and right[j] < key:
+            j += 1
+        if j == len(right) or right[j] != key:
+            kept.append(key)
+    return kept
+
+
+def contains(keys, key):
+    index = bisect_left(keys, key)
+    return index < len(keys) and keys[index] == key
+
+
+class AddressSet(object):
+    """
+    Sorted set of canonical addresses
+    """
+
+    def __init__(self, addresses=(), strict=False):
+        keys_v4 = set()
+        keys_v6 = set()
+        others = set()
+        for address in addresses:
+            parsed = parse_address(address, strict)
+            if parsed is None:
+                others.add(address)
+            elif parsed[0] == 4:
+                keys_v4.add(to_key(parsed))
+            else:
+                keys_v6.add(to_key(parsed))
+        self.keys_v4 = array('Q', sorted(keys_v4))
+        self.keys_v6 = sorted(keys_v6)
+        self.others = sorted(others)
+
+    @classmethod
+    def from_sorted(cls, keys_v4, keys_v6, others):
+        address_set = cls()
+        address_set.keys_v4 = array('Q', keys_v4)
+        address_set.keys_v6 = list(keys_v6)
+        address_set.others = list(others)
+        return address_set
+
+    def __len__(self):
+        return len(self.keys_v4) + len(self.keys_v6) + len(self.others)
+
+    def __iter__(self):
+        for key in self.keys_v4:
+            yield format_cidr(from_key(key, 4))
+        for key in self.keys_v6:
+            yield format_cidr(from_key(key, 6))
+        yield from self.others
+
+    def __contains__(self, address):
+        parsed = parse_address(address)
+        if parsed is None:
+            return contains(self.others, address)
+        return contains(self.keys_v4 if parsed[0] == 4 else self.keys_v6, to_key(parsed))
+
+    def union(self, other):
+        return AddressSet.from_sorted(merge_union(self.keys_v4, other.keys_v4),
+                                      merge_union(self.keys_v6, other.keys_v6),
+                                      merge_union(self.others, other.others))
+
+    def difference(self, other):
+        return AddressSet.from_sorted(merge_difference(self.keys_v4, other.keys_v4),
+                                      merge_difference(self.keys_v6, other.keys_v6),
+                                      merge_difference(self.others, other.others))
+
+    def get_addresses(self, version=None):
+        """
+        Canonical CIDRs of one IP version ('IPV4' or 'IPV6'), or every entry when version is None
+        """
+        if version == 'IPV4':
+            return [format_cidr(from_key(key, 4)) for key in self.keys_v4]
+        if version == 'IPV6':
+            return [format_cidr(from_key(key, 6)) for key in self.keys_v6]
+        return list(self)
@@ -0,0 +1,141 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import sys
+import resource
+import tracemalloc
+from os import getenv
+
+DEFAULT_TOP_ALLOCATIONS = 10
+DEFAULT_TRACEBACK_FRAMES = 1
+
+# Allocations made by the profiler itself are not interesting
+IGNORED_TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def is_memory_profiling_enabled():
+    return getenv('MEMORY_PROFILING_ENABLED', 'false').lower() == 'true'
+
+
+def get_peak_rss_bytes():
+    """
+    Peak resident set size of the current process. ru_maxrss is reported in
+    kilobytes on Linux (the Lambda runtime) and in bytes on macOS.
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def deep_getsizeof(obj):
+    """
+    Approximate number of bytes retained by a container of builtin types
+    (dict, list, tuple, set, str, numbers). Shared objects are counted once.
+    """
+    seen = set()
+    pending = [obj]
+    size = 0
+    while pending:
+        current = pending.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            pending.extend(current.keys())
+            pending.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            pending.extend(current)
+    return size
+
+
+def count_entries(obj):
+    """
+    Number of leaf entries of a counter or outstanding requesters dict
+    ({'general': {...}, 'uriList': {uri: {...}}}), or len() of anything else.
+    """
+    if isinstance(obj, dict) and 'general' in obj and 'uriList' in obj:
+        return len(obj['general']) + sum(len(v) for v in obj['uriList'].values())
+    try:
+        return len(obj)
+    except TypeError:
+        return None
+
+
+class MemoryProfiler(object):
+    """
+    This class takes tracemalloc snapshots at pipeline stage boundaries and logs,
+    as one structured record per stage, the peak RSS, the traced memory peak of
+    the stage, the top allocation sites grown since the previous stage and the
+    size of the tracked data structures (e.g. counter and outstanding_requesters).
+
+    Profiling is opt-in (MEMORY_PROFILING_ENABLED=true) because tracemalloc
+    slows down allocation heavy code such as log parsing considerably.
+    """
+
+    def __init__(self, log, pipeline):
+        self.log = log
+        self.pipeline = pipeline
+        self.enabled = is_memory_profiling_enabled()
+        self.top_allocations = int(getenv('MEMORY_PROFILING_TOP_ALLOCATIONS', DEFAULT_TOP_ALLOCATIONS))
+        self.tracked = {}
+        self.previous_snapshot = None
+
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start(int(getenv('MEMORY_PROFILING_FRAMES', DEFAULT_TRACEBACK_FRAMES)))
+
+    def track(self, **objects):
+        """
+        Register data structures whose size is reported at every following snapshot
+        """
+        if self.enabled:
+            self.tracked.update(objects)
+
+    def snapshot(self, stage):
+        if not self.enabled:
+            return None
+
+        try:
+            traced_current, traced_peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED_TRACE_FILTERS)
+            if self.previous_snapshot is None:
+                statistics = snapshot.statistics('lineno')
+            else:
+                statistics = snapshot.compare_to(self.previous_snapshot, 'lineno')
+
+            report = {
+                'memory_profile': {
+                    'pipeline': self.pipeline,
+                    'stage': stage,
+                    'peak_rss_bytes': get_peak_rss_bytes(),
+                    'traced_peak_bytes': traced_peak,
+                    'traced_current_bytes': traced_current,
+                    'top_allocations': [
+                        {
+                            'site': str(stat.traceback),
+                            'size_bytes': stat.size,
+                            'size_diff_bytes': getattr(stat, 'size_diff', stat.size),
+                            'count': stat.count
+                        } for stat in statistics[:self.top_allocations]
+                    ],
+                    'tracked': {
+                        name: {
+                            'entries': count_entries(obj),
+                            'size_bytes': deep_getsizeof(obj)
+                        } for name, obj in self.tracked.items()
+                    }
+                }
+            }
+            self.log.info(report)
+
+            self.previous_snapshot = snapshot
+            tracemalloc.reset_peak()
+            return report
+        except Exception as e:
+            self.log.error("[memory_profiler: snapshot] Failed to profile %s stage %s." % (self.pipeline, stage))
+            self.log.error(str(e))
+            return None
@@ -13,13 +13,27 @@
 #!/bin/python
 
 import json
-from lib.boto3_util import create_client, create_resource
+from lib.boto3_util import get_client, get_resource, LazyClient
+
+PRECONDITION_ERROR_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409')
+
+
+def is_precondition_error(error):
+    """
+    True when a conditional S3 request failed because the object changed
+    """
+    # botocore is only imported once a request failed, keeping it off the import path
+    from botocore.exceptions import ClientError
+    return isinstance(error, ClientError) and \
+        str(error.response.get('Error', {}).get('Code')) in PRECONDITION_ERROR_CODES
+
 
 class S3(object):
     def __init__(self, log):
         self.log = log
-        self.s3_client = create_client('s3')
-        self.s3_resource = create_resource('s3')
+        # Most paths use only one of them, each is created on first use
+        self.s3_client = LazyClient('s3', get_client)
+        self.s3_resource = LazyClient('s3', get_resource)
 
     def read_json_config_file_from_s3(self, bucket_name, key_name):
         try:
@@ -52,6 +66,60 @@ class S3(object):
             self.log.error(e)
             raise e
         
+    def read_object(self, bucket_name, key_name):
+        """
+        Read an object in memory and return its body and ETag
+        """
+        try:
+            response = self.s3_client.get_object(Bucket=bucket_name, Key=key_name)
+            return response['Body'].read(), response.get('ETag')
+        except Exception as e:
+            self.log.error("[s3_util: read_object] Error to read file %s from bucket %s."
+                           %(key_name, bucket_name))
+            self.log.error(e)
+            raise e
+
+    def put_object_body(self, bucket_name, key_name, body, content_type="application/octet-stream",
+                        if_match=None, if_none_match=None):
+        """
+        Write an object from memory. if_match (an ETag) and if_none_match ('*') make
+        the write conditional: S3 then rejects it with PreconditionFailed or
+        ConditionalRequestConflict when the object changed in the meantime.
+        """
+        conditions = {}
+        if if_match:
+            conditions['IfMatch'] = if_match
+        if if_none_match:
+            conditions['IfNoneMatch'] = if_none_match
+        try:
+            return self.s3_client.put_object(Bucket=bucket_name, Key=key_name, Body=body,
+                                             ContentType=content_type, **conditions)
+        except Exception as e:
+            if is_precondition_error(e):
+                self.log.info("[s3_util: put_object_body] Conditional write of file %s to bucket %s rejected."
+                              %(key_name, bucket_name))
+            else:
+                self.log.error("[s3_util: put_object_body] Error to write file %s to bucket %s."
+                               %(key_name, bucket_name))
+                self.log.error(e)
+            raise e
+
+    def list_objects(self, bucket_name, prefix):
+        """
+        Objects under a prefix by key, each with its ETag, LastModified and Size
+        """
+        try:
+            objects = {}
+            for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    objects[obj['Key']] = obj
+            return objects
+        except Exception as e:
+            self.log.error("[s3_util: list_objects] Error to list files %s* in bucket %s."
+                           %(prefix, bucket_name))
+            self.log.error(e)
+            raise e
+
     def get_head_object(self, bucket_name, key_name):
         try:
             response = self.s3_client.head_object(Bucket=bucket_name, Key=key_name)
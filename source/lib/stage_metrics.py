@@ -0,0 +1,225 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import io
+from os import getenv
+from time import perf_counter, time
+from datetime import datetime
+from contextlib import contextmanager
+from aws_lambda_powertools.metrics import EphemeralMetrics, MetricUnit
+from lib.memory_profiler import MemoryProfiler, get_peak_rss_bytes
+
+DEFAULT_NAMESPACE = 'SecurityAutomationsForAWSWAF'
+
+
+def is_stage_metrics_enabled():
+    return getenv('STAGE_METRICS_ENABLED', 'true').lower() == 'true'
+
+
+class StageTimer(object):
+    """
+    This class collects per-stage durations and throughput counters for one unit
+    of work (a log file, an Athena result, a reputation list refresh...) and
+    publishes them as a single CloudWatch Embedded Metric Format (EMF) record.
+
+    Timers only call perf_counter at stage boundaries, so they are cheap enough
+    to stay enabled by default. Set STAGE_METRICS_ENABLED=false to turn them off.
+
+    Stage boundaries are also the checkpoints of the opt-in MemoryProfiler.
+    """
+
+    def __init__(self, log, pipeline):
+        self.log = log
+        self.pipeline = pipeline
+        self.enabled = is_stage_metrics_enabled()
+        self.durations = {}
+        self.values = {}
+        self.started_at = perf_counter()
+        self.memory_profiler = MemoryProfiler(log, pipeline)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block and add the elapsed milliseconds to stage `name`.
+        Repeated stages (e.g. one WAF update per IP set) are accumulated.
+        """
+        start = perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_duration(name, (perf_counter() - start) * 1000)
+            self.checkpoint(name)
+
+    def checkpoint(self, name):
+        """
+        Mark the end of stage `name` for stages timed without stage()
+        """
+        self.memory_profiler.snapshot(name)
+
+    def track(self, **objects):
+        """
+        Report the size of the given data structures at memory profiling checkpoints
+        """
+        self.memory_profiler.track(**objects)
+
+    def add_duration(self, name, milliseconds):
+        self.durations[name] = self.durations.get(name, 0.0) + milliseconds
+
+    def get_duration(self, name):
+        return self.durations.get(name, 0.0)
+
+    def add_value(self, name, value, unit=MetricUnit.Count):
+        """
+        Add `value` to the metric `name`. Values for the same name are summed.
+        """
+        previous = self.values.get(name, (unit, 0))[1]
+        self.values[name] = (unit, previous + value)
+
+    def set_value(self, name, value, unit=MetricUnit.Count):
+        self.values[name] = (unit, value)
+
+    def get_value(self, name):
+        return self.values.get(name, (None, 0))[1]
+
+    def add_rate(self, name, amount, stage):
+        """
+        Record `amount` per second of time spent in `stage`, e.g. lines per second
+        of the parse stage.
+        """
+        milliseconds = self.get_duration(stage)
+        if milliseconds > 0:
+            self.set_value(name, amount / (milliseconds / 1000), MetricUnit.CountPerSecond)
+
+    def publish(self, **dimensions):
+        """
+        Emit the collected metrics as one EMF record on stdout and reset the timer.
+        Any failure is logged and swallowed: metrics must never break the pipeline.
+        """
+        if not self.enabled or (not self.durations and not self.values):
+            return
+
+        try:
+            metrics = EphemeralMetrics(
+                namespace=getenv('POWERTOOLS_METRICS_NAMESPACE', DEFAULT_NAMESPACE))
+            metrics.add_dimension(name='Pipeline', value=self.pipeline)
+            for dimension_name, dimension_value in dimensions.items():
+                metrics.add_dimension(name=dimension_name, value=str(dimension_value))
+
+            for stage_name, milliseconds in self.durations.items():
+                metrics.add_metric(name=stage_name + 'Duration',
+                                   unit=MetricUnit.Milliseconds, value=round(milliseconds, 3))
+            metrics.add_metric(name='TotalDuration', unit=MetricUnit.Milliseconds,
+                               value=round((perf_counter() - self.started_at) * 1000, 3))
+
+            for metric_name, (unit, value) in self.values.items():
+                metrics.add_metric(name=metric_name, unit=unit, value=value)
+
+            if self.memory_profiler.enabled:
+                metrics.add_metric(name='PeakRSS', unit=MetricUnit.Bytes, value=get_peak_rss_bytes())
+
+            metrics.flush_metrics()
+        except Exception as e:
+            self.log.error("[stage_metrics: publish] Failed to publish %s stage metrics." % self.pipeline)
+            self.log.error(str(e))
+        finally:
+            self.reset()
+
+    def reset(self):
+        self.durations = {}
+        self.values = {}
+        self.started_at = perf_counter()
+
+
+def record_ip_set_sync(stage_timer, result, ip_version):
+    """
+    Count the outcome of a (sharded) IP set sync of one IP version ('V4' or 'V6')
+    """
+    stage_timer.add_value('IPSetAdded' + ip_version, result['Added'])
+    stage_timer.add_value('IPSetRemoved' + ip_version, result['Removed'])
+    stage_timer.add_value('IPSetShardOverflow', result.get('Truncated', 0))
+    if result.get('Error'):
+        stage_timer.add_value('IPSetUpdateErrors', 1)
+    elif not result['Updated']:
+        stage_timer.add_value('IPSetWritesSkipped', 1)
+
+
+class DetectionLatency(object):
+    """
+    This class records the timestamps (epoch seconds) needed to measure how long it
+    takes from an abusive request to the IP being blocked, split into stages:
+
+        newest log record -> S3 object event      Delivery
+        S3 object event   -> processing start     Queue
+        processing start  -> WAF update start     Processing
+        WAF update start  -> WAF update completed API
+
+    Unknown timestamps (e.g. no log record time for Athena results) simply drop
+    the stages that depend on them.
+    """
+
+    def __init__(self):
+        self.newest_record_at = None
+        self.event_at = None
+        self.processing_started_at = time()
+        self.api_started_at = None
+        self.api_completed_at = None
+
+    def set_event_time(self, event_time):
+        """
+        Set the S3 event time from the ISO 8601 eventTime field of an S3 event record
+        """
+        if event_time:
+            try:
+                self.event_at = datetime.fromisoformat(event_time.replace('Z', '+00:00')).timestamp()
+            except (AttributeError, ValueError):
+                self.event_at = None
+
+    def api_started(self):
+        if self.api_started_at is None:
+            self.api_started_at = time()
+
+    def api_completed(self):
+        self.api_completed_at = time()
+
+    def record(self, stage_timer):
+        """
+        Add the latency of every measurable stage to `stage_timer` in milliseconds
+        """
+        stages = (
+            ('DeliveryLatency', self.newest_record_at, self.event_at),
+            ('QueueLatency', self.event_at, self.processing_started_at),
+            ('ProcessingLatency', self.processing_started_at, self.api_started_at),
+            ('APILatency', self.api_started_at, self.api_completed_at),
+            ('DetectionLatency', self.newest_record_at, self.api_completed_at),
+        )
+        for name, started_at, completed_at in stages:
+            if started_at is not None and completed_at is not None:
+                stage_timer.set_value(name, round(max(completed_at - started_at, 0) * 1000, 3),
+                                      MetricUnit.Milliseconds)
+
+
+class TimedReader(io.RawIOBase):
+    """
+    Raw stream wrapper that accounts the time and bytes spent reading from an
+    inner stream (e.g. a GzipFile) to a StageTimer stage. Wrap it in an
+    io.BufferedReader so the timer is hit once per buffer refill, not per line.
+    """
+
+    def __init__(self, stream, stage_timer, stage_name, bytes_metric_name):
+        self.stream = stream
+        self.stage_timer = stage_timer
+        self.stage_name = stage_name
+        self.bytes_metric_name = bytes_metric_name
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        start = perf_counter()
+        data = self.stream.read(len(buffer))
+        self.stage_timer.add_duration(self.stage_name, (perf_counter() - start) * 1000)
+
+        size = len(data)
+        buffer[:size] = data
+        self.stage_timer.add_value(self.bytes_metric_name, size, MetricUnit.Bytes)
+        return size
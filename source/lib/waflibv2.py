@@ -12,20 +12,421 @@
 ######################################################################################################################
 # import boto3
 # from botocore.config import Config
+import os
+import json
+import time
+import zlib
+import heapq
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
-from ipaddress import ip_address
 from backoff import on_exception, expo, full_jitter
-from lib.boto3_util import create_client
+from lib.boto3_util import get_client, LazyClient
+from lib.ip_util import parse_address, format_cidr, canonicalize, get_cidr, get_ip_version, range_to_cidrs, AddressSet, \
+    MAX_PREFIX_LENGTH
 
 API_CALL_NUM_RETRIES = 5
 MAX_TIME = 20
 
-client = create_client('wafv2')
+# Created on first use: importing the module costs no client
+client = LazyClient('wafv2')
+
+DEFAULT_WAF_API_RATE = 2
+DEFAULT_WAF_API_BURST = 4
+DEFAULT_WAF_API_MIN_RATE = 0.2
+DEFAULT_WAF_API_MAX_RATE = 5
+DEFAULT_WAF_RATE_LIMIT_KEY = 'wafv2'
+DEFAULT_WAF_UPDATE_WORKERS = 2
+# Tolerance on refilled tokens, so that rounding never asks for a vanishing wait
+TOKEN_EPSILON = 1e-9
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'Throttling', 'TooManyRequestsException',
+                          'WAFLimitsExceededException')
+OPTIMISTIC_LOCK_ERROR_CODES = ('WAFOptimisticLockException', 'OptimisticLockException')
+DEFAULT_IP_SET_CACHE_TTL = 300
+LOGGING_FILTER_BEHAVIORS = ('KEEP', 'DROP')
+LOGGING_FILTER_REQUIREMENTS = ('MEETS_ALL', 'MEETS_ANY')
+LOGGING_FILTER_ACTIONS = ('ALLOW', 'BLOCK', 'COUNT', 'CAPTCHA', 'CHALLENGE', 'EXCLUDED_AS_COUNT')
+
+log = logging.getLogger()
+
+rate_limiter = None
+
+# (scope, web acl arn) -> {'Arns', 'LoadedAt'}, the IPSets referenced by the rules of the web ACL
+WEB_ACL_IP_SETS = {}
+
+# (scope, ip set id) -> {'LockToken', 'Description', 'Addresses', 'Digest', 'LoadedAt'}, kept by warm containers
+IP_SET_SNAPSHOTS = {}
+
+
+class TokenBucket(object):
+    """
+    In-memory token bucket: `rate` tokens per second, up to `capacity` tokens
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+
+    def reserve(self):
+        """
+        Take a token and return 0, or return the seconds to wait for the next one
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1 - TOKEN_EPSILON:
+                self.tokens = max(0, self.tokens - 1)
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class InMemoryBucketStore(object):
+    """
+    Stand-in for DynamoDBBucketStore, shared by the buckets of one process
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def put(self, key, tokens, updated_at, expected_updated_at):
+        with self.lock:
+            current = self.items.get(key)
+            if (current[1] if current else None) != expected_updated_at:
+                return False
+            self.items[key] = (tokens, updated_at)
+            return True
+
+
+class DynamoDBBucketStore(object):
+    """
+    Bucket state shared by every function of the stack, one item (bucket_key,
+    tokens, updated_at) per bucket. Writes are conditional on the updated_at
+    that was read, so concurrent functions never take the same token.
+    """
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.client = get_client('dynamodb')
+
+    def get(self, key):
+        response = self.client.get_item(TableName=self.table_name, Key={'bucket_key': {'S': key}},
+                                        ConsistentRead=True)
+        item = response.get('Item')
+        if not item:
+            return None
+        return float(item['tokens']['N']), item['updated_at']['N']
+
+    def put(self, key, tokens, updated_at, expected_updated_at):
+        conditions = {'ConditionExpression': 'attribute_not_exists(bucket_key)'} if expected_updated_at is None else {
+            'ConditionExpression': 'updated_at = :expected',
+            'ExpressionAttributeValues': {':expected': {'N': expected_updated_at}}
+        }
+        try:
+            self.client.put_item(TableName=self.table_name,
+                                 Item={'bucket_key': {'S': key}, 'tokens': {'N': repr(tokens)},
+                                       'updated_at': {'N': updated_at}},
+                                 **conditions)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+
+class SharedTokenBucket(object):
+    """
+    Token bucket kept in a store (DynamoDBBucketStore or InMemoryBucketStore)
+    """
+
+    def __init__(self, store, key, rate, capacity, clock=time.time):
+        self.store = store
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+
+    def set_rate(self, rate):
+        self.rate = rate
+
+    def reserve(self):
+        item = self.store.get(self.key)
+        now = self.clock()
+        if item is None:
+            tokens, expected_updated_at = self.capacity, None
+        else:
+            tokens = min(self.capacity, item[0] + max(0, now - float(item[1])) * self.rate)
+            expected_updated_at = item[1]
+        if tokens < 1 - TOKEN_EPSILON:
+            return (1 - tokens) / self.rate
+        if self.store.put(self.key, max(0, tokens - 1), repr(now), expected_updated_at):
+            return 0
+        # Another function took a token meanwhile, read the bucket again
+        return 1 / (self.capacity * self.rate)
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Paces WAF API calls with a token bucket. The rate is halved when WAF throttles
+    a call and grows back by `increase` per successful call, between min_rate and max_rate.
+    """
+
+    def __init__(self, bucket, min_rate, max_rate, increase=0.1, sleep=time.sleep):
+        self.bucket = bucket
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.sleep = sleep
+        self.waited = 0
+
+    def acquire(self):
+        wait = self.bucket.reserve()
+        while wait > 0:
+            self.sleep(wait)
+            self.waited += wait
+            wait = self.bucket.reserve()
+
+    def on_throttle(self):
+        self.bucket.set_rate(max(self.min_rate, self.bucket.rate / 2))
+
+    def on_success(self):
+        if self.bucket.rate < self.max_rate:
+            self.bucket.set_rate(min(self.max_rate, self.bucket.rate + self.increase))
+
+
+def create_rate_limiter():
+    """
+    Rate limiter of the WAF API calls of this container, None when WAF_API_RATE is 0.
+    The bucket is shared by every function through the WAF_RATE_LIMIT_TABLE DynamoDB
+    table when it is set, and local to the container otherwise.
+    """
+    rate = float(os.getenv('WAF_API_RATE', DEFAULT_WAF_API_RATE))
+    if rate <= 0:
+        return None
+    burst = float(os.getenv('WAF_API_BURST', DEFAULT_WAF_API_BURST))
+    table_name = os.getenv('WAF_RATE_LIMIT_TABLE')
+    if table_name:
+        bucket = SharedTokenBucket(DynamoDBBucketStore(table_name),
+                                   os.getenv('WAF_RATE_LIMIT_KEY', DEFAULT_WAF_RATE_LIMIT_KEY), rate, burst)
+    else:
+        bucket = TokenBucket(rate, burst)
+    return AdaptiveRateLimiter(bucket,
+                               min(rate, float(os.getenv('WAF_API_MIN_RATE', DEFAULT_WAF_API_MIN_RATE))),
+                               max(rate, float(os.getenv('WAF_API_MAX_RATE', DEFAULT_WAF_API_MAX_RATE))))
+
+
+def get_rate_limiter():
+    global rate_limiter
+    if rate_limiter is None:
+        rate_limiter = create_rate_limiter() or False
+    return rate_limiter or None
+
+
+def call_waf(operation, **kwargs):
+    """
+    WAF API call paced by the rate limiter
+    """
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return getattr(client, operation)(**kwargs)
+
+    limiter.acquire()
+    try:
+        response = getattr(client, operation)(**kwargs)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            limiter.on_throttle()
+        raise
+    limiter.on_success()
+    return response
+
+
+def giveup_unless(*error_codes):
+    """
+    backoff giveup predicate retrying only the WAF errors in error_codes
+    """
+    return lambda e: not (isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in error_codes)
+
+
+def is_optimistic_lock_error(e):
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in OPTIMISTIC_LOCK_ERROR_CODES
+
+
+def get_addresses_digest(addresses):
+    """
+    Digest of the canonical, sorted addresses, equal for lists holding the same addresses
+    """
+    return hashlib.sha256('\n'.join(AddressSet(addresses)).encode('utf-8')).hexdigest()
+
+
+def get_statement_ip_set_arns(statement):
+    """
+    ARNs of the IPSets referenced by rules or statements, nested statements included
+    """
+    arns = set()
+    if isinstance(statement, dict):
+        if 'IPSetReferenceStatement' in statement:
+            arns.add(statement['IPSetReferenceStatement']['ARN'])
+        for value in statement.values():
+            arns.update(get_statement_ip_set_arns(value))
+    elif isinstance(statement, list):
+        for value in statement:
+            arns.update(get_statement_ip_set_arns(value))
+    return arns
+
+
+def get_web_acl_ip_set_arns(scope, web_acl_arn):
+    """
+    ARNs of the IPSets referenced by the rules of a web ACL, cached for IP_SET_CACHE_TTL
+    seconds. None when the web ACL cannot be read.
+    """
+    cached = WEB_ACL_IP_SETS.get((scope, web_acl_arn))
+    ttl = float(os.getenv('IP_SET_CACHE_TTL', DEFAULT_IP_SET_CACHE_TTL))
+    if cached and time.time() - cached['LoadedAt'] < ttl:
+        return cached['Arns']
+    try:
+        name, web_acl_id = web_acl_arn.split('/')[-2:]
+        response = call_waf('get_web_acl', Scope=scope, Name=name, Id=web_acl_id)
+    except Exception as e:
+        log.error("Failed to read WebACL: %s", str(web_acl_arn))
+        log.error(str(e))
+        return None
+    arns = get_statement_ip_set_arns(response['WebACL'].get('Rules', []))
+    WEB_ACL_IP_SETS[(scope, web_acl_arn)] = {'Arns': arns, 'LoadedAt': time.time()}
+    return arns
+
+
+def get_ip_set_shards(name, arn, shards_key):
+    """
+    (name, arn) of the physical IP sets of a logical IP set: the IP set itself, then the
+    shard IP sets listed in IP_SET_SHARDS_<shards_key> (comma separated ARNs, the name of
+    an IP set being part of its ARN). Empty when the IP set is not configured.
+    The shards are refused, and the IP set used alone, unless a rule of the web ACL
+    (WAF_WEB_ACL_ARN) references each of them: no request would be blocked by the
+    addresses written to a shard that no rule matches.
+    """
+    if arn is None:
+        return []
+    shards = [(name, arn)]
+    for shard_arn in os.getenv('IP_SET_SHARDS_' + shards_key, '').split(','):
+        shard_arn = shard_arn.strip()
+        if shard_arn:
+            shards.append((shard_arn.split('/')[-2], shard_arn))
+    if len(shards) == 1:
+        return shards
+
+    web_acl_arn = os.getenv('WAF_WEB_ACL_ARN')
+    referenced = get_web_acl_ip_set_arns(os.getenv('SCOPE'), web_acl_arn) if web_acl_arn else None
+    unreferenced = [shard_name for shard_name, shard_arn in shards[1:]
+                    if referenced is None or shard_arn not in referenced]
+    if unreferenced:
+        log.error("[waflib:get_ip_set_shards] Shard IPSets %s are not referenced by the web ACL %s, "
+                  "IPSet %s is used alone", ', '.join(unreferenced), str(web_acl_arn), str(name))
+        return shards[:1]
+    return shards
+
+
+def get_address_shard(address, shard_count):
+    """
+    Shard of an address. crc32 of the canonical form is stable across processes, so an
+    address stays in its shard and a change only rewrites the shards it touches.
+    """
+    return zlib.crc32(canonicalize(address).encode('utf-8')) % shard_count
+
+
+def load_logging_filters(value):
+    """
+    (logging filter rules, default behavior or None) from a list of rules or its JSON form, e.g.
+    [{"Behavior": "DROP", "Actions": ["BLOCK"]}, {"Behavior": "DROP", "Labels": ["partner:allowed"]}],
+    or from {"DefaultBehavior": "DROP", "Filters": [...]} to also set the behavior of the requests
+    no rule matches. No rules when value is empty.
+    """
+    if not value:
+        return [], None
+    rules = json.loads(value) if isinstance(value, str) else value
+    default_behavior = None
+    if isinstance(rules, dict) and 'Filters' in rules:
+        default_behavior = rules.get('DefaultBehavior')
+        rules = rules['Filters']
+    if isinstance(rules, dict):
+        rules = [rules]
+    if not isinstance(rules, list):
+        raise ValueError("Logging filters must be a list of rules")
+    return rules, default_behavior
+
+
+def build_logging_filter(rule):
+    """
+    WAF LoggingFilter filter of a rule {'Behavior', 'Requirement', 'Label(s)', 'Action(s)'}.
+    The conditions of a rule are met all by default; raises ValueError on an invalid rule.
+    """
+    behavior = str(rule.get('Behavior', '')).upper()
+    if behavior not in LOGGING_FILTER_BEHAVIORS:
+        raise ValueError("Unknown logging filter behavior %s" % rule.get('Behavior'))
+    requirement = str(rule.get('Requirement', 'MEETS_ALL')).upper()
+    if requirement not in LOGGING_FILTER_REQUIREMENTS:
+        raise ValueError("Unknown logging filter requirement %s" % rule.get('Requirement'))
+
+    labels = list(rule.get('Labels', [])) + ([rule['Label']] if rule.get('Label') else [])
+    actions = list(rule.get('Actions', [])) + ([rule['Action']] if rule.get('Action') else [])
+    conditions = [{'LabelNameCondition': {'LabelName': label}} for label in labels]
+    for action in actions:
+        if str(action).upper() not in LOGGING_FILTER_ACTIONS:
+            raise ValueError("Unknown logging filter action %s" % action)
+        conditions.append({'ActionCondition': {'Action': str(action).upper()}})
+    if not conditions:
+        raise ValueError("Logging filter rule without label or action")
+    return {'Behavior': behavior, 'Requirement': requirement, 'Conditions': conditions}
+
+
+def get_aggregation_policy():
+    """
+    CIDR aggregation of IP set addresses, None unless IP_SET_AGGREGATION is 'true'.
+    A /widen prefix holding at least `widen_density` of its addresses is blocked
+    as a whole; widening is off when the prefix length of the version is unset.
+
+    Aggregation parses and sorts every address of each update, on the order of a
+    hundred milliseconds per 10k addresses on a cold container against about a
+    millisecond for the plain merge (benchmarks.ip_list_bench). The blocked CIDRs no
+    longer match single addresses, so expired blocks are removed by rebuilding the
+    IP sets from the remaining requesters rather than address by address.
+    """
+    if os.getenv('IP_SET_AGGREGATION', 'false').lower() != 'true':
+        return None
+    widen_v4 = os.getenv('IP_SET_AGGREGATION_WIDEN_PREFIX_V4')
+    widen_v6 = os.getenv('IP_SET_AGGREGATION_WIDEN_PREFIX_V6')
+    return {
+        'widen_prefix': {4: int(widen_v4) if widen_v4 else None, 6: int(widen_v6) if widen_v6 else None},
+        'widen_density': float(os.getenv('IP_SET_AGGREGATION_WIDEN_DENSITY', 0.5))
+    }
+
+
+def select_top_k(items, k, key):
+    """
+    The k items with the highest key, highest first, selected with a heap bounded
+    to k entries (O(n log k)). Ties keep the order of `items`.
+    """
+    return heapq.nlargest(k, items, key=key)
+
 
 class WAFLIBv2(object):
 
     def __init__(self):
-        return
+        self.aggregation_policy = get_aggregation_policy()
 
     # Parse arn into ip_set_id
     def arn_to_id(self, arn):
@@ -38,39 +439,106 @@ class WAFLIBv2(object):
     def which_ip_version(self, log, source_ip):
         if source_ip == None:
             return None
-        try:
-            source_ip = source_ip.strip()
-            ip_type = "IPV%s"%ip_address(source_ip).version
-            return ip_type
-        except Exception as e:
+        ip_type = get_ip_version(source_ip)
+        if ip_type is None:
             log.error("Source ip %s is not IPV4 or IPV6.", str(source_ip))
-            log.error(str(e))
-            return None
+        return ip_type
     
-    # Append correct cidr to source_ip
+    # Append correct cidr to source_ip, a network prefix (x.x.x.0/24) is returned in its canonical form
     def set_ip_cidr(self, log, source_ip):
         if source_ip == None:
             return None
-        try:
-            source_ip = source_ip.strip()
-            ip_type = "IPV%s"%ip_address(source_ip).version
-        except Exception as e:
+        cidr = get_cidr(source_ip)
+        if cidr is None:
             log.error("Source ip %s is not IPV4 or IPV6.", str(source_ip))
-            log.error(str(e))
+        return cidr
+
+    # Cache the lock token, description and addresses of an IPSet, read or just written.
+    # The entry is dropped when there is no lock token to cache.
+    def store_ip_set_snapshot(self, scope, ip_set_id, lock_token, description, addresses):
+        if not lock_token:
+            IP_SET_SNAPSHOTS.pop((scope, ip_set_id), None)
+            return None
+        snapshot = {
+            'LockToken': lock_token,
+            'Description': description,
+            'Addresses': list(addresses),
+            'Digest': get_addresses_digest(addresses),
+            'LoadedAt': time.time()
+        }
+        IP_SET_SNAPSHOTS[(scope, ip_set_id)] = snapshot
+        return snapshot
+
+    def store_get_ip_set_response(self, scope, ip_set_id, response):
+        if not isinstance(response, dict) or 'IPSet' not in response:
+            IP_SET_SNAPSHOTS.pop((scope, ip_set_id), None)
             return None
-        
-        ip_class = "32" if ip_type == "IPV4" else "128"
-        return str(source_ip)+"/"+str(ip_class)
+        return self.store_ip_set_snapshot(scope, ip_set_id, response.get('LockToken'),
+                                          response['IPSet'].get('Description'), response['IPSet']['Addresses'])
+
+    def store_update_ip_set_response(self, scope, ip_set_id, description, addresses, response):
+        next_lock_token = response.get('NextLockToken') if isinstance(response, dict) else None
+        return self.store_ip_set_snapshot(scope, ip_set_id, next_lock_token, description, addresses)
+
+    # Cached snapshot of an IPSet, read again when it is older than IP_SET_CACHE_TTL seconds
+    # or refresh is set. None when the IPSet cannot be read.
+    def get_ip_set_snapshot(self, log, scope, name, ip_set_id, refresh=False):
+        snapshot = IP_SET_SNAPSHOTS.get((scope, ip_set_id))
+        ttl = float(os.getenv('IP_SET_CACHE_TTL', DEFAULT_IP_SET_CACHE_TTL))
+        if snapshot and not refresh and time.time() - snapshot['LoadedAt'] < ttl:
+            return snapshot
+        return self.store_get_ip_set_response(scope, ip_set_id, self.get_ip_set_by_id(log, scope, name, ip_set_id))
+
+    # Write the addresses built from the snapshot of an IPSet with its cached lock token, so
+    # that a warm container writes without reading the IPSet first. build_addresses returns
+    # the new addresses, or None when there is nothing to write. A stale token fails with
+    # WAFOptimisticLockException: the IPSet is then read again and the addresses rebuilt once.
+    # The cached addresses may be older than a change made by another writer, so a write is
+    # only skipped once the IPSet read again confirms there is nothing to write.
+    # Returns the update response, None when the write was skipped.
+    def write_ip_set(self, log, scope, name, ip_set_id, build_addresses):
+        for attempt in range(2):
+            cached = IP_SET_SNAPSHOTS.get((scope, ip_set_id))
+            snapshot = self.get_ip_set_snapshot(log, scope, name, ip_set_id, refresh=attempt > 0)
+            if snapshot is None:
+                raise RuntimeError("Failed to get IPSet %s" % str(name))
+
+            new_list = build_addresses(snapshot)
+            if new_list is None:
+                if attempt == 0 and snapshot is cached:
+                    log.debug("[waflib:write_ip_set] Nothing to write to the cached IPSet %s, reading it again",
+                              str(name))
+                    continue
+                return None
+
+            try:
+                response = call_waf('update_ip_set',
+                    Scope=scope,
+                    Name=name,
+                    Description=snapshot['Description'],
+                    Id=ip_set_id,
+                    Addresses=new_list,
+                    LockToken=snapshot['LockToken']
+                )
+            except ClientError as e:
+                IP_SET_SNAPSHOTS.pop((scope, ip_set_id), None)
+                if attempt == 0 and is_optimistic_lock_error(e):
+                    log.info("[waflib:write_ip_set] Lock token of IPSet %s is stale, reading it again", str(name))
+                    continue
+                raise
+            self.store_update_ip_set_response(scope, ip_set_id, snapshot['Description'], new_list, response)
+            return response
 
     # Retrieve IPSet given an ip_set_id
     def get_ip_set_by_id(self, log, scope, name, ip_set_id):
         try:
             log.debug("[waflib:get_ip_set_by_id] Start")
-            response = client.get_ip_set(
+            response = call_waf('get_ip_set',
                 Scope=scope,
                 Name=name,
                 Id=ip_set_id
             )
+            self.store_get_ip_set_response(scope, ip_set_id, response)
             log.debug("[waflib:get_ip_set_by_id] got ip set: \n{}.".format(response))
             log.debug("[waflib:get_ip_set_by_id] End")
             return response
@@ -80,16 +548,17 @@ class WAFLIBv2(object):
             return None
             
     # Retrieve IPSet given an ip set arn
-    @on_exception(expo, client.exceptions.WAFInternalErrorException, max_time=MAX_TIME)
+    @on_exception(expo, ClientError, giveup=giveup_unless('WAFInternalErrorException'), max_time=MAX_TIME)
     def get_ip_set(self, log, scope, name, arn):
         try:
             log.info("[waflib:get_ip_set] Start")
             ip_set_id = self.arn_to_id(arn)
-            response = client.get_ip_set(
+            response = call_waf('get_ip_set',
                 Scope=scope,
                 Name=name,
                 Id=ip_set_id
             )
+            self.store_get_ip_set_response(scope, ip_set_id, response)
             log.info("[waflib:get_ip_set] End")
             return response
         except Exception as e:
@@ -98,7 +567,7 @@ class WAFLIBv2(object):
             return None
 
     # Get the count of ip addresses based on ip set arn
-    @on_exception(expo, client.exceptions.WAFInternalErrorException, max_time=MAX_TIME)
+    @on_exception(expo, ClientError, giveup=giveup_unless('WAFInternalErrorException'), max_time=MAX_TIME)
     def get_ip_address_count(self, log, scope, name, arn):
         try:
             response = self.get_ip_set(log, scope, name, arn)
@@ -112,7 +581,7 @@ class WAFLIBv2(object):
             return 0
 
     # Update addresses in an IPSet using ip set id
-    @on_exception(expo, client.exceptions.WAFOptimisticLockException,
+    @on_exception(expo, ClientError, giveup=giveup_unless('WAFOptimisticLockException'),
               max_time=MAX_TIME,
               jitter=full_jitter,
               max_tries=API_CALL_NUM_RETRIES)
@@ -120,7 +589,7 @@ class WAFLIBv2(object):
         log.debug("[waflib:update_ip_set_by_id] Start")
 
         try:
-            response = client.update_ip_set(
+            response = call_waf('update_ip_set',
                 Scope=scope,
                 Name=name,
                 Id=ip_set_id,
@@ -129,18 +598,18 @@ class WAFLIBv2(object):
                 Description=description
             )
 
+            self.store_update_ip_set_response(scope, ip_set_id, description, addresses, response)
             log.debug("[waflib:update_ip_set_by_id] update ip set response: \n{}.".format(response))
             log.debug("[waflib:update_ip_set_by_id] End")
             return response
         # Get the latest ip set and retry updating api call when OptimisticLockException occurs
         except ClientError as ex:
-            exception_type = ex.response['Error']['Code']
-            if exception_type in ['OptimisticLockException']:
+            if is_optimistic_lock_error(ex):
                 log.info("[waflib:update_ip_set_by_id] OptimisticLockException detected. Get the latest ip set and retry updating ip set.")
                 ip_set = self.get_ip_set_by_id(log, scope, name, ip_set_id)
                 lock_token = ip_set['LockToken']
 
-                response = client.update_ip_set(
+                response = call_waf('update_ip_set',
                     Scope=scope,
                     Name=name,
                     Id=ip_set_id,
@@ -148,6 +617,7 @@ class WAFLIBv2(object):
                     LockToken=lock_token,
                     Description=description
                 )
+                self.store_update_ip_set_response(scope, ip_set_id, description, addresses, response)
                 log.debug("[waflib:update_ip_set_id] End")
                 return response
         except Exception as e:
@@ -156,49 +626,239 @@ class WAFLIBv2(object):
             return None
 
             
+    # Canonical form of an address (CIDR), used to compare address lists
+    def canonicalize_address(self, address):
+        return canonicalize(address)
+
+    # Addresses of desired_list missing from current_list and addresses of current_list
+    # missing from desired_list, compared in canonical form
+    def diff_addresses(self, current_list, desired_list):
+        current = {self.canonicalize_address(address): address for address in current_list}
+        desired = {self.canonicalize_address(address): address for address in desired_list}
+        additions = [address for key, address in desired.items() if key not in current]
+        removals = [address for key, address in current.items() if key not in desired]
+        return additions, removals
+
     # Update addresses in an IPSet using ip set arn
-    @on_exception(expo, client.exceptions.WAFOptimisticLockException,
+    def update_ip_set(self, log, scope, name, ip_set_arn, addresses):
+        return self.sync_ip_set(log, scope, name, ip_set_arn, addresses)['Response']
+
+    # Replace the addresses of an IPSet, skipping the write when they are already the same.
+    # Returns the counts of added and removed addresses and the update response.
+    @on_exception(expo, ClientError, giveup=giveup_unless('WAFOptimisticLockException'),
             max_time=MAX_TIME,
             jitter=full_jitter,
             max_tries=API_CALL_NUM_RETRIES)
-    def update_ip_set(self, log, scope, name, ip_set_arn, addresses):
-        log.info("[waflib:update_ip_set] Start")
+    def sync_ip_set(self, log, scope, name, ip_set_arn, addresses):
+        log.info("[waflib:sync_ip_set] Start")
+        result = {'Added': 0, 'Removed': 0, 'Updated': False, 'Response': None, 'Error': None}
         if (ip_set_arn is None or name is None):
             log.error("No IPSet found for: %s ", str(ip_set_arn))
-            return None
+            return result
+
+        digest = None
+
+        def build_addresses(snapshot):
+            nonlocal digest
+            digest = digest or get_addresses_digest(addresses)
+            if snapshot['Digest'] == digest:
+                additions, removals = [], []
+            else:
+                additions, removals = self.diff_addresses(snapshot['Addresses'], addresses)
+            result['Added'] = len(additions)
+            result['Removed'] = len(removals)
+            if not additions and not removals:
+                log.info("[waflib:sync_ip_set] IPSet %s is up to date, update skipped", str(name))
+                return None
+
+            log.info("Updating IPSet with description: %s, %d added and %d removed addresses",
+                     str(snapshot['Description']), len(additions), len(removals))
+            return addresses
 
         try:
             # convert from arn to ip_set_id
             ip_set_id = self.arn_to_id(ip_set_arn)
 
-            # retrieve the ipset to get a locktoken
-            ip_set = self.get_ip_set(log, scope, name, ip_set_arn)
-            lock_token = ip_set['LockToken']
-            description = ip_set['IPSet']['Description']
-            log.info("Updating IPSet with description: %s", str(description))
-
-            response = client.update_ip_set(
-                Scope=scope,
-                Name=name,
-                Description=description,
-                Id=ip_set_id,
-                Addresses=addresses,
-                LockToken=lock_token
-            )
+            # write with the cached locktoken, the ipset is read only when it is not cached or stale
+            result['Response'] = self.write_ip_set(log, scope, name, ip_set_id, build_addresses)
+            result['Updated'] = result['Response'] is not None
 
-            log.debug("[waflib:update_ip_set] update ip set response:\n{}".format(response))
-            log.info("[waflib:update_ip_set] End")
+            log.debug("[waflib:sync_ip_set] update ip set response:\n{}".format(result['Response']))
+            log.info("[waflib:sync_ip_set] End")
 
-            return response
+            return result
         except Exception as e:
             log.error(e)
             log.error("Failed to update IPSet: %s", str(name))
+            result['Error'] = str(e)
+            return result
+
+    # Run IP set updates, (function, args) pairs, concurrently in a small thread pool.
+    # Returns one (result, error) pair per update, in order: an update that raises
+    # does not affect the others. The calls share the WAF API rate limiter.
+    def run_ip_set_updates(self, log, updates):
+        if len(updates) <= 1:
+            workers = 1
+        else:
+            workers = min(len(updates), int(os.getenv('WAF_UPDATE_WORKERS', DEFAULT_WAF_UPDATE_WORKERS)))
+
+        def run(update):
+            function, args = update
+            try:
+                return function(*args), None
+            except Exception as e:
+                log.error("[waflib:run_ip_set_updates] IPSet update failed: %s", str(e))
+                return None, e
+
+        if workers <= 1:
+            return [run(update) for update in updates]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(run, updates))
+
+    # Replace the addresses of several IPSets concurrently, ip_sets being (name, arn, addresses)
+    # tuples. Returns one sync_ip_set result per IPSet, in order.
+    def sync_ip_sets(self, log, scope, ip_sets):
+        results = []
+        for result, error in self.run_ip_set_updates(
+                log, [(self.sync_ip_set, (log, scope, name, arn, addresses)) for name, arn, addresses in ip_sets]):
+            if result is None:
+                result = {'Added': 0, 'Removed': 0, 'Updated': False, 'Response': None, 'Error': str(error)}
+            results.append(result)
+        return results
+
+    # Patch several IPSets concurrently, ip_sets being (name, arn, addresses) tuples.
+    # Returns one {'Response', 'Error'} per IPSet, in order.
+    def patch_ip_sets(self, log, scope, ip_sets, ip_range_limit):
+        return [{'Response': response, 'Error': str(error) if error else None}
+                for response, error in self.run_ip_set_updates(
+                    log, [(self.patch_ip_set, (log, scope, name, arn, addresses, ip_range_limit))
+                          for name, arn, addresses in ip_sets])]
+
+    # Addresses of each of shard_count shards, in the order of addresses
+    def shard_addresses(self, addresses, shard_count):
+        if shard_count <= 1:
+            return [list(addresses)]
+        shards = [[] for _ in range(shard_count)]
+        for address in addresses:
+            shards[get_address_shard(address, shard_count)].append(address)
+        return shards
+
+    # Addresses of each of shard_count shards holding at most ip_range_limit addresses. The
+    # addresses, ranked, are truncated to the capacity of all the shards first; an address goes
+    # to its own shard, or to the next shard with space when its own shard is full.
+    def spread_addresses(self, addresses, shard_count, ip_range_limit):
+        addresses = list(addresses)[:ip_range_limit * max(shard_count, 1)]
+        if shard_count <= 1:
+            return [addresses]
+        shards = [[] for _ in range(shard_count)]
+        for address in addresses:
+            shard = get_address_shard(address, shard_count)
+            while len(shards[shard]) >= ip_range_limit:
+                shard = (shard + 1) % shard_count
+            shards[shard].append(address)
+        return shards
+
+    # Replace the addresses of logical IP sets, (shards, addresses) pairs where shards are the
+    # (name, arn) of the physical IP sets from get_ip_set_shards. The addresses are spread over
+    # the shards by spread_addresses; the shards are updated concurrently and the shards whose
+    # addresses did not change are skipped.
+    # Returns one sync result per logical IP set, with the count of addresses truncated.
+    def sync_sharded_ip_sets(self, log, scope, ip_sets, ip_range_limit):
+        updates = []
+        truncated = []
+        for shards, addresses in ip_sets:
+            parts = self.spread_addresses(addresses, len(shards), ip_range_limit)
+            truncated.append(len(addresses) - sum(len(part) for part in parts))
+            updates.extend((name, arn, part) for (name, arn), part in zip(shards, parts))
+
+        shard_results = iter(self.sync_ip_sets(log, scope, updates))
+        results = []
+        for (shards, _), dropped in zip(ip_sets, truncated):
+            result = {'Added': 0, 'Removed': 0, 'Updated': False, 'Responses': [], 'Error': None,
+                      'Truncated': dropped}
+            for _ in shards:
+                shard_result = next(shard_results)
+                result['Added'] += shard_result['Added']
+                result['Removed'] += shard_result['Removed']
+                result['Updated'] = result['Updated'] or shard_result['Updated']
+                result['Responses'].append(shard_result['Response'])
+                result['Error'] = result['Error'] or shard_result.get('Error')
+            if dropped:
+                log.info("[waflib:sync_sharded_ip_sets] %d addresses over the capacity of IPSet %s truncated",
+                         dropped, str(shards[0][0]))
+            results.append(result)
+        return results
+
+    # Add addresses to logical IP sets, (shards, addresses) pairs. Only the shards receiving
+    # addresses are patched. Returns one {'Responses', 'Error'} per logical IP set.
+    def patch_sharded_ip_sets(self, log, scope, ip_sets, ip_range_limit):
+        updates = []
+        owners = []
+        for index, (shards, addresses) in enumerate(ip_sets):
+            for (name, arn), part in zip(shards, self.shard_addresses(addresses, len(shards))):
+                if part:
+                    updates.append((name, arn, part))
+                    owners.append(index)
+
+        results = [{'Responses': [], 'Error': None} for _ in ip_sets]
+        for index, shard_result in zip(owners, self.patch_ip_sets(log, scope, updates, ip_range_limit)):
+            results[index]['Responses'].append(shard_result['Response'])
+            results[index]['Error'] = results[index]['Error'] or shard_result['Error']
+        return results
+
+    # Remove addresses from a logical IP set. An address may have been spread to another shard
+    # than its own, so every shard is looked at; only the shards holding them are updated.
+    def remove_addresses_from_sharded_ip_set(self, log, scope, shards, addresses):
+        return [self.remove_addresses_from_ip_set(log, scope, name, arn, addresses) for name, arn in shards]
+
+    # Logging filter of the web ACL: bad bot labels only and/or the configured rules
+    def get_logging_filter(self, log, is_bad_bot_waf_logs, bad_bot_waf_logs_label, logging_filters=None,
+                           default_behavior='KEEP'):
+        """
+        LoggingFilter of the web ACL, None when every request is logged. Invalid rules
+        are skipped so that logging is still configured. A default behavior given with
+        the rules takes precedence over default_behavior, except in bad bot only mode.
+        """
+        filters = []
+        if is_bad_bot_waf_logs:
+            filters.append({
+                'Behavior': 'KEEP',
+                'Requirement': 'MEETS_ALL',
+                'Conditions': [
+                    {
+                        'LabelNameCondition': {
+                            'LabelName': bad_bot_waf_logs_label
+                        }
+                    }
+                ]
+            })
+            default_behavior = 'DROP'
+
+        try:
+            rules, configured_behavior = load_logging_filters(logging_filters)
+        except ValueError as e:
+            log.error("[waflib:get_logging_filter] Ignoring logging filters: %s", str(e))
+            rules, configured_behavior = [], None
+        if configured_behavior and not is_bad_bot_waf_logs:
+            default_behavior = configured_behavior
+        for rule in rules:
+            try:
+                filters.append(build_logging_filter(rule))
+            except (ValueError, TypeError, AttributeError) as e:
+                log.error("[waflib:get_logging_filter] Ignoring logging filter %s: %s", str(rule), str(e))
+
+        if not filters:
             return None
-            
-    
+        default_behavior = str(default_behavior).upper()
+        return {
+            'DefaultBehavior': default_behavior if default_behavior in LOGGING_FILTER_BEHAVIORS else 'KEEP',
+            'Filters': filters
+        }
+
     # Put Log Configuration for webacl
-    @on_exception(expo, client.exceptions.WAFInternalErrorException, max_time=MAX_TIME)
-    def put_logging_configuration(self, log, web_acl_arn, delivery_stream_arn, is_bad_bot_waf_logs, bad_bot_waf_logs_label):
+    @on_exception(expo, ClientError, giveup=giveup_unless('WAFInternalErrorException'), max_time=MAX_TIME)
+    def put_logging_configuration(self, log, web_acl_arn, delivery_stream_arn, is_bad_bot_waf_logs,
+                                  bad_bot_waf_logs_label, logging_filters=None, default_behavior='KEEP'):
         try:
 
             logging_config = {
@@ -206,25 +866,12 @@ class WAFLIBv2(object):
                 'LogDestinationConfigs': [delivery_stream_arn]
             }
 
-            if is_bad_bot_waf_logs:
-                logging_config['LoggingFilter'] = {
-                    'DefaultBehavior': 'DROP',
-                    'Filters': [
-                        {
-                            'Behavior': 'KEEP',
-                            'Requirement': 'MEETS_ALL',
-                            'Conditions': [
-                                {
-                                    'LabelNameCondition': {
-                                        'LabelName': bad_bot_waf_logs_label
-                                    }
-                                }
-                            ]
-                        }
-                    ]
-                }
+            logging_filter = self.get_logging_filter(log, is_bad_bot_waf_logs, bad_bot_waf_logs_label,
+                                                     logging_filters, default_behavior)
+            if logging_filter:
+                logging_config['LoggingFilter'] = logging_filter
 
-            response = client.put_logging_configuration(
+            response = call_waf('put_logging_configuration',
                 LoggingConfiguration=logging_config
             )
             return response
@@ -234,10 +881,10 @@ class WAFLIBv2(object):
             return None
 
     # Delete Log Configuration for webacl
-    @on_exception(expo, client.exceptions.WAFInternalErrorException, max_time=MAX_TIME)
+    @on_exception(expo, ClientError, giveup=giveup_unless('WAFInternalErrorException'), max_time=MAX_TIME)
     def delete_logging_configuration(self, log, web_acl_arn):
         try:
-            response = client.delete_logging_configuration(
+            response = call_waf('delete_logging_configuration',
                 ResourceArn=web_acl_arn
             )
             return response
@@ -247,10 +894,10 @@ class WAFLIBv2(object):
             return None
 
     # List webacls
-    @on_exception(expo, client.exceptions.WAFInternalErrorException, max_time=MAX_TIME)
+    @on_exception(expo, ClientError, giveup=giveup_unless('WAFInternalErrorException'), max_time=MAX_TIME)
     def list_web_acls(self, log, scope):
         try:
-            response = client.list_web_acls(
+            response = call_waf('list_web_acls',
                 Scope=scope
             )
             return response
@@ -259,29 +906,38 @@ class WAFLIBv2(object):
             log.error(str(e))
             return None
 
-    @on_exception(expo,
-                  (client.exceptions.WAFInternalErrorException,
-                   client.exceptions.WAFOptimisticLockException,
-                   client.exceptions.WAFAssociatedItemException),
+    @on_exception(expo, ClientError,
+                  giveup=giveup_unless('WAFInternalErrorException', 'WAFOptimisticLockException',
+                                       'WAFAssociatedItemException'),
                   max_time=MAX_TIME)
     def delete_ip_set(self, log, scope, name, ip_set_id):
         try:
-            response = self.get_ip_set(log, scope, name, ip_set_id)          
-            if response is not None:
-                lock_token = response['LockToken']
-                response = client.delete_ip_set(
-                    Scope=scope,
-                    Name=name,
-                    LockToken=lock_token,
-                    Id=ip_set_id
-                )
-            return response
+            ip_set_id = self.arn_to_id(ip_set_id)
+            # delete with the cached locktoken, read the ipset again when it is stale
+            for attempt in range(2):
+                snapshot = self.get_ip_set_snapshot(log, scope, name, ip_set_id, refresh=attempt > 0)
+                if snapshot is None:
+                    return None
+                try:
+                    response = call_waf('delete_ip_set',
+                        Scope=scope,
+                        Name=name,
+                        LockToken=snapshot['LockToken'],
+                        Id=ip_set_id
+                    )
+                except ClientError as e:
+                    if attempt == 0 and is_optimistic_lock_error(e):
+                        continue
+                    raise
+                finally:
+                    IP_SET_SNAPSHOTS.pop((scope, ip_set_id), None)
+                return response
         except Exception as e:
             log.error("Failed to delete IPSet: %s", str(name))
             log.error(str(e))
             return None
 
-    @on_exception(expo, client.exceptions.WAFOptimisticLockException,
+    @on_exception(expo, ClientError, giveup=giveup_unless('WAFOptimisticLockException'),
                   max_time=MAX_TIME,
                   jitter=full_jitter,
                   max_tries=API_CALL_NUM_RETRIES)
@@ -291,28 +947,26 @@ class WAFLIBv2(object):
             log.error("No IPSet found for: %s ", str(ip_set_arn))
             return None
 
+        def build_addresses(snapshot):
+            current_list = snapshot['Addresses']
+            new_list = self.merge_and_truncate_addresses(log, addresses, current_list, ip_range_limit)
+            additions, removals = self.diff_addresses(current_list, new_list)
+            if not additions and not removals:
+                log.info("[waflib:patch_ip_set] IPSet %s already holds the addresses, patch skipped", str(name))
+                return None
+
+            log.info("Patch IPSet with description: %s, %d added and %d removed addresses",
+                     str(snapshot['Description']), len(additions), len(removals))
+            return new_list
+
         try:
             # convert from arn to ip_set_id
             ip_set_id = self.arn_to_id(ip_set_arn)
 
-            # retrieve the ipset to get a locktoken
-            ip_set = self.get_ip_set(log, scope, name, ip_set_arn)
-            lock_token = ip_set['LockToken']
-            description = ip_set['IPSet']['Description']
-            current_list = ip_set["IPSet"]["Addresses"]
-
-            new_list = self.merge_and_truncate_addresses(log, addresses, current_list, ip_range_limit)
-
-            log.info("Patch IPSet with description: %s", str(description))
-
-            response = client.update_ip_set(
-                Scope=scope,
-                Name=name,
-                Description=description,
-                Id=ip_set_id,
-                Addresses=new_list,
-                LockToken=lock_token
-            )
+            # write with the cached locktoken, the ipset is read only when it is not cached or stale
+            response = self.write_ip_set(log, scope, name, ip_set_id, build_addresses)
+            if response is None:
+                return None
 
             log.debug("[waflib:patch_ip_set] patch ip set response:\n{}".format(response))
             log.info("[waflib:patch_ip_set] patch End")
@@ -323,9 +977,49 @@ class WAFLIBv2(object):
             log.error("Failed to patch IPSet: %s", str(name))
             return None
 
+    @on_exception(expo, ClientError, giveup=giveup_unless('WAFOptimisticLockException'),
+                  max_time=MAX_TIME,
+                  jitter=full_jitter,
+                  max_tries=API_CALL_NUM_RETRIES)
+    def remove_addresses_from_ip_set(self, log, scope, name, ip_set_arn, addresses):
+        """
+        Remove addresses from an IPSet in a single update, skipped when none of them is in it.
+        Only exact addresses are removed: a wider CIDR covering one of them is left as is.
+        """
+        log.info("[waflib:remove_addresses_from_ip_set] Start")
+        if (ip_set_arn is None or name is None):
+            log.error("No IPSet found for: %s ", str(ip_set_arn))
+            return None
+
+        removed = AddressSet(addresses)
+
+        def build_addresses(snapshot):
+            current_list = snapshot['Addresses']
+            new_list = [ip for ip in current_list if ip not in removed]
+            if len(new_list) == len(current_list):
+                log.info("[waflib:remove_addresses_from_ip_set] None of the addresses is in IPSet %s", str(name))
+                return None
+
+            log.info("[waflib:remove_addresses_from_ip_set] Removing %d addresses from IPSet %s",
+                     len(current_list) - len(new_list), str(name))
+            return new_list
+
+        try:
+            # convert from arn to ip_set_id
+            ip_set_id = self.arn_to_id(ip_set_arn)
+
+            # write with the cached locktoken, the ipset is read only when it is not cached or stale
+            return self.write_ip_set(log, scope, name, ip_set_id, build_addresses)
+        except Exception as e:
+            log.error(e)
+            log.error("Failed to remove addresses from IPSet: %s", str(name))
+            return None
+
     def merge_and_truncate_addresses(self, log, addresses, current_list, ip_range_limit):
 
         new_list = self.ips_ordered_merge(addresses, current_list)
+        if self.aggregation_policy is not None:
+            new_list = self.aggregate_addresses(new_list, self.aggregation_policy)
         if len(new_list) > ip_range_limit:
             log.info("[truncate_list] Start to truncate list to respect WAF ip range limit")
             new_list = new_list[:ip_range_limit]
@@ -333,4 +1027,78 @@ class WAFLIBv2(object):
 
     def ips_ordered_merge(self, addresses, remaining_ips):
         seen = set()
-        return [ip for ip in [*addresses, *remaining_ips] if not (ip in seen or seen.add(ip))]
\ No newline at end of file
+        return [ip for ip in [*addresses, *remaining_ips] if not (ip in seen or seen.add(ip))]
+
+    def aggregate_addresses(self, addresses, policy=None):
+        """
+        Collapse adjacent and overlapping addresses into the minimal list of CIDRs.
+        Each CIDR takes the position of its first member in `addresses`, so the
+        result keeps their priority order for truncation. Entries that are not
+        IPs are kept as is.
+        """
+        policy = policy or {}
+        ranges = {4: [], 6: []}
+        others = []
+        for rank, address in enumerate(addresses):
+            parsed = parse_address(address)
+            if parsed is None:
+                others.append((rank, address))
+                continue
+            version, start, prefix_length = parsed
+            ranges[version].append((start, start + (1 << (MAX_PREFIX_LENGTH[version] - prefix_length)) - 1, rank))
+
+        aggregated = others
+        for version, version_ranges in ranges.items():
+            version_ranges.sort()
+            merged = self.merge_ranges(version_ranges)
+            widen_prefix = policy.get('widen_prefix', {}).get(version)
+            if widen_prefix is not None:
+                merged = self.merge_ranges(self.widen_ranges(merged, version, widen_prefix,
+                                                             policy.get('widen_density', 0.5)))
+            for start, end, rank in merged:
+                aggregated.extend((rank, format_cidr(cidr)) for cidr in range_to_cidrs(version, start, end))
+
+        aggregated.sort(key=lambda ranked: ranked[0])
+        return [address for _, address in aggregated]
+
+    def merge_ranges(self, ranges):
+        """
+        One pass over (start, end, rank) ranges sorted by start, merging the ones that overlap or touch
+        """
+        merged = []
+        for start, end, rank in ranges:
+            if merged and start <= merged[-1][1] + 1:
+                last_start, last_end, last_rank = merged[-1]
+                merged[-1] = (last_start, max(last_end, end), min(last_rank, rank))
+            else:
+                merged.append((start, end, rank))
+        return merged
+
+    def widen_ranges(self, ranges, version, prefix_length, density):
+        """
+        Replace the sorted, disjoint ranges of each /prefix_length network by the whole
+        network when they cover at least `density` of it
+        """
+        size = 1 << (MAX_PREFIX_LENGTH[version] - prefix_length)
+        widened = []
+        group = []
+        covered = 0
+        for start, end, rank in ranges + [(None, None, None)]:
+            network_start = start - start % size if start is not None else None
+            if group and (network_start != group[0][0] - group[0][0] % size or end - network_start >= size):
+                group_start = group[0][0] - group[0][0] % size
+                if covered >= density * size:
+                    widened.append((group_start, group_start + size - 1, min(r for _, _, r in group)))
+                else:
+                    widened.extend(group)
+                group, covered = [], 0
+            if start is None:
+                break
+            if end - network_start >= size:
+                # Spans more than one network: already at least as wide
+                widened.append((start, end, rank))
+            else:
+                group.append((start, end, rank))
+                covered += end - start + 1
+        return widened
+
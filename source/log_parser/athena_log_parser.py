@@ -21,6 +21,7 @@ from build_athena_queries import build_athena_query_for_app_access_logs, \
     build_bad_bot_athena_query_for_waf_logs
 from lib.boto3_util import create_client
 from lib.s3_util import S3
+from lib.stage_metrics import StageTimer, DetectionLatency
 from lambda_log_parser import LambdaLogParser
 
 
@@ -212,9 +213,18 @@ class AthenaLogParser(object):
         return outstanding_requesters, bad_bot_ips
 
 
-    def process_athena_result(self, bucket_name, key_name, ip_set_type):
+    def process_athena_result(self, bucket_name, key_name, ip_set_type, event_time=None):
         self.log.debug("[athena_log_parser: process_athena_result] Start")
 
+        # Share one timer with the lambda log parser so its WAF update stages are accounted here.
+        # Athena results carry no log record timestamps, so only queue, processing and API
+        # latencies can be measured on this path.
+        stage_timer = StageTimer(self.log, 'AthenaLogParser')
+        detection_latency = DetectionLatency()
+        detection_latency.set_event_time(event_time)
+        self.lambda_log_parser.stage_timer = stage_timer
+        self.lambda_log_parser.detection_latency = detection_latency
+
         # Use with statement to ensure proper resource management
         with tempfile.NamedTemporaryFile(delete=False, suffix='-' + key_name.split('/')[-1]) as temp_file:
             local_file_path = temp_file.name
@@ -226,12 +236,19 @@ class AthenaLogParser(object):
             # --------------------------------------------------------------------------------------------------------------
             self.log.info("[athena_log_parser: process_athena_result] Download file from S3")
             # --------------------------------------------------------------------------------------------------------------
-            self.s3_util.download_file_from_s3(bucket_name, key_name, local_file_path)
+            with stage_timer.stage('Download'):
+                self.s3_util.download_file_from_s3(bucket_name, key_name, local_file_path)
+            stage_timer.add_value('DownloadedBytes', os.path.getsize(local_file_path), 'Bytes')
 
             # --------------------------------------------------------------------------------------------------------------
             self.log.info("[athena_log_parser: process_athena_result] Read file content")
             # --------------------------------------------------------------------------------------------------------------
-            outstanding_requesters, bad_bot_ips = self.read_athena_result_file(local_file_path)
+            with stage_timer.stage('Parse'):
+                outstanding_requesters, bad_bot_ips = self.read_athena_result_file(local_file_path)
+                stage_timer.track(outstanding_requesters=outstanding_requesters, bad_bot_ips=bad_bot_ips)
+            stage_timer.set_value('OutstandingRequesters', len(outstanding_requesters['general']))
+            stage_timer.set_value('LinesProcessed', len(outstanding_requesters['general']) + len(bad_bot_ips))
+            stage_timer.add_rate('LinesPerSecond', stage_timer.get_value('LinesProcessed'), 'Parse')
 
             # --------------------------------------------------------------------------------------------------------------
             self.log.info("[athena_log_parser: process_athena_result] Update WAF IP Sets")
@@ -254,5 +271,7 @@ class AthenaLogParser(object):
                 os.unlink(local_file_path)
             except OSError:
                 pass  # File may already be deleted
+            detection_latency.record(stage_timer)
+            stage_timer.publish(IPSetType=ip_set_type)
 
         self.log.debug("[athena_log_parser: process_athena_result] End")
@@ -0,0 +1,270 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Time driven expiry of the HTTP flood and scanner blocks kept in the log parser
+state. The log parser only drops expired entries when a new log file arrives;
+the sweeper runs on a schedule, removes the entries older than blockPeriod from
+the state and the addresses they blocked from the IP sets, with one update per
+IP set. With CIDR aggregation (IP_SET_AGGREGATION) an expired address may only be
+blocked through a wider CIDR, possibly on another shard: the IP sets are then
+rebuilt from the requesters left in the states, as the log parser does. When the
+IP set writer owns the IP sets (IP_SET_INTENT_QUEUE_URL), removals and rebuilds
+are queued as intents instead of written.
+
+Expirations are kept in a min-heap per state object. A warm container reuses
+the heap while the state ETag is unchanged, so a sweep with nothing due only
+costs a HEAD per state object and a sweep pops just the expired entries.
+"""
+
+import os
+import copy
+import heapq
+import datetime
+from lib.waflibv2 import WAFLIBv2, get_ip_set_shards
+from lib.s3_util import S3, is_precondition_error
+from lib.stage_metrics import StageTimer
+from lambda_log_parser import LambdaLogParser
+from ip_set_intents import get_intent_queue, submit_intent
+from requester_state import decode_state, encode_state, encode_json_state, to_epoch_seconds, get_shard_key, \
+    union_requesters
+
+RESOURCE_TYPE = 'LambdaLogParserExpirySweeper'
+
+# (bucket, state key) -> (ETag, block period, outstanding requesters, ExpiryIndex)
+EXPIRY_INDEXES = {}
+
+
+class ExpiryIndex(object):
+    """
+    Min-heap of (expires_at, uri, ip) over the entries of one state, uri is ''
+    for the general section
+    """
+
+    def __init__(self, outstanding_requesters, block_period_seconds):
+        cache = {}
+        self.heap = [(to_epoch_seconds(v['updated_at'], cache) + block_period_seconds, '', k)
+                     for k, v in outstanding_requesters.get('general', {}).items()]
+        for uri, entries in outstanding_requesters.get('uriList', {}).items():
+            self.heap.extend((to_epoch_seconds(v['updated_at'], cache) + block_period_seconds, uri, k)
+                             for k, v in entries.items())
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def next_expiry(self):
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now_epoch):
+        due = []
+        while self.heap and self.heap[0][0] <= now_epoch:
+            expires_at, uri, ip = heapq.heappop(self.heap)
+            due.append((uri or None, ip))
+        return due
+
+
+class ExpirySweeper(object):
+    """
+    Removes expired blocks from the log parser states and from the HTTP flood and
+    scanners & probes IP sets
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.scope = os.getenv('SCOPE')
+        self.s3_util = S3(log)
+        self.waflib = WAFLIBv2()
+        self.intent_queue = get_intent_queue()
+        self.stage_timer = StageTimer(log, 'ExpirySweeper')
+
+    @staticmethod
+    def get_targets():
+        stack_name = os.getenv('STACK_NAME')
+        targets = []
+        if os.getenv('WAF_ACCESS_LOG_BUCKET'):
+            targets.append({
+                'bucket_name': os.getenv('WAF_ACCESS_LOG_BUCKET'),
+                'conf_filename': stack_name + '-waf_log_conf.json',
+                'output_filename': stack_name + '-waf_log_out.json',
+                'ip_set_type': 'flood',
+                'ip_sets': {
+                    'IPV4': get_ip_set_shards(os.getenv('IP_SET_NAME_HTTP_FLOODV4'),
+                                              os.getenv('IP_SET_ID_HTTP_FLOODV4'), 'HTTP_FLOODV4'),
+                    'IPV6': get_ip_set_shards(os.getenv('IP_SET_NAME_HTTP_FLOODV6'),
+                                              os.getenv('IP_SET_ID_HTTP_FLOODV6'), 'HTTP_FLOODV6'),
+                }
+            })
+        if os.getenv('APP_ACCESS_LOG_BUCKET'):
+            targets.append({
+                'bucket_name': os.getenv('APP_ACCESS_LOG_BUCKET'),
+                'conf_filename': stack_name + '-app_log_conf.json',
+                'output_filename': stack_name + '-app_log_out.json',
+                'ip_set_type': 'scanners',
+                'ip_sets': {
+                    'IPV4': get_ip_set_shards(os.getenv('IP_SET_NAME_SCANNERS_PROBESV4'),
+                                              os.getenv('IP_SET_ID_SCANNERS_PROBESV4'), 'SCANNERS_PROBESV4'),
+                    'IPV6': get_ip_set_shards(os.getenv('IP_SET_NAME_SCANNERS_PROBESV6'),
+                                              os.getenv('IP_SET_ID_SCANNERS_PROBESV6'), 'SCANNERS_PROBESV6'),
+                }
+            })
+        return targets
+
+    def sweep(self, now_epoch=None):
+        self.log.debug("[expiry_sweeper: sweep] Start")
+        if now_epoch is None:
+            now_epoch = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+
+        try:
+            for target in self.get_targets():
+                try:
+                    self.sweep_target(target, now_epoch)
+                except Exception as e:
+                    self.log.error("[expiry_sweeper: sweep] Failed to sweep %s" % target['output_filename'])
+                    self.log.error(e)
+        finally:
+            self.stage_timer.publish()
+
+        self.log.debug("[expiry_sweeper: sweep] End")
+
+    def sweep_target(self, target, now_epoch):
+        bucket_name = target['bucket_name']
+        output_filename = target['output_filename']
+        if self.s3_util.get_head_object(bucket_name, target['conf_filename']) is None:
+            self.log.info("[expiry_sweeper: sweep_target] No log parser configuration for %s" % output_filename)
+            return
+
+        config = self.s3_util.read_json_config_file_from_s3(bucket_name, target['conf_filename'])
+        block_period_seconds = int(float(config['general']['blockPeriod']) * 60)
+
+        shards = LambdaLogParser.get_state_shards()
+        state_keys = [output_filename] if shards == 0 else \
+            [get_shard_key(output_filename, shard) for shard in range(shards)]
+
+        unblocked = set()
+        remaining = []
+        for state_key in state_keys:
+            state_unblocked, outstanding_requesters = self.sweep_state(bucket_name, state_key,
+                                                                       block_period_seconds, now_epoch)
+            unblocked.update(state_unblocked)
+            remaining.append(outstanding_requesters)
+
+        if not unblocked:
+            return
+        if self.waflib.aggregation_policy is None:
+            self.remove_from_ip_sets(target['ip_sets'], unblocked)
+        elif None in remaining:
+            # The log parser changed a state meanwhile, it rebuilds the IP sets itself
+            self.log.info("[expiry_sweeper: sweep_target] State changed by the log parser, IP sets left to it")
+        else:
+            self.rebuild_ip_sets(target['ip_set_type'], union_requesters(remaining))
+
+    def load_index(self, bucket_name, state_key, block_period_seconds):
+        """
+        Outstanding requesters and expiry index of a state object, None when it does not exist
+        """
+        response = self.s3_util.get_head_object(bucket_name, state_key)
+        if response is None:
+            EXPIRY_INDEXES.pop((bucket_name, state_key), None)
+            return None
+
+        cached = EXPIRY_INDEXES.get((bucket_name, state_key))
+        if cached and response.get('ETag') and cached[0] == response.get('ETag') and cached[1] == block_period_seconds:
+            return cached
+
+        body, etag = self.s3_util.read_object(bucket_name, state_key)
+        self.stage_timer.add_value('StateDownloads', 1)
+        outstanding_requesters = decode_state(body)
+        return etag, block_period_seconds, outstanding_requesters, ExpiryIndex(outstanding_requesters,
+                                                                               block_period_seconds)
+
+    def sweep_state(self, bucket_name, state_key, block_period_seconds, now_epoch):
+        """
+        Drop the due entries of one state object. Returns the IPs left without any entry
+        and the outstanding requesters left, None when the state changed meanwhile.
+        """
+        loaded = self.load_index(bucket_name, state_key, block_period_seconds)
+        if loaded is None:
+            return set(), {'general': {}, 'uriList': {}}
+        etag, _, outstanding_requesters, index = loaded
+
+        due = index.pop_due(now_epoch)
+        if not due:
+            EXPIRY_INDEXES[(bucket_name, state_key)] = loaded
+            return set(), outstanding_requesters
+
+        for uri, ip in due:
+            if uri is None:
+                outstanding_requesters['general'].pop(ip, None)
+            else:
+                entries = outstanding_requesters['uriList'].get(uri, {})
+                entries.pop(ip, None)
+                if not entries:
+                    outstanding_requesters['uriList'].pop(uri, None)
+        self.stage_timer.add_value('EntriesExpired', len(due))
+
+        if LambdaLogParser.is_binary_state_format():
+            body, content_type = encode_state(outstanding_requesters), 'application/octet-stream'
+        else:
+            body, content_type = encode_json_state(outstanding_requesters), 'application/json'
+        conditions = {'if_match': etag} if LambdaLogParser.is_conditional_state_write() and etag else {}
+        try:
+            response = self.s3_util.put_object_body(bucket_name, state_key, body, content_type, **conditions)
+        except Exception as e:
+            # The log parser changed the state meanwhile; it drops expired entries itself on merge
+            EXPIRY_INDEXES.pop((bucket_name, state_key), None)
+            if is_precondition_error(e):
+                self.stage_timer.add_value('StateConflicts', 1)
+                return set(), None
+            raise
+
+        new_etag = response.get('ETag') if isinstance(response, dict) else None
+        if new_etag:
+            EXPIRY_INDEXES[(bucket_name, state_key)] = (new_etag, block_period_seconds, outstanding_requesters, index)
+        else:
+            EXPIRY_INDEXES.pop((bucket_name, state_key), None)
+
+        still_blocked = set(outstanding_requesters['general'])
+        for entries in outstanding_requesters['uriList'].values():
+            still_blocked.update(entries)
+        return {ip for _, ip in due if ip not in still_blocked}, outstanding_requesters
+
+    def remove_from_ip_sets(self, ip_sets, ips):
+        """
+        One IP set update per IP version (and shard) holding any of the ips, or one remove
+        intent per shard for the IP set writer
+        """
+        addresses = {'IPV4': [], 'IPV6': []}
+        for ip in ips:
+            ip_type = self.waflib.which_ip_version(self.log, ip)
+            if ip_type in addresses:
+                addresses[ip_type].append(self.waflib.set_ip_cidr(self.log, ip))
+
+        for ip_type in ('IPV4', 'IPV6'):
+            shards = ip_sets[ip_type]
+            if not addresses[ip_type] or not shards:
+                continue
+            if self.intent_queue is not None:
+                # An address may have been spread to another shard than its own
+                with self.stage_timer.stage('IntentSubmit'):
+                    for name, arn in shards:
+                        submit_intent(self.intent_queue, self.scope, name, arn, 'remove', addresses[ip_type])
+                self.stage_timer.add_value('IPSetIntentsSubmitted', len(shards))
+            else:
+                with self.stage_timer.stage('WAFUpdate'):
+                    self.waflib.remove_addresses_from_sharded_ip_set(self.log, self.scope, shards,
+                                                                     addresses[ip_type])
+            self.stage_timer.add_value('AddressesUnblocked', len(addresses[ip_type]))
+
+    def rebuild_ip_sets(self, ip_set_type, outstanding_requesters):
+        """
+        Replace the IP sets of a target by the aggregated addresses of the requesters left,
+        through replace intents when the IP set writer owns the IP sets
+        """
+        log_parser = LambdaLogParser(self.log)
+        log_parser.waflib = self.waflib
+        log_parser.intent_queue = self.intent_queue
+        log_parser.stage_timer = self.stage_timer
+        with self.stage_timer.stage('WAFUpdate'):
+            log_parser.update_ip_set(getattr(log_parser, ip_set_type), copy.deepcopy(outstanding_requesters))
+        self.stage_timer.add_value('IPSetsRebuilt', 1)
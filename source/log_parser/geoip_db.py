@@ -0,0 +1,144 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Read only GeoIP/ASN database used to enrich client IPs of the access logs.
+
+The file is memory-mapped, so only the pages touched by lookups are read, and
+holds two tables of non overlapping ranges sorted by start address:
+
+    header   MAGIC (4 bytes) | version (1 byte) | IPv4 count (uint32) | IPv6 count (uint32)
+    IPv4     start (uint32) | end (uint32) | country (2 bytes) | asn (uint32)
+    IPv6     start (16 bytes) | end (16 bytes) | country (2 bytes) | asn (uint32)
+
+Integers are big-endian so IPv6 ranges compare as bytes. A lookup is a binary
+search over the table of the IP version; hot IPs are answered by an LRU cache.
+The file is shipped in a Lambda layer (GEOIP_DB_PATH, /opt/geoip/geoip.db by
+default) and can be built from (network, country, asn) rows with write_database.
+"""
+
+import os
+import mmap
+import struct
+import socket
+import ipaddress
+from functools import lru_cache
+
+GEOIP_MAGIC = b'WGEO'
+GEOIP_VERSION = 1
+DEFAULT_GEOIP_DB_PATH = '/opt/geoip/geoip.db'
+DEFAULT_GEOIP_CACHE_SIZE = 65536
+
+HEADER = struct.Struct('>4sBII')
+RECORD_V4 = struct.Struct('>II2sI')
+RECORD_V6 = struct.Struct('>16s16s2sI')
+
+# path -> GeoIPDatabase, kept by warm Lambda containers
+DATABASES = {}
+
+
+class GeoIPDatabase(object):
+    def __init__(self, path, cache_size=DEFAULT_GEOIP_CACHE_SIZE):
+        self.path = path
+        with open(path, 'rb') as db_file:
+            self.buffer = mmap.mmap(db_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count_v4, self.count_v6 = HEADER.unpack_from(self.buffer, 0)
+        if magic != GEOIP_MAGIC or version != GEOIP_VERSION:
+            self.buffer.close()
+            raise ValueError("Unsupported GeoIP database %s" % path)
+        self.offset_v4 = HEADER.size
+        self.offset_v6 = self.offset_v4 + self.count_v4 * RECORD_V4.size
+
+        self.lookup = lru_cache(maxsize=cache_size)(self.search)
+
+    def close(self):
+        self.buffer.close()
+
+    def search(self, ip):
+        """
+        (country, asn) of an IP address, None when it is not in any range or not an IP
+        """
+        try:
+            packed = socket.inet_pton(socket.AF_INET, ip)
+            return self.search_table(struct.unpack('>I', packed)[0], RECORD_V4, self.offset_v4, self.count_v4)
+        except OSError:
+            pass
+        try:
+            packed = socket.inet_pton(socket.AF_INET6, ip)
+        except OSError:
+            return None
+        return self.search_table(packed, RECORD_V6, self.offset_v6, self.count_v6)
+
+    def search_table(self, key, record, offset, count):
+        # Last range starting at or before key
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if record.unpack_from(self.buffer, offset + middle * record.size)[0] <= key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+
+        start, end, country, asn = record.unpack_from(self.buffer, offset + (low - 1) * record.size)
+        if key > end:
+            return None
+        return country.decode('ascii').rstrip('\x00') or None, asn or None
+
+    def get_cache_info(self):
+        return self.lookup.cache_info()
+
+
+def write_database(path, rows):
+    """
+    Write a database from (network, country, asn) rows, network being a CIDR string
+    """
+    ranges_v4 = []
+    ranges_v6 = []
+    for network, country, asn in rows:
+        network = ipaddress.ip_network(network, strict=False)
+        country = (country or '').encode('ascii')[:2].ljust(2, b'\x00')
+        if network.version == 4:
+            ranges_v4.append((int(network.network_address), int(network.broadcast_address), country, int(asn or 0)))
+        else:
+            ranges_v6.append((network.network_address.packed, network.broadcast_address.packed,
+                              country, int(asn or 0)))
+    ranges_v4.sort()
+    ranges_v6.sort()
+
+    with open(path, 'wb') as db_file:
+        db_file.write(HEADER.pack(GEOIP_MAGIC, GEOIP_VERSION, len(ranges_v4), len(ranges_v6)))
+        for row in ranges_v4:
+            db_file.write(RECORD_V4.pack(*row))
+        for row in ranges_v6:
+            db_file.write(RECORD_V6.pack(*row))
+
+
+def load_database(path=None):
+    """
+    Database at GEOIP_DB_PATH, opened once per container. None when there is no file.
+    """
+    path = path or os.getenv('GEOIP_DB_PATH', DEFAULT_GEOIP_DB_PATH)
+    if path not in DATABASES:
+        if not os.path.isfile(path):
+            return None
+        DATABASES[path] = GeoIPDatabase(path, int(os.getenv('GEOIP_CACHE_SIZE', DEFAULT_GEOIP_CACHE_SIZE)))
+    return DATABASES[path]
+
+
+@lru_cache(maxsize=DEFAULT_GEOIP_CACHE_SIZE)
+def get_network_prefix(ip, prefix_length_v4, prefix_length_v6):
+    """
+    Network prefix (CIDR) of an IP for prefix level counting, the IP itself for full
+    length prefixes or keys that are not IPs
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    prefix_length = prefix_length_v4 if address.version == 4 else prefix_length_v6
+    if prefix_length >= address.max_prefixlen:
+        return ip
+    return str(ipaddress.ip_network((address, prefix_length), strict=False))
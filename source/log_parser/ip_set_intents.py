@@ -0,0 +1,337 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Single writer of the IP sets shared by the log parser producers (log files, Athena
+results and bad bot). Instead of a read-modify-write of their own, producers submit
+intents to a queue:
+
+    {'Id', 'Part', 'Parts', 'SubmittedAt', 'DetectedAt', 'Scope', 'Name', 'Arn',
+     'Action': 'add' | 'remove' | 'replace', 'Addresses', 'Limit'}
+
+IPSetIntentWriter folds the intents of each IP set, in the order they were queued,
+into one net change and applies it with a single update per IP set. An intent
+larger than INTENT_MAX_ADDRESSES addresses is split into parts that are only
+applied once all of them are received, which keeps messages under the SQS size
+limit. An incomplete intent, a failed write and the later intents of the same IP
+set are released and delivered again, so an older intent never follows a newer one.
+
+The queue is an SQS FIFO queue (IP_SET_INTENT_QUEUE_URL, only set when the stack
+activates it) with one message group per IP set: SQS delivers the intents of an IP
+set in order and to one writer at a time. The log parser receives them through an
+SQS event source mapping (SQSEventBatch); InMemoryIntentQueue runs the same flow
+in a single process for tests and local runs.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from collections import deque
+from lib.boto3_util import get_client
+from lib.ip_util import canonicalize
+from lib.stage_metrics import StageTimer
+from aws_lambda_powertools.metrics import MetricUnit
+
+ACTIONS = ('add', 'remove', 'replace')
+DEFAULT_INTENT_MAX_ADDRESSES = 2000
+DEFAULT_INTENT_MAX_MESSAGES = 1000
+DEFAULT_INTENT_PART_TIMEOUT = 300
+DEFAULT_IP_RANGE_LIMIT = 10000
+SQS_BATCH_SIZE = 10
+
+
+class InMemoryIntentQueue(object):
+    """
+    Intent queue of one process. Received messages stay in flight until they are
+    deleted or released.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = deque()
+        self.in_flight = {}
+        self.next_receipt = 0
+
+    def __len__(self):
+        return len(self.messages) + len(self.in_flight)
+
+    def send(self, messages):
+        with self.lock:
+            self.messages.extend(json.dumps(message) for message in messages)
+
+    def receive(self, max_messages):
+        received = []
+        with self.lock:
+            while self.messages and len(received) < max_messages:
+                body = self.messages.popleft()
+                self.next_receipt += 1
+                self.in_flight[self.next_receipt] = body
+                received.append((self.next_receipt, json.loads(body)))
+        return received
+
+    def delete(self, receipts):
+        with self.lock:
+            for receipt in receipts:
+                self.in_flight.pop(receipt, None)
+
+    def release(self, receipts):
+        with self.lock:
+            for receipt in reversed(receipts):
+                body = self.in_flight.pop(receipt, None)
+                if body is not None:
+                    self.messages.appendleft(body)
+
+
+class SQSIntentQueue(object):
+    """
+    Producer side of the SQS FIFO intent queue. Every IP set is a message group, the
+    writer receives the messages through the event source mapping (SQSEventBatch).
+    """
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.sqs_client = get_client('sqs')
+
+    def send(self, messages):
+        for message in messages:
+            ip_set_id = message['Arn'].split('/')[-1]
+            self.sqs_client.send_message(
+                QueueUrl=self.queue_url,
+                MessageBody=json.dumps(message),
+                MessageGroupId=ip_set_id,
+                MessageDeduplicationId='%s-%d' % (message['Id'], message['Part'])
+            )
+
+
+class SQSEventBatch(object):
+    """
+    Intent queue over the records of one SQS event source mapping invocation. Lambda
+    deletes the records of a successful invocation; released records are reported as
+    batch item failures, SQS delivers them again before the later messages of their
+    IP set.
+    """
+
+    def __init__(self, records):
+        self.records = list(records)
+        self.failures = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def receive(self, max_messages):
+        received, self.records = self.records[:max_messages], self.records[max_messages:]
+        return [(record['messageId'], json.loads(record['body'])) for record in received]
+
+    def delete(self, receipts):
+        pass
+
+    def release(self, receipts):
+        self.failures.extend(receipts)
+
+    def batch_response(self):
+        return {'batchItemFailures': [{'itemIdentifier': receipt} for receipt in self.failures]}
+
+
+def is_intent_event(event):
+    """
+    True for the SQS events delivering intents to the IP set writer
+    """
+    records = event.get('Records') or [{}]
+    return records[0].get('eventSource') == 'aws:sqs'
+
+
+def get_intent_queue():
+    """
+    Intent queue of the function, None when IP set intents are not enabled
+    """
+    queue_url = os.getenv('IP_SET_INTENT_QUEUE_URL')
+    return SQSIntentQueue(queue_url) if queue_url else None
+
+
+def submit_intent(queue, scope, name, arn, action, addresses, limit=None, now=None, detected_at=None):
+    """
+    Queue an intent on one IP set, split into parts of INTENT_MAX_ADDRESSES addresses.
+    `detected_at` is the time of the newest log record behind it, the writer measures
+    the detection latency from it. Returns the intent id.
+    """
+    if action not in ACTIONS:
+        raise ValueError("Unknown IP set intent action %s" % action)
+    intent_id = uuid.uuid4().hex
+    submitted_at = time.time() if now is None else now
+    size = int(os.getenv('INTENT_MAX_ADDRESSES', DEFAULT_INTENT_MAX_ADDRESSES))
+    parts = [addresses[i:i + size] for i in range(0, len(addresses), size)] or [[]]
+    queue.send([{
+        'Id': intent_id,
+        'Part': part,
+        'Parts': len(parts),
+        'SubmittedAt': submitted_at,
+        'DetectedAt': detected_at,
+        'Scope': scope,
+        'Name': name,
+        'Arn': arn,
+        'Action': action,
+        'Addresses': list(part_addresses),
+        'Limit': limit
+    } for part, part_addresses in enumerate(parts)])
+    return intent_id
+
+
+def assemble_intents(messages, now, part_timeout):
+    """
+    Join the parts of the received intents. Returns (status, intent, receipts) of every
+    intent in the order its first part was received, status being 'complete',
+    'pending' (parts still missing) or 'expired' (incomplete for more than part_timeout).
+    """
+    parts = {}
+    for receipt, message in messages:
+        intent = parts.setdefault(message['Id'], {'parts': {}, 'receipts': []})
+        intent['parts'][message['Part']] = message
+        intent['receipts'].append(receipt)
+
+    assembled = []
+    for intent in parts.values():
+        first = next(iter(intent['parts'].values()))
+        if len(intent['parts']) == first['Parts']:
+            complete = dict(first, Addresses=[address for part in sorted(intent['parts'])
+                                              for address in intent['parts'][part]['Addresses']])
+            del complete['Part']
+            assembled.append(('complete', complete, intent['receipts']))
+        elif now - first['SubmittedAt'] > part_timeout:
+            assembled.append(('expired', first, intent['receipts']))
+        else:
+            assembled.append(('pending', first, intent['receipts']))
+    return assembled
+
+
+def coalesce_intents(intents):
+    """
+    Net change of the intents of one IP set, folded in queue order:
+    (replacement addresses or None, added addresses, removed addresses, limit)
+    """
+    replacement = None
+    additions = {}
+    removals = set()
+    limit = None
+    for intent in intents:
+        addresses = [canonicalize(address) for address in intent['Addresses']]
+        if intent['Action'] == 'replace':
+            replacement = addresses
+            additions = {}
+            removals = set()
+        elif intent['Action'] == 'add':
+            for address in addresses:
+                removals.discard(address)
+                additions[address] = None
+        else:
+            for address in addresses:
+                additions.pop(address, None)
+                removals.add(address)
+        if intent.get('Limit'):
+            limit = intent['Limit']
+    return replacement, list(additions), removals, limit
+
+
+class IPSetIntentWriter(object):
+    """
+    Drains the intent queue and applies the net change of each IP set with one write
+    """
+
+    def __init__(self, log, queue, waflib):
+        self.log = log
+        self.queue = queue
+        self.waflib = waflib
+        self.stage_timer = StageTimer(log, 'IPSetIntentWriter')
+
+    def build_addresses(self, change):
+        replacement, additions, removals, limit = change
+        limit = limit or int(os.getenv('LIMIT_IP_ADDRESS_RANGES_PER_IP_MATCH_CONDITION', DEFAULT_IP_RANGE_LIMIT))
+
+        def build(snapshot):
+            current_list = snapshot['Addresses']
+            base = replacement if replacement is not None else current_list
+            kept = [address for address in map(canonicalize, base) if address not in removals]
+            new_list = self.waflib.merge_and_truncate_addresses(self.log, additions, kept, limit)
+            added, removed = self.waflib.diff_addresses(current_list, new_list)
+            if not added and not removed:
+                return None
+            self.stage_timer.add_value('IPSetAdded', len(added))
+            self.stage_timer.add_value('IPSetRemoved', len(removed))
+            return new_list
+        return build
+
+    def drain(self, now=None):
+        """
+        Apply the intents waiting in the queue. Returns the number of IP sets written.
+        """
+        now = time.time() if now is None else now
+        messages = self.queue.receive(int(os.getenv('INTENT_MAX_MESSAGES', DEFAULT_INTENT_MAX_MESSAGES)))
+        if not messages:
+            return 0
+
+        by_ip_set = {}
+        blocked = set()
+        released = []
+        for status, intent, receipts in assemble_intents(
+                messages, now, float(os.getenv('INTENT_PART_TIMEOUT', DEFAULT_INTENT_PART_TIMEOUT))):
+            ip_set = (intent['Scope'], intent['Name'], intent['Arn'])
+            if status == 'expired':
+                self.log.warning("[ip_set_intents: drain] Dropping %d parts of an incomplete intent" % len(receipts))
+                self.queue.delete(receipts)
+            elif status == 'pending' or ip_set in blocked:
+                # The later intents of the IP set wait for the incomplete one, to be applied in order
+                blocked.add(ip_set)
+                released.extend(receipts)
+            else:
+                by_ip_set.setdefault(ip_set, []).append((intent, receipts))
+
+        written = 0
+        for (scope, name, arn), group in by_ip_set.items():
+            receipts = [receipt for _, intent_receipts in group for receipt in intent_receipts]
+            build = self.build_addresses(coalesce_intents(intent for intent, _ in group))
+            try:
+                with self.stage_timer.stage('WAFUpdate'):
+                    response = self.waflib.write_ip_set(self.log, scope, name, self.waflib.arn_to_id(arn), build)
+            except Exception as e:
+                self.log.error("[ip_set_intents: drain] Failed to write IPSet %s, intents are retried" % str(name))
+                self.log.error(str(e))
+                self.stage_timer.add_value('IPSetUpdateErrors', 1)
+                released.extend(receipts)
+                continue
+
+            self.queue.delete(receipts)
+            self.stage_timer.add_value('IntentsApplied', len(group))
+            if response is None:
+                self.stage_timer.add_value('IPSetWritesSkipped', 1)
+            else:
+                written += 1
+                self.stage_timer.add_value('IPSetWrites', 1)
+                self.record_latency([intent for intent, _ in group], time.time())
+
+        if released:
+            order = {receipt: index for index, (receipt, _) in enumerate(messages)}
+            self.queue.release(sorted(released, key=order.get))
+        self.log.info("[ip_set_intents: drain] %d IP sets, %d written" % (len(by_ip_set), written))
+        return written
+
+    def record_latency(self, intents, written_at):
+        """
+        Time the oldest intent of a write waited in the queue and, when the intents carry
+        the time of their log records, the detection latency up to the IP set write
+        """
+        waits = [written_at - intent['SubmittedAt'] for intent in intents]
+        detections = [written_at - intent['DetectedAt'] for intent in intents if intent.get('DetectedAt')]
+        for name, values in (('IntentQueueLatency', waits), ('DetectionLatency', detections)):
+            if values:
+                latency = round(max(max(values), 0) * 1000, 3)
+                if latency > self.stage_timer.get_value(name):
+                    self.stage_timer.set_value(name, latency, MetricUnit.Milliseconds)
+
+    def run(self):
+        """
+        Apply the intents of the queue and publish the writer metrics
+        """
+        try:
+            self.drain()
+        finally:
+            self.stage_timer.publish()
@@ -12,17 +12,52 @@
 ######################################################################################################################
 
 import gzip
+import io
 import json
 import datetime
 import os
 import tempfile
 from os import remove
-from time import sleep
+from time import perf_counter
 from urllib.parse import urlparse
-from lib.waflibv2 import WAFLIBv2
-from lib.s3_util import S3
+from backoff import on_exception, expo, full_jitter
+from lib.waflibv2 import WAFLIBv2, select_top_k, get_ip_set_shards, load_logging_filters, build_logging_filter
+from lib.cidr_index import get_allowlist_index
+from lib.s3_util import S3, is_precondition_error
+from lib.stage_metrics import StageTimer, TimedReader, DetectionLatency, record_ip_set_sync
+from geoip_db import load_database, get_network_prefix
+from ip_set_intents import get_intent_queue, submit_intent
+from requester_state import FORMAT_DATE_TIME, encode_state, encode_json_state, decode_state, parse_updated_at, \
+    copy_requesters, StateConflictError, split_requesters, union_requesters, get_shard_key, get_shard_prefix, \
+    to_epoch_seconds
+
+READ_BUFFER_SIZE = 1024 * 1024
+STATE_WRITE_MAX_TRIES = 5
+STATE_WRITE_MAX_TIME = 20
+GROUP_BY_DIMENSIONS = ('country', 'uri', 'method')
+
+# Shards kept by a warm Lambda container: (bucket, shard key) -> (ETag, outstanding requesters).
+# Compaction only downloads the shards whose ETag changed since the previous invocation.
+SHARD_CACHE = {}
+
+
+def count_state_write_retry(details):
+    details['args'][0].stage_timer.add_value('StateWriteRetries', 1)
+
+
+def get_group_by_dimensions(group_by, request_threshold_by_country):
+    """
+    Aggregation dimensions of the WAF log counters besides the client IP, chosen like
+    the columns of the Athena query (build_select_group_by_columns_for_waf_logs):
+    'Country', 'URI', 'Country and URI' or 'None', and country whenever thresholds by
+    country are set
+    """
+    group_by = (group_by or 'none').strip().lower()
+    dimensions = set() if group_by == 'none' else {d.strip() for d in group_by.split(' and ')}
+    if request_threshold_by_country:
+        dimensions.add('country')
+    return tuple(d for d in GROUP_BY_DIMENSIONS if d in dimensions)
 
-FORMAT_DATE_TIME = "%Y-%m-%d %H:%M:%S %Z%z"
 
 class LambdaLogParser(object):
     """
@@ -32,12 +67,32 @@ class LambdaLogParser(object):
     def __init__(self, log):
         self.log = log
         self.config = {}
-        self.delay_between_updates = 5
         self.scope = os.getenv('SCOPE')
         self.scanners = 1
         self.flood = 2
         self.s3_util = S3(log)
         self.waflib = WAFLIBv2()
+        self.stage_timer = StageTimer(log, 'LambdaLogParser')
+        self.detection_latency = DetectionLatency()
+        # Raw timestamp field of the newest log record (comparable within a log type)
+        self.newest_record_time = None
+        # ETag of the state read by the last merge, None when there was no state yet
+        self.state_etag = None
+        # ETag returned by the last state write, when S3 returned one
+        self.state_etag_written = None
+        # GeoIP/ASN database for thresholds by country / ASN, None when not configured
+        self.geoip = None
+        # (IPv4, IPv6) prefix lengths when requesters are counted by network prefix
+        self.prefix_lengths = None
+        # Dimensions of the WAF log counter keys besides the IP, see configure_group_by
+        self.group_by_dimensions = ()
+        self.group_keys = {}
+        self.group_key_list = []
+        self.allowlist = None
+        # Queue of the IP set writer, None when the parser writes the IP sets itself
+        self.intent_queue = get_intent_queue()
+        # WAF logging filters in effect for the parsed WAF logs, see configure_log_filters
+        self.log_filters = []
 
         # CloudFront Access Logs
         # http://docs.aws.amazon.com/AmazonCloudFront/latest/DeveloperGuide/AccessLogs.html#BasicDistributionFileFormat
@@ -122,20 +177,37 @@ class LambdaLogParser(object):
             'uriList': {}
         }
         bad_bot_ips = []
+        line_count = 0
 
-        with gzip.open(local_file_path, 'r') as content:
-            for line in content:
-                try:  
-                    oreq = self.read_contents(line, log_type, outstanding_requesters, counter, bad_bot_ips)
-                    if oreq: 
-                        return oreq
+        # Decompression time is accounted by TimedReader once per buffer refill,
+        # the rest of the loop is attributed to the Parse stage
+        decompress_ms = self.stage_timer.get_duration('Decompress')
+        start = perf_counter()
+        try:
+            with gzip.open(local_file_path, 'r') as gzip_content, io.BufferedReader(
+                    TimedReader(gzip_content, self.stage_timer, 'Decompress', 'DecompressedBytes'),
+                    READ_BUFFER_SIZE) as content:
+                for line in content:
+                    line_count += 1
+                    try:
+                        oreq = self.read_contents(line, log_type, outstanding_requesters, counter, bad_bot_ips)
+                        if oreq:
+                            return oreq
+
+                    except Exception as e:
+                        error_count += 1
+                        self.log.error("[lambda_log_parser: get_outstanding_requesters] Error to process line: %s" % line)
+                        self.log.error(str(e))
+                        if error_count == 5:  #Allow 5 errors before stopping the function execution
+                            raise
+        finally:
+            loop_ms = (perf_counter() - start) * 1000
+            self.stage_timer.add_duration(
+                'Parse', loop_ms - (self.stage_timer.get_duration('Decompress') - decompress_ms))
+            self.stage_timer.add_value('LinesProcessed', line_count)
+            self.stage_timer.track(counter=counter, outstanding_requesters=outstanding_requesters)
+            self.stage_timer.checkpoint('Parse')
 
-                except Exception as e:
-                    error_count += 1
-                    self.log.error("[lambda_log_parser: get_outstanding_requesters] Error to process line: %s" % line)
-                    self.log.error(str(e))
-                    if error_count == 5:  #Allow 5 errors before stopping the function execution
-                        raise
         remove(local_file_path)
         return counter, outstanding_requesters, bad_bot_ips
 
@@ -148,21 +220,34 @@ class LambdaLogParser(object):
 
         if log_type == 'waf':
             request_key, uri, ip, line_data = self.read_waf_log_file(line)
+            record_time = line_data['timestamp']
         elif log_type == 'alb':
             line = line.decode('utf8')
             if line.startswith('#'):
                 return
             request_key, uri, return_code_index, ip, line_data = \
                 self.read_alb_log_file(line)
+            record_time = line_data[self.line_format_alb['timestamp']]
         elif log_type == 'cloudfront':
             line = line.decode('utf8')
             if line.startswith('#'):
                 return
             request_key, uri, return_code_index, ip, line_data = \
                 self.read_cloudfront_log_file(line)
+            record_time = line_data[self.line_format_cloud_front['date']] + 'T' + \
+                line_data[self.line_format_cloud_front['time']]
         else:
             return outstanding_requesters
 
+        if self.newest_record_time is None or record_time > self.newest_record_time:
+            self.newest_record_time = record_time
+
+        if self.prefix_lengths:
+            request_key = request_key[:len(request_key) - len(ip)] + get_network_prefix(ip, *self.prefix_lengths)
+
+        if self.group_by_dimensions and log_type == 'waf':
+            request_key = self.get_group_key(request_key, uri, line_data)
+
         if self.is_full_log():
             if 'ignoredSufixes' in self.config['general'] and uri.endswith(
                     tuple(self.config['general']['ignoredSufixes'])):
@@ -176,6 +261,146 @@ class LambdaLogParser(object):
         bad_bot_ips = self.bad_bot_urls_population(uri, ip, bad_bot_ips, log_type)
         self.log.debug("[lambda_log_parser: bad_bot_urls_population] End")
 
+    def get_newest_record_epoch(self, log_type):
+        """
+        Convert the newest log record timestamp seen while parsing into epoch seconds
+        """
+        if self.newest_record_time is None:
+            return None
+        try:
+            if log_type == 'waf':
+                return int(self.newest_record_time) / 1000.0
+            return datetime.datetime.fromisoformat(
+                self.newest_record_time.replace('Z', '')).replace(tzinfo=datetime.timezone.utc).timestamp()
+        except (TypeError, ValueError):
+            self.log.info("[lambda_log_parser: get_newest_record_epoch] Invalid record time %s" % self.newest_record_time)
+            return None
+
+    def configure_enrichment(self):
+        """
+        Load the GeoIP/ASN database when the configuration has thresholds by country
+        or ASN (e.g. general.errorThresholdByCountry {"CN": 20}, general.errorThresholdByAsn
+        {"64500": 10}), and the prefix lengths of general.prefixLength {"ipv4": 24, "ipv6": 64}
+        """
+        general = self.config.get('general', {})
+        self.geoip = None
+        if any(general[k] for k in general if k.endswith(('ByCountry', 'ByAsn'))):
+            self.geoip = load_database()
+            if self.geoip is None:
+                self.log.info("[lambda_log_parser: configure_enrichment] No GeoIP database, "
+                              "thresholds by country and ASN are ignored")
+
+        prefix_length = general.get('prefixLength')
+        self.prefix_lengths = (int(prefix_length.get('ipv4', 32)), int(prefix_length.get('ipv6', 128))) \
+            if prefix_length else None
+
+    def configure_log_filters(self, log_type):
+        """
+        Record the WAF logging filters in effect (WAF_LOG_FILTERS, the WAFLogFilters stack
+        parameter also given to put_logging_configuration): requests they drop never reach
+        the parser, so the counters of a WAF log only cover the requests the filters keep.
+        """
+        self.log_filters = []
+        if log_type != 'waf':
+            return
+        try:
+            rules, default_behavior = load_logging_filters(os.getenv('WAF_LOG_FILTERS'))
+            self.log_filters = [build_logging_filter(rule) for rule in rules]
+        except (ValueError, TypeError, AttributeError) as e:
+            self.log.error("[lambda_log_parser: configure_log_filters] Invalid WAF_LOG_FILTERS: %s" % str(e))
+            return
+        if self.log_filters:
+            self.log.info("[lambda_log_parser: configure_log_filters] WAF logging filters in effect: %s, "
+                          "default behavior %s" % (json.dumps(self.log_filters), default_behavior or 'KEEP'))
+        self.stage_timer.set_value('WAFLogFilters', len(self.log_filters))
+
+    def configure_group_by(self, log_type):
+        """
+        Count WAF log requests by (minute, client IP) plus the dimensions the Athena
+        engine groups by, read from the same HTTP_FLOOD_ATHENA_GROUP_BY and
+        REQUEST_THRESHOLD_BY_COUNTRY settings. Thresholds by country of the
+        configuration file (general.requestThresholdByCountry) take precedence.
+        """
+        self.group_by_dimensions = ()
+        self.group_keys = {}
+        self.group_key_list = []
+        if log_type != 'waf':
+            return
+
+        request_threshold_by_country = os.getenv('REQUEST_THRESHOLD_BY_COUNTRY', '').strip()
+        if request_threshold_by_country and 'requestThresholdByCountry' not in self.config['general']:
+            try:
+                self.config['general']['requestThresholdByCountry'] = json.loads(request_threshold_by_country)
+            except ValueError:
+                self.log.error("[lambda_log_parser: configure_group_by] Invalid REQUEST_THRESHOLD_BY_COUNTRY %s"
+                               % request_threshold_by_country)
+                request_threshold_by_country = ''
+        self.group_by_dimensions = get_group_by_dimensions(
+            os.getenv('HTTP_FLOOD_ATHENA_GROUP_BY', 'None'), request_threshold_by_country)
+
+    def get_group_key(self, request_key, uri, line_data):
+        """
+        Composite counter key 'minute id ip': the dimension values are stored once in
+        group_key_list and the key only carries their index, so the IP stays last
+        """
+        http_request = line_data['httpRequest']
+        values = {'country': http_request.get('country'), 'uri': uri, 'method': http_request.get('httpMethod')}
+        group = tuple(values[d] for d in self.group_by_dimensions)
+
+        group_id = self.group_keys.get(group)
+        if group_id is None:
+            group_id = self.group_keys[group] = len(self.group_key_list)
+            self.group_key_list.append(group)
+
+        head, _, ip = request_key.rpartition(' ')
+        return '%s %d %s' % (head, group_id, ip)
+
+    def get_group_country(self, request_key_parts):
+        if 'country' not in self.group_by_dimensions or len(request_key_parts) < 3:
+            return None
+        group = self.group_key_list[int(request_key_parts[-2])]
+        return group[self.group_by_dimensions.index('country')]
+
+    def get_requester_threshold(self, k, threshold, country=None):
+        """
+        Threshold of a requester (IP or prefix): the one of its country (from the log
+        record, else from the GeoIP database), else of its ASN, else the general one
+        """
+        general = self.config['general']
+        if country is not None and country in (general.get(threshold + 'ByCountry') or {}):
+            return general[threshold + 'ByCountry'][country]
+        if self.geoip is not None:
+            location = self.geoip.lookup(k.split('/')[0])
+            if location is not None:
+                country, asn = location
+                by_country = general.get(threshold + 'ByCountry') or {}
+                by_asn = general.get(threshold + 'ByAsn') or {}
+                if country in by_country:
+                    return by_country[country]
+                if str(asn) in by_asn:
+                    return by_asn[str(asn)]
+        return general[threshold]
+
+    @staticmethod
+    def is_conditional_state_write():
+        return os.getenv('STATE_CONDITIONAL_WRITES', 'true').lower() == 'true'
+
+    @staticmethod
+    def get_state_shards():
+        """
+        Number of shards of the requester state, 0 keeps the state in a single object
+        """
+        return int(os.getenv('REQUESTER_STATE_SHARDS', '0'))
+
+    @staticmethod
+    def is_binary_state_format():
+        """
+        Whether the requester state is written in the binary format. JSON stays the default
+        for one release: the state keeps its *_log_out.json key, and a release that cannot
+        decode the binary state must still be able to read it after a rollback.
+        """
+        return os.getenv('REQUESTER_STATE_FORMAT', 'json').lower() == 'binary'
+
     @staticmethod
     def is_full_log():
         return os.getenv('BAD_BOT_LOG_PARSER', 'false') == 'false'
@@ -214,8 +439,10 @@ class LambdaLogParser(object):
         try:
             # Set restrictive file permissions (600 - owner read/write only)
             os.chmod(local_file_path, 0o600)
-            
-            self.s3_util.download_file_from_s3(bucket_name, key_name, local_file_path)
+
+            with self.stage_timer.stage('Download'):
+                self.s3_util.download_file_from_s3(bucket_name, key_name, local_file_path)
+            self.stage_timer.add_value('DownloadedBytes', os.path.getsize(local_file_path), 'Bytes')
 
             # --------------------------------------------------------------------------------------------------------------
             self.log.info("[lambda_log_parser: parse_log_file] Read file content")
@@ -237,14 +464,19 @@ class LambdaLogParser(object):
                                            threshold, utc_now_timestamp_str):
         for k, num_reqs in counter['general'].items():
             try:
-                k = k.split(' ')[-1]
-                if num_reqs >= self.config['general'][threshold]:
+                parts = k.split(' ')
+                k = parts[-1]
+                country = self.get_group_country(parts)
+                if num_reqs >= self.get_requester_threshold(k, threshold, country):
                     if k not in outstanding_requesters['general'].keys() or num_reqs > \
                             outstanding_requesters['general'][k]['max_counter_per_min']:
                         outstanding_requesters['general'][k] = {
                             'max_counter_per_min': num_reqs,
                             'updated_at': utc_now_timestamp_str
                         }
+                        # Kept in the state so the block is checked against the same threshold on merge
+                        if country is not None:
+                            outstanding_requesters['general'][k]['country'] = country
             except Exception:
                 self.log.error(
                     "[lambda_log_parser: get_general_outstanding_requesters] \
@@ -311,33 +543,11 @@ class LambdaLogParser(object):
     def get_current_blocked_ips(self, bucket_name, key_name, output_key_name):
         self.log.info(f"[get_current_blocked_ips] Processing source file: {key_name}")
         self.log.info(f"[get_current_blocked_ips] Downloading current blocked IPs from: {output_key_name}")
-        
-        # Use with statement to ensure proper resource management
-        with tempfile.NamedTemporaryFile(delete=False, suffix='_REMOTE.json') as temp_file:
-            local_file_path = temp_file.name
-        
-        try:
-            # Set restrictive file permissions (600 - owner read/write only)
-            os.chmod(local_file_path, 0o600)
-            
-            self.s3_util.download_file_from_s3(bucket_name, output_key_name, local_file_path)
 
-            remote_outstanding_requesters = {
-                'general': {},
-                'uriList': {}
-            }
-
-            with open(local_file_path, 'r') as file_content:
-                remote_outstanding_requesters = json.loads(file_content.read())
-
-            return remote_outstanding_requesters
-            
-        finally:
-            # Ensure cleanup even if exceptions occur
-            try:
-                os.unlink(local_file_path)
-            except OSError:
-                pass  # File may already be deleted
+        # The state is read in memory; both the binary and the legacy JSON formats are accepted
+        body, self.state_etag = self.s3_util.read_object(bucket_name, output_key_name)
+        self.stage_timer.set_value('StateReadBytes', len(body), 'Bytes')
+        return decode_state(body)
 
 
     def iterate_general_list_for_existing_ip(self, k, v, outstanding_requesters, utc_now_timestamp_str):
@@ -354,15 +564,14 @@ class LambdaLogParser(object):
 
     def iterate_general_list_for_new_ip(self, k, v, threshold, outstanding_requesters,
                                         utc_now_timestamp, force_update):
-        utc_prev_updated_at = datetime.datetime.strptime(v['updated_at'],
-            FORMAT_DATE_TIME).astimezone(datetime.timezone.utc)
+        utc_prev_updated_at = parse_updated_at(v['updated_at'])
         total_diff_min = ((utc_now_timestamp - utc_prev_updated_at).total_seconds()) / 60
 
-        if v['max_counter_per_min'] < self.config['general'][threshold]:
+        if v['max_counter_per_min'] < self.get_requester_threshold(k, threshold, v.get('country')):
             force_update = True
             self.log.info(
                 "[lambda_log_parser: merge_general_outstanding_requesters] \
-                %s is bellow the current general threshold" % k)
+                %s is bellow its current threshold" % k)
 
         elif total_diff_min < self.config['general']['blockPeriod']:
             self.log.debug("[merge_general_outstanding_requesters] Keeping %s in general" % k)
@@ -415,8 +624,7 @@ class LambdaLogParser(object):
 
     def iterate_urilist_for_new_uri(self, uri, k, v, threshold, utc_now_timestamp,
                                          outstanding_requesters, force_update):
-        utc_prev_updated_at = datetime.datetime.strptime(
-            v['updated_at'], FORMAT_DATE_TIME).astimezone(datetime.timezone.utc)
+        utc_prev_updated_at = parse_updated_at(v['updated_at'])
         total_diff_min = ((utc_now_timestamp - utc_prev_updated_at).total_seconds()) / 60
 
         if v['max_counter_per_min'] < self.config['uriList'][uri][threshold]:
@@ -464,7 +672,7 @@ class LambdaLogParser(object):
                 self.log.error(
                     "[lambda_log_parser: iterate_urilist] Error merging uriList (%s) %s rule" % (uri, k))
                 
-            return outstanding_requesters, force_update
+        return outstanding_requesters, force_update
     
     
     def merge_urilist_outstanding_requesters(self, threshold, remote_outstanding_requesters, outstanding_requesters,
@@ -499,6 +707,7 @@ class LambdaLogParser(object):
         need_update = False
 
         # Get metadata of object key_name
+        self.state_etag = None
         response = self.s3_util.get_head_object(bucket_name, output_key_name)
         if response is None:
             self.log.info("[lambda_log_parser: merge_outstanding_requesters] No file to be merged.")
@@ -537,35 +746,180 @@ class LambdaLogParser(object):
         return outstanding_requesters, need_update
 
 
-    def write_output(self, bucket_name, key_name, output_key_name, outstanding_requesters):
+    def encode_output(self, outstanding_requesters):
+        """
+        Body and content type of the state in the format in use
+        """
+        # The key name is kept for both formats so existing stacks and bucket policies keep working
+        if self.is_binary_state_format():
+            return encode_state(outstanding_requesters), 'application/octet-stream'
+        return encode_json_state(outstanding_requesters), 'application/json'
+
+    def write_output(self, bucket_name, key_name, output_key_name, outstanding_requesters,
+                     if_match=None, if_none_match=None):
+        """
+        Write the state. With if_match / if_none_match the write is conditional and
+        StateConflictError is raised when another invocation changed the state first.
+        """
         self.log.debug("[lambda_log_parser: write_output] Start")
+        self.state_etag_written = None
         self.log.info(f"[write_output] Writing results for source file: {key_name}")
         self.log.info(f"[write_output] Output destination: {output_key_name}")
 
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='_LOCAL.json') as temp_file:
-            current_data = temp_file.name
-            json.dump(outstanding_requesters, temp_file)
-        
         try:
-            # Set restrictive file permissions (600 - owner read/write only)
-            os.chmod(current_data, 0o600)
+            body, content_type = self.encode_output(outstanding_requesters)
+            self.stage_timer.set_value('StateWriteBytes', len(body), 'Bytes')
 
-            self.s3_util.upload_file_to_s3(current_data, bucket_name, output_key_name)
+            response = self.s3_util.put_object_body(bucket_name, output_key_name, body, content_type,
+                                                    if_match=if_match, if_none_match=if_none_match)
+            self.state_etag_written = response.get('ETag') if isinstance(response, dict) else None
 
         except Exception as e:
+            if is_precondition_error(e):
+                self.stage_timer.add_value('StateConflicts', 1)
+                raise StateConflictError(output_key_name) from e
             self.log.error(f"[lambda_log_parser: write_output] Error writing output file for source: {key_name}")
             self.log.error(e)
-            
-        finally:
-            # Ensure cleanup even if exceptions occur
-            try:
-                os.unlink(current_data)
-            except OSError:
-                pass  # File may already be deleted
 
         self.log.debug("[lambda_log_parser: write_output] End")
 
 
+    @on_exception(expo, StateConflictError,
+                  max_time=STATE_WRITE_MAX_TIME,
+                  jitter=full_jitter,
+                  max_tries=STATE_WRITE_MAX_TRIES,
+                  factor=0.1,
+                  on_backoff=count_state_write_retry)
+    def merge_and_write_state(self, bucket_name, key_name, log_type, output_key_name, outstanding_requesters):
+        """
+        Merge outstanding requesters into the current state and write it back, only
+        if nobody else wrote it since it was read (S3 If-Match / If-None-Match).
+        On conflict the state is re-read and the merge runs again on a fresh copy of
+        outstanding_requesters: merging is a union keeping the highest counters, so
+        the order in which concurrent invocations win does not change the result.
+        """
+        self.stage_timer.add_value('StateWriteAttempts', 1)
+        with self.stage_timer.stage('Merge'):
+            merged_requesters, need_update = self.merge_outstanding_requesters(
+                bucket_name, key_name, log_type, output_key_name, copy_requesters(outstanding_requesters))
+            self.stage_timer.track(outstanding_requesters=merged_requesters)
+
+        if need_update:
+            conditions = {}
+            if self.is_conditional_state_write():
+                conditions = {'if_match': self.state_etag} if self.state_etag else {'if_none_match': '*'}
+            with self.stage_timer.stage('WriteOutput'):
+                self.write_output(bucket_name, key_name, output_key_name, merged_requesters, **conditions)
+
+        return merged_requesters, need_update
+
+
+    def merge_and_write_sharded_state(self, bucket_name, key_name, log_type, output_key_name,
+                                      outstanding_requesters, shards):
+        """
+        Sharded variant of merge_and_write_state: the requesters are split by client
+        IP hash and only the shards they touch are read, merged and written back.
+        When any shard changed, compact_state assembles the unified requesters.
+        """
+        self.migrate_legacy_state(bucket_name, key_name, output_key_name, shards)
+
+        merged_shards = {}
+        need_update = False
+        for shard, requesters in sorted(split_requesters(outstanding_requesters, shards).items()):
+            shard_key = get_shard_key(output_key_name, shard)
+            merged_shards[shard], shard_need_update = self.merge_and_write_state(
+                bucket_name, key_name, log_type, shard_key, requesters)
+            if shard_need_update and self.state_etag_written is not None:
+                SHARD_CACHE[(bucket_name, shard_key)] = (self.state_etag_written, merged_shards[shard])
+            need_update = need_update or shard_need_update
+        self.stage_timer.set_value('StateShardsTouched', len(merged_shards))
+
+        if not need_update:
+            return union_requesters(merged_shards.values()), need_update
+        return self.compact_state(bucket_name, key_name, log_type, output_key_name, shards, merged_shards), need_update
+
+
+    def migrate_legacy_state(self, bucket_name, key_name, output_key_name, shards):
+        """
+        Move the entries of a single object state into their shards (create only), then
+        leave an empty state behind so the migration runs once.
+        """
+        empty_state, content_type = self.encode_output({'general': {}, 'uriList': {}})
+        response = self.s3_util.get_head_object(bucket_name, output_key_name)
+        if response is None or response.get('ContentLength', 0) <= len(empty_state):
+            return
+
+        self.log.info("[migrate_legacy_state] Splitting %s into %d shards" % (output_key_name, shards))
+        legacy_requesters = self.get_current_blocked_ips(bucket_name, key_name, output_key_name)
+        for shard, requesters in split_requesters(legacy_requesters, shards).items():
+            shard_key = get_shard_key(output_key_name, shard)
+            try:
+                self.write_output(bucket_name, key_name, shard_key, requesters, if_none_match='*')
+            except StateConflictError:
+                self.log.info("[migrate_legacy_state] %s already exists, legacy entries skipped" % shard_key)
+        self.s3_util.put_object_body(bucket_name, output_key_name, empty_state, content_type)
+
+
+    def compact_state(self, bucket_name, key_name, log_type, output_key_name, shards, merged_shards=None):
+        """
+        Assemble the unified outstanding requesters of every shard for update_ip_set.
+        merged_shards holds the shards this invocation just wrote. The ETags of the
+        others come from a single listing of the shard keys; they are reused from
+        SHARD_CACHE when their ETag did not change, and have their expired entries
+        dropped. A shard losing entries is written back if nobody changed it in the
+        meantime (a conflict is left to the next compaction).
+        """
+        parts = dict(merged_shards or {})
+        threshold = 'requestThreshold' if log_type == 'waf' else "errorThreshold"
+        downloads = 0
+
+        with self.stage_timer.stage('Compact'):
+            listing = self.s3_util.list_objects(bucket_name, get_shard_prefix(output_key_name)) \
+                if len(parts) < shards else {}
+            for shard in range(shards):
+                if shard in parts:
+                    continue
+                shard_key = get_shard_key(output_key_name, shard)
+                response = listing.get(shard_key)
+                if response is None:
+                    continue
+
+                cached = SHARD_CACHE.get((bucket_name, shard_key))
+                if cached and response.get('ETag') and cached[0] == response.get('ETag'):
+                    etag, remote_requesters = cached
+                else:
+                    remote_requesters = self.get_current_blocked_ips(bucket_name, key_name, shard_key)
+                    etag = self.state_etag
+                    downloads += 1
+
+                utc_now_timestamp, utc_now_timestamp_str, _ = self.calculate_last_update_age(response)
+                kept_requesters = {'general': {}, 'uriList': {}}
+                if 'general' in remote_requesters:
+                    self.merge_general_outstanding_requesters(
+                        threshold, remote_requesters, kept_requesters, utc_now_timestamp_str, utc_now_timestamp, False)
+                if 'uriList' in remote_requesters:
+                    kept_requesters, _ = self.merge_urilist_outstanding_requesters(
+                        threshold, remote_requesters, kept_requesters, utc_now_timestamp_str, utc_now_timestamp, False)
+
+                expired = self.get_counter_cardinality(remote_requesters) - \
+                    self.get_counter_cardinality(kept_requesters)
+                if expired > 0:
+                    self.stage_timer.add_value('StateEntriesExpired', expired)
+                    conditions = {'if_match': etag} if self.is_conditional_state_write() and etag else {}
+                    try:
+                        self.write_output(bucket_name, key_name, shard_key, kept_requesters, **conditions)
+                        etag = self.state_etag_written
+                    except StateConflictError:
+                        self.log.info("[compact_state] %s changed during compaction" % shard_key)
+                        etag = None
+                if etag:
+                    SHARD_CACHE[(bucket_name, shard_key)] = (etag, kept_requesters)
+                parts[shard] = kept_requesters
+
+        self.stage_timer.set_value('StateShardsDownloaded', downloads)
+        return union_requesters(parts.values())
+
+
     def merge_lists(self, outstanding_requesters):
         self.log.debug("[lambda_log_parser: merge_lists] Start to merge general and uriList into a single list")
 
@@ -581,42 +935,65 @@ class LambdaLogParser(object):
         return unified_outstanding_requesters
 
 
-    def truncate_list(self, unified_outstanding_requesters):
+    @staticmethod
+    def get_requester_priority(entry, cache=None):
+        """
+        Severity of a blocked requester: highest request rate first, most recent first on ties
+        """
+        return int(float(entry['max_counter_per_min'])), to_epoch_seconds(entry['updated_at'], cache)
+
+
+    def rank_requesters(self, unified_outstanding_requesters, limit=None):
+        """
+        Unified requesters in severity order, only the `limit` most severe when given
+        """
+        cache = {}
+        return dict(select_top_k(
+            unified_outstanding_requesters.items(),
+            len(unified_outstanding_requesters) if limit is None else limit,
+            key=lambda kv: self.get_requester_priority(kv[1], cache)))
+
+
+    def truncate_list(self, unified_outstanding_requesters, ip_range_limit=None):
         self.log.debug("[lambda_log_parser: truncate_list] " +
                        "Start to truncate [if necessary] list to respect WAF ip range limit")
 
-        ip_range_limit = int(os.getenv('LIMIT_IP_ADDRESS_RANGES_PER_IP_MATCH_CONDITION'))
+        if ip_range_limit is None:
+            ip_range_limit = int(os.getenv('LIMIT_IP_ADDRESS_RANGES_PER_IP_MATCH_CONDITION'))
         if len(unified_outstanding_requesters) > ip_range_limit:
-            ordered_unified_outstanding_requesters = sorted(
-                unified_outstanding_requesters.items(),
-                key=lambda kv: kv[1]['max_counter_per_min'], reverse=True)
-            unified_outstanding_requesters = {}
-            for key, value in ordered_unified_outstanding_requesters:
-                if counter < ip_range_limit:
-                    unified_outstanding_requesters[key] = value
-                    counter += 1
-                else:
-                    break
+            self.stage_timer.set_value('RequestersTruncated', len(unified_outstanding_requesters) - ip_range_limit)
+            unified_outstanding_requesters = self.rank_requesters(unified_outstanding_requesters, ip_range_limit)
 
         self.log.debug("[lambda_log_parser: truncate_list] End")
         return unified_outstanding_requesters 
 
 
+    def get_allowlist(self):
+        if self.allowlist is None:
+            self.allowlist = get_allowlist_index(self.log, self.scope, self.waflib)
+        return self.allowlist
+
+
     def build_ip_list_to_block(self, unified_outstanding_requesters):
         self.log.debug("[lambda_log_parser: truncate_list] Start to build list of ips to be blocked")
 
         addresses_v4 = []
         addresses_v6 = []
+        allowlist = self.get_allowlist()
+        allowlisted = 0
 
         for k in unified_outstanding_requesters.keys():
             ip_type = self.waflib.which_ip_version(self.log, k)
             source_ip = self.waflib.set_ip_cidr(self.log, k)
 
-            if ip_type == "IPV4":
+            if allowlist.covers(source_ip):
+                allowlisted += 1
+            elif ip_type == "IPV4":
                 addresses_v4.append(source_ip)
             elif ip_type == "IPV6":
                 addresses_v6.append(source_ip)
 
+        self.stage_timer.add_value('AllowlistedSkipped', allowlisted)
         self.log.debug("[lambda_log_parser: truncate_list] End")
         return addresses_v4, addresses_v6
  
@@ -633,6 +1010,7 @@ class LambdaLogParser(object):
         ipset_name_v6 = None
         ipset_arn_v4 = None
         ipset_arn_v6 = None
+        ip_set_key = None
 
         # switch if type of IPSets are HTTP_FLOOD
         if ip_set_type == self.flood:
@@ -640,17 +1018,24 @@ class LambdaLogParser(object):
             ipset_name_v6 = os.getenv('IP_SET_NAME_HTTP_FLOODV6')
             ipset_arn_v4 = os.getenv('IP_SET_ID_HTTP_FLOODV4')
             ipset_arn_v6 = os.getenv('IP_SET_ID_HTTP_FLOODV6')
+            ip_set_key = 'HTTP_FLOOD'
         elif ip_set_type == self.scanners:
             ipset_name_v4 = os.getenv('IP_SET_NAME_SCANNERS_PROBESV4')
             ipset_name_v6 = os.getenv('IP_SET_NAME_SCANNERS_PROBESV6')
             ipset_arn_v4 = os.getenv('IP_SET_ID_SCANNERS_PROBESV4')
             ipset_arn_v6 = os.getenv('IP_SET_ID_SCANNERS_PROBESV6')
+            ip_set_key = 'SCANNERS_PROBES'
 
         counter = 0
         try:
             if ipset_arn_v4 == None or ipset_arn_v6 == None:
                 self.log.info("[update_ip_set] Ignore process when ip_set_id is None")
                 return
+
+            # Each IPSet may be backed by shard IPSets, which multiply its capacity
+            shards_v4 = get_ip_set_shards(ipset_name_v4, ipset_arn_v4, ip_set_key + 'V4')
+            shards_v6 = get_ip_set_shards(ipset_name_v6, ipset_arn_v6, ip_set_key + 'V6')
+            ip_range_limit = int(os.getenv('LIMIT_IP_ADDRESS_RANGES_PER_IP_MATCH_CONDITION'))
             
             # --------------------------------------------------------------------------------------------------------------
             self.log.info("[update_ip_set] Merge general and uriList into a single list")
@@ -660,22 +1045,42 @@ class LambdaLogParser(object):
             # --------------------------------------------------------------------------------------------------------------
             self.log.info("[update_ip_set] Truncate [if necessary] list to respect WAF limit")
             # --------------------------------------------------------------------------------------------------------------
-            unified_outstanding_requesters = self.truncate_list(unified_outstanding_requesters)
+            aggregation_policy = self.waflib.aggregation_policy
+            if aggregation_policy is None:
+                unified_outstanding_requesters = self.truncate_list(
+                    unified_outstanding_requesters, ip_range_limit * max(len(shards_v4), len(shards_v6)))
+            else:
+                # Aggregated CIDRs are truncated instead, most aggressive requesters first
+                unified_outstanding_requesters = self.rank_requesters(unified_outstanding_requesters)
 
             # --------------------------------------------------------------------------------------------------------------
             self.log.info("[update_ip_set] Block remaining outstanding requesters")
             # --------------------------------------------------------------------------------------------------------------
             addresses_v4, addresses_v6 = self.build_ip_list_to_block(unified_outstanding_requesters)
-
-            self.log.info("[update_ip_set] Changes in WAF IP set v4")
-            self.waflib.update_ip_set(self.log, self.scope, ipset_name_v4, ipset_arn_v4, addresses_v4)
+            if aggregation_policy is not None:
+                self.stage_timer.set_value('BlockedAddresses', len(addresses_v4) + len(addresses_v6))
+                addresses_v4 = self.waflib.merge_and_truncate_addresses(
+                    self.log, addresses_v4, [], ip_range_limit * len(shards_v4))
+                addresses_v6 = self.waflib.merge_and_truncate_addresses(
+                    self.log, addresses_v6, [], ip_range_limit * len(shards_v6))
+
+            self.stage_timer.set_value('IPSetSizeV4', len(addresses_v4))
+            self.stage_timer.set_value('IPSetSizeV6', len(addresses_v6))
+
+            self.log.info("[update_ip_set] Changes in WAF IP sets v4 and v6")
+            ip_sets = [(shards_v4, addresses_v4), (shards_v6, addresses_v6)]
+            self.detection_latency.api_started()
+            if self.intent_queue is not None:
+                # The IP set writer records the latency up to the IP set write
+                self.submit_ip_set_intents('replace', ip_sets, ip_range_limit)
+            else:
+                with self.stage_timer.stage('WAFUpdate'):
+                    result_v4, result_v6 = self.waflib.sync_sharded_ip_sets(self.log, self.scope, ip_sets,
+                                                                            ip_range_limit)
+                self.detection_latency.api_completed()
+                record_ip_set_sync(self.stage_timer, result_v4, 'V4')
+                record_ip_set_sync(self.stage_timer, result_v6, 'V6')
             self.log.info("[update_ip_set]  IPSet %s with %d IP addresses v4", ipset_name_v4, len(addresses_v4))
-
-            # Sleep for a few seconds to mitigate AWS WAF Update API call throttling issue
-            sleep(self.delay_between_updates)
-
-            self.log.info("[update_ip_set] Changes in WAF IP set v6")
-            self.waflib.update_ip_set(self.log, self.scope, ipset_name_v6, ipset_arn_v6, addresses_v6)
             self.log.info("[update_ip_set]  IPSet %s with %d IP addresses v6", ipset_name_v6, len(addresses_v6))
 
         except Exception as error:
@@ -686,48 +1091,105 @@ class LambdaLogParser(object):
         return counter
 
 
-    def process_log_file(self, bucket_name, key_name, conf_filename, output_filename, log_type, ip_set_type):
-        self.log.debug("[lambda_log_parser: process_log_file] Start")
-       
-        # --------------------------------------------------------------------------------------------------------------
-        self.log.info("[lambda_log_parser: process_log_file] Reading input data and get outstanding requesters")
-        # --------------------------------------------------------------------------------------------------------------
-        self.config = self.s3_util.read_json_config_file_from_s3(bucket_name, conf_filename)
-        counter, outstanding_requesters, bad_bot_ips = self.parse_log_file(bucket_name, key_name, log_type)
-
-        is_requesters_update = False
+    def submit_ip_set_intents(self, action, ip_sets, limit):
+        """
+        Queue the changes of (shards, addresses) IP sets for the IP set writer, one intent per
+        shard. A replace covers every shard, its addresses spread as sync_sharded_ip_sets does;
+        an add only the shards receiving addresses.
+        """
+        submitted = 0
+        with self.stage_timer.stage('IntentSubmit'):
+            for shards, addresses in ip_sets:
+                if action == 'replace':
+                    parts = self.waflib.spread_addresses(addresses, len(shards), limit)
+                else:
+                    parts = self.waflib.shard_addresses(addresses, len(shards))
+                for (name, arn), part in zip(shards, parts):
+                    if part or action == 'replace':
+                        submit_intent(self.intent_queue, self.scope, name, arn, action, part[:limit], limit,
+                                      detected_at=self.detection_latency.newest_record_at)
+                        submitted += 1
+        self.stage_timer.add_value('IPSetIntentsSubmitted', submitted)
 
-        if not self.is_empty_counter(counter):
-            outstanding_requesters = self.get_outstanding_requesters(log_type, counter, outstanding_requesters)
-            outstanding_requesters, need_update = self.merge_outstanding_requesters(
-                bucket_name, key_name, log_type, output_filename, outstanding_requesters)
 
-            is_requesters_update = need_update
+    def process_log_file(self, bucket_name, key_name, conf_filename, output_filename, log_type, ip_set_type,
+                         event_time=None):
+        self.log.debug("[lambda_log_parser: process_log_file] Start")
+        self.stage_timer = StageTimer(self.log, 'LambdaLogParser')
+        self.detection_latency = DetectionLatency()
+        self.detection_latency.set_event_time(event_time)
+        self.newest_record_time = None
 
-            if need_update:
+        try:
+            # --------------------------------------------------------------------------------------------------------------
+            self.log.info("[lambda_log_parser: process_log_file] Reading input data and get outstanding requesters")
+            # --------------------------------------------------------------------------------------------------------------
+            with self.stage_timer.stage('ReadConfig'):
+                self.config = self.s3_util.read_json_config_file_from_s3(bucket_name, conf_filename)
+                self.configure_enrichment()
+                self.configure_group_by(log_type)
+                self.configure_log_filters(log_type)
+            counter, outstanding_requesters, bad_bot_ips = self.parse_log_file(bucket_name, key_name, log_type)
+            self.detection_latency.newest_record_at = self.get_newest_record_epoch(log_type)
+            self.stage_timer.add_rate('LinesPerSecond', self.stage_timer.get_value('LinesProcessed'), 'Parse')
+
+            if not self.is_empty_counter(counter):
+                self.stage_timer.set_value('CounterCardinality', self.get_counter_cardinality(counter))
+                if self.group_by_dimensions:
+                    self.stage_timer.set_value('CounterGroups', len(self.group_key_list))
+                lookups = self.geoip.get_cache_info() if self.geoip is not None else None
+                with self.stage_timer.stage('Threshold'):
+                    outstanding_requesters = self.get_outstanding_requesters(log_type, counter, outstanding_requesters)
+                if lookups is not None:
+                    cache_info = self.geoip.get_cache_info()
+                    self.stage_timer.set_value('GeoIPLookups', cache_info.misses - lookups.misses)
+                    self.stage_timer.set_value('GeoIPCacheHits', cache_info.hits - lookups.hits)
                 # ----------------------------------------------------------------------------------------------------------
-                self.log.info("[process_log_file] Update new blocked requesters list to S3")
+                self.log.info("[process_log_file] Merge and update blocked requesters list in S3")
                 # ----------------------------------------------------------------------------------------------------------
-                self.write_output(bucket_name, key_name, output_filename, outstanding_requesters)
+                shards = self.get_state_shards()
+                try:
+                    if shards > 0:
+                        outstanding_requesters, need_update = self.merge_and_write_sharded_state(
+                            bucket_name, key_name, log_type, output_filename, outstanding_requesters, shards)
+                    else:
+                        outstanding_requesters, need_update = self.merge_and_write_state(
+                            bucket_name, key_name, log_type, output_filename, outstanding_requesters)
+                except StateConflictError:
+                    self.stage_timer.add_value('StateWriteFailures', 1)
+                    self.log.error("[process_log_file] Gave up writing %s after %d conflicting writes"
+                                   % (output_filename, STATE_WRITE_MAX_TRIES))
+                    raise
+                self.stage_timer.set_value('OutstandingRequesters', self.get_counter_cardinality(outstanding_requesters))
+
+                if need_update:
+                    # ----------------------------------------------------------------------------------------------------------
+                    self.log.info("[process_log_file] Update WAF IP Set")
+                    # ----------------------------------------------------------------------------------------------------------
+                    self.update_ip_set(ip_set_type, outstanding_requesters)
 
-                # ----------------------------------------------------------------------------------------------------------
-                self.log.info("[process_log_file] Update WAF IP Set")
-                # ----------------------------------------------------------------------------------------------------------
-                self.update_ip_set(ip_set_type, outstanding_requesters)
+                else:
+                    # ----------------------------------------------------------------------------------------------------------
+                    self.log.info("[process_log_file] No changes identified")
+                    # ----------------------------------------------------------------------------------------------------------
 
-            else:
-                # ----------------------------------------------------------------------------------------------------------
-                self.log.info("[process_log_file] No changes identified")
-                # ----------------------------------------------------------------------------------------------------------
+            if bad_bot_ips:
+                self.bad_bot_ips_to_ip_set(bad_bot_ips)
 
-        if bad_bot_ips:
-            if is_requesters_update:
-                # Sleep for a few seconds to mitigate AWS WAF Update API call throttling issue
-                sleep(self.delay_between_updates)
-            self.bad_bot_ips_to_ip_set(bad_bot_ips)
+        finally:
+            self.detection_latency.newest_record_at = self.get_newest_record_epoch(log_type)
+            self.detection_latency.record(self.stage_timer)
+            self.stage_timer.publish(LogType=log_type)
 
         self.log.debug('[process_log_file] End')
 
+    @staticmethod
+    def get_counter_cardinality(counter):
+        """
+        Number of distinct keys held by a counter or an outstanding requesters dict
+        """
+        return len(counter.get('general', {})) + sum(len(v) for v in counter.get('uriList', {}).values())
+
     def is_empty_counter(self, counter):
         is_empty_counter = not counter['general'] and not counter['uriList']
         self.log.info("[process_log_file] is_counter_empty  %s " % is_empty_counter)
@@ -739,10 +1201,27 @@ class LambdaLogParser(object):
         ipset_arn_v4 = os.getenv('IP_SET_ID_BAD_BOTV4')
         ipset_arn_v6 = os.getenv('IP_SET_ID_BAD_BOTV6')
         limit = int(os.getenv('LIMIT_IP_ADDRESS_RANGES_PER_IP_MATCH_CONDITION', 10000))
+        shards_v4 = get_ip_set_shards(ipset_name_v4, ipset_arn_v4, 'BAD_BOTV4')
+        shards_v6 = get_ip_set_shards(ipset_name_v6, ipset_arn_v6, 'BAD_BOTV6')
+        capacity = limit * max(len(shards_v4), len(shards_v6), 1)
 
         addresses_v4 = []
         addresses_v6 = []
 
+        allowlist = self.get_allowlist()
+        if len(allowlist):
+            allowed = len(ips)
+            ips = [ip for ip in ips if not allowlist.covers(ip)]
+            self.stage_timer.add_value('AllowlistedSkipped', allowed - len(ips))
+
+        hits = {}
+        for position, ip in enumerate(ips):
+            hits[ip] = (hits.get(ip, (0, 0))[0] + 1, position)
+        if len(hits) > capacity:
+            # Keep the bots with the most hits, most recent first on ties
+            self.stage_timer.set_value('BadBotIPsTruncated', len(hits) - capacity)
+            ips = [ip for ip, _ in select_top_k(hits.items(), capacity, key=lambda kv: kv[1])]
+
         for k in ips:
             ip_type = self.waflib.which_ip_version(self.log, k)
             source_ip = self.waflib.set_ip_cidr(self.log, k)
@@ -752,13 +1231,21 @@ class LambdaLogParser(object):
             elif ip_type == "IPV6":
                 addresses_v6.append(source_ip)
 
-        if addresses_v4:
-            self.log.info("[Bad bot update_ip_set] Changes in WAF IP set V4")
-            self.waflib.patch_ip_set(self.log, self.scope, ipset_name_v4, ipset_arn_v4, addresses_v4, limit)
-            self.log.info("[Bad bot update_ip_set]  IPSet %s with %d IP addresses v4", ipset_name_v4, len(addresses_v4))
-            sleep(self.delay_between_updates)
+        self.stage_timer.set_value('BadBotIPs', len(addresses_v4) + len(addresses_v6))
 
-        if addresses_v6:
-            self.log.info("[Bad bot update_ip_set] Changes in WAF IP set V6")
-            self.waflib.patch_ip_set(self.log, self.scope, ipset_name_v6, ipset_arn_v6, addresses_v6, limit)
+        ip_sets = [(shards, addresses) for shards, addresses in (
+            (shards_v4, addresses_v4),
+            (shards_v6, addresses_v6)) if addresses]
+
+        if ip_sets:
+            self.log.info("[Bad bot update_ip_set] Changes in WAF IP sets")
+            self.detection_latency.api_started()
+            if self.intent_queue is not None:
+                self.submit_ip_set_intents('add', ip_sets, limit)
+            else:
+                with self.stage_timer.stage('WAFBadBotUpdate'):
+                    results = self.waflib.patch_sharded_ip_sets(self.log, self.scope, ip_sets, limit)
+                self.detection_latency.api_completed()
+                self.stage_timer.add_value('IPSetUpdateErrors', sum(1 for result in results if result['Error']))
+            self.log.info("[Bad bot update_ip_set]  IPSet %s with %d IP addresses v4", ipset_name_v4, len(addresses_v4))
             self.log.info("[Bad bot update_ip_set]  IPSet %s with %d IP addresses v6", ipset_name_v6, len(addresses_v6))
@@ -9,6 +9,8 @@ from lib.solution_metrics import send_metrics
 from lib.cw_metrics_util import WAFCloudWatchMetrics
 from lambda_log_parser import LambdaLogParser
 from athena_log_parser import AthenaLogParser
+from expiry_sweeper import ExpirySweeper, RESOURCE_TYPE as EXPIRY_SWEEPER_RESOURCE_TYPE
+from ip_set_intents import IPSetIntentWriter, SQSEventBatch, is_intent_event
 from aws_lambda_powertools import Logger, Tracer
 
 logger = Logger(
@@ -36,7 +38,19 @@ def lambda_handler(event, _):
         # ----------------------------------------------------------
         athena_log_parser = AthenaLogParser(logger)
 
-        if "resourceType" in event:
+        if event.get('resourceType') == EXPIRY_SWEEPER_RESOURCE_TYPE:
+            ExpirySweeper(logger).sweep()
+            result['message'] = "[lambda_handler] Expiry sweeper event processed."
+            logger.info(result['message'])
+
+        elif is_intent_event(event):
+            intent_batch = SQSEventBatch(event['Records'])
+            IPSetIntentWriter(logger, intent_batch, WAFLIBv2()).run()
+            result.update(intent_batch.batch_response())
+            result['message'] = "[lambda_handler] IP set intents processed."
+            logger.info(result['message'])
+
+        elif "resourceType" in event:
             athena_log_parser.process_athena_scheduler_event(event)
             result['message'] = "[lambda_handler] Athena scheduler event processed."
             logger.info(result['message'])
@@ -61,10 +75,11 @@ def lambda_handler(event, _):
 def process_record(r, log, result, athena_log_parser, lambda_log_parser):
     bucket_name = r['s3']['bucket']['name']
     key_name = unquote_plus(r['s3']['object']['key'])
+    event_time = r.get('eventTime')
 
     if 'APP_ACCESS_LOG_BUCKET' in environ and bucket_name == os.getenv('APP_ACCESS_LOG_BUCKET'):
         if key_name.startswith('athena_results/'):
-            athena_log_parser.process_athena_result(bucket_name, key_name, scanners)
+            athena_log_parser.process_athena_result(bucket_name, key_name, scanners, event_time)
             result['message'] = "[lambda_handler] Athena app log query result processed."
             log.info(result['message'])
 
@@ -72,13 +87,14 @@ def process_record(r, log, result, athena_log_parser, lambda_log_parser):
             conf_filename = os.getenv('STACK_NAME') + '-app_log_conf.json'
             output_filename = os.getenv('STACK_NAME') + '-app_log_out.json'
             log_type = os.getenv('LOG_TYPE')
-            lambda_log_parser.process_log_file(bucket_name, key_name, conf_filename, output_filename, log_type, scanners)
+            lambda_log_parser.process_log_file(bucket_name, key_name, conf_filename, output_filename, log_type, scanners,
+                                               event_time)
             result['message'] = "[lambda_handler] App access log file processed."
             log.info(result['message'])
 
     elif 'WAF_ACCESS_LOG_BUCKET' in environ and bucket_name == os.getenv('WAF_ACCESS_LOG_BUCKET'):
         if key_name.startswith('athena_results/'):
-            athena_log_parser.process_athena_result(bucket_name, key_name, flood)
+            athena_log_parser.process_athena_result(bucket_name, key_name, flood, event_time)
             result['message'] = "[lambda_handler] Athena AWS WAF log query result processed."
             log.info(result['message'])
 
@@ -86,7 +102,8 @@ def process_record(r, log, result, athena_log_parser, lambda_log_parser):
             conf_filename = os.getenv('STACK_NAME') + '-waf_log_conf.json'
             output_filename = os.getenv('STACK_NAME') + '-waf_log_out.json'
             log_type = 'waf'
-            lambda_log_parser.process_log_file(bucket_name, key_name, conf_filename, output_filename, log_type, flood)
+            lambda_log_parser.process_log_file(bucket_name, key_name, conf_filename, output_filename, log_type, flood,
+                                               event_time)
             result['message'] = "[lambda_handler] AWS WAF access log file processed."
             log.info(result['message'])
 
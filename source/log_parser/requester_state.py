@@ -0,0 +1,266 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Serialization of the outstanding requesters state kept in S3 between log parser
+invocations ({'general': {ip: entry}, 'uriList': {uri: {ip: entry}}} where an
+entry is {'max_counter_per_min': int, 'updated_at': ...}, plus the 'country' it
+was counted in when the requests are grouped by country).
+
+The binary format is versioned and zlib compressed:
+
+    header   MAGIC (4 bytes) | version (1 byte) | codec (1 byte)
+    payload  section 'general', then uri count (uint32) and one
+             (uri length (uint16) | uri (utf-8) | section) per uri
+    section  entry count (uint32) and, per entry:
+             key kind (1 byte) | key | max_counter_per_min (uint32) | updated_at (uint32 epoch seconds) |
+             country length (1 byte, 0 when unknown) | country (utf-8)
+
+Version 1 entries have no country and are still decoded.
+
+IPv4 and IPv6 keys are stored as packed 4 and 16 byte integers, any other key
+(or an IP whose text form is not canonical) is stored as a utf-8 string so that
+decoding always returns the original keys.
+
+decode_state also accepts the legacy JSON state, which migrates transparently
+on the next write. Decoded entries carry updated_at as epoch seconds; legacy
+entries and freshly computed ones carry FORMAT_DATE_TIME strings. Use
+parse_updated_at to read either.
+"""
+
+import json
+import zlib
+import struct
+import socket
+import datetime
+
+FORMAT_DATE_TIME = "%Y-%m-%d %H:%M:%S %Z%z"
+
+STATE_MAGIC = b'WSRS'
+STATE_VERSION = 2
+SUPPORTED_STATE_VERSIONS = (1, 2)
+CODEC_ZLIB = 1
+COMPRESSION_LEVEL = 6
+
+KEY_STRING = 0
+KEY_IPV4 = 4
+KEY_IPV6 = 6
+
+HEADER = struct.Struct('<4sBB')
+COUNT = struct.Struct('<I')
+STRING_LENGTH = struct.Struct('<H')
+VALUES = struct.Struct('<II')
+COUNTRY_LENGTH = struct.Struct('<B')
+
+
+def is_binary_state(body):
+    return body[:len(STATE_MAGIC)] == STATE_MAGIC
+
+
+def to_epoch_seconds(updated_at, cache=None):
+    """
+    Epoch seconds of an updated_at value (epoch seconds or FORMAT_DATE_TIME string).
+    `cache` memoizes parsed strings: all entries of one invocation share the same string.
+    """
+    if isinstance(updated_at, (int, float)):
+        return int(updated_at)
+    if cache is not None and updated_at in cache:
+        return cache[updated_at]
+    epoch = int(datetime.datetime.strptime(updated_at, FORMAT_DATE_TIME).timestamp())
+    if cache is not None:
+        cache[updated_at] = epoch
+    return epoch
+
+
+def parse_updated_at(updated_at):
+    """
+    UTC datetime of an updated_at value (epoch seconds or FORMAT_DATE_TIME string)
+    """
+    if isinstance(updated_at, (int, float)):
+        return datetime.datetime.fromtimestamp(updated_at, datetime.timezone.utc)
+    return datetime.datetime.strptime(updated_at, FORMAT_DATE_TIME).astimezone(datetime.timezone.utc)
+
+
+def format_updated_at(updated_at):
+    """
+    FORMAT_DATE_TIME string of an updated_at value, as written in the legacy JSON state
+    """
+    if isinstance(updated_at, (int, float)):
+        return datetime.datetime.fromtimestamp(updated_at, datetime.timezone.utc).strftime(FORMAT_DATE_TIME)
+    return updated_at
+
+
+def pack_key(key):
+    for kind, family in ((KEY_IPV4, socket.AF_INET), (KEY_IPV6, socket.AF_INET6)):
+        try:
+            packed = socket.inet_pton(family, key)
+        except (OSError, TypeError):
+            continue
+        if socket.inet_ntop(family, packed) == key:
+            return bytes((kind,)) + packed
+        break
+    encoded = key.encode('utf-8')
+    return bytes((KEY_STRING,)) + STRING_LENGTH.pack(len(encoded)) + encoded
+
+
+def encode_section(entries, pieces, cache):
+    pieces.append(COUNT.pack(len(entries)))
+    for key, entry in entries.items():
+        pieces.append(pack_key(key))
+        pieces.append(VALUES.pack(int(float(entry['max_counter_per_min'])),
+                                  to_epoch_seconds(entry['updated_at'], cache)))
+        country = (entry.get('country') or '').encode('utf-8')[:255]
+        pieces.append(COUNTRY_LENGTH.pack(len(country)))
+        pieces.append(country)
+
+
+def encode_state(outstanding_requesters):
+    """
+    Serialize outstanding requesters to the compressed binary state format
+    """
+    cache = {}
+    pieces = []
+    encode_section(outstanding_requesters.get('general', {}), pieces, cache)
+
+    uri_list = outstanding_requesters.get('uriList', {})
+    pieces.append(COUNT.pack(len(uri_list)))
+    for uri, entries in uri_list.items():
+        encoded = uri.encode('utf-8')
+        pieces.append(STRING_LENGTH.pack(len(encoded)))
+        pieces.append(encoded)
+        encode_section(entries, pieces, cache)
+
+    payload = zlib.compress(b''.join(pieces), COMPRESSION_LEVEL)
+    return HEADER.pack(STATE_MAGIC, STATE_VERSION, CODEC_ZLIB) + payload
+
+
+def decode_section(payload, offset, version=STATE_VERSION):
+    count, = COUNT.unpack_from(payload, offset)
+    offset += COUNT.size
+    entries = {}
+    for _ in range(count):
+        kind = payload[offset]
+        offset += 1
+        if kind == KEY_IPV4:
+            key = socket.inet_ntop(socket.AF_INET, payload[offset:offset + 4])
+            offset += 4
+        elif kind == KEY_IPV6:
+            key = socket.inet_ntop(socket.AF_INET6, payload[offset:offset + 16])
+            offset += 16
+        elif kind == KEY_STRING:
+            length, = STRING_LENGTH.unpack_from(payload, offset)
+            offset += STRING_LENGTH.size
+            key = payload[offset:offset + length].decode('utf-8')
+            offset += length
+        else:
+            raise ValueError("Unknown key kind %d in requester state" % kind)
+
+        max_counter_per_min, updated_at = VALUES.unpack_from(payload, offset)
+        offset += VALUES.size
+        entries[key] = {'max_counter_per_min': max_counter_per_min, 'updated_at': updated_at}
+        if version >= 2:
+            length, = COUNTRY_LENGTH.unpack_from(payload, offset)
+            offset += COUNTRY_LENGTH.size
+            if length:
+                entries[key]['country'] = payload[offset:offset + length].decode('utf-8')
+                offset += length
+    return entries, offset
+
+
+def decode_state(body):
+    """
+    Deserialize a binary or legacy JSON state into outstanding requesters
+    """
+    if not is_binary_state(body):
+        return json.loads(body)
+
+    _, version, codec = HEADER.unpack_from(body)
+    if version not in SUPPORTED_STATE_VERSIONS or codec != CODEC_ZLIB:
+        raise ValueError("Unsupported requester state version %d codec %d" % (version, codec))
+
+    payload = zlib.decompress(body[HEADER.size:])
+    general, offset = decode_section(payload, 0, version)
+
+    uri_count, = COUNT.unpack_from(payload, offset)
+    offset += COUNT.size
+    uri_list = {}
+    for _ in range(uri_count):
+        length, = STRING_LENGTH.unpack_from(payload, offset)
+        offset += STRING_LENGTH.size
+        uri = payload[offset:offset + length].decode('utf-8')
+        uri_list[uri], offset = decode_section(payload, offset + length, version)
+
+    return {'general': general, 'uriList': uri_list}
+
+
+def encode_json_state(outstanding_requesters):
+    """
+    Serialize outstanding requesters to the legacy JSON state format
+    """
+    return json.dumps({
+        'general': {k: dict(v, updated_at=format_updated_at(v['updated_at']))
+                    for k, v in outstanding_requesters.get('general', {}).items()},
+        'uriList': {uri: {k: dict(v, updated_at=format_updated_at(v['updated_at'])) for k, v in entries.items()}
+                    for uri, entries in outstanding_requesters.get('uriList', {}).items()}
+    }).encode('utf-8')
+
+
+class StateConflictError(Exception):
+    """
+    The state changed in S3 between the read and the conditional write
+    """
+    pass
+
+
+def copy_requesters(outstanding_requesters):
+    """
+    Copy of outstanding requesters down to the entries, which merges update in place
+    """
+    return {
+        'general': {k: dict(v) for k, v in outstanding_requesters.get('general', {}).items()},
+        'uriList': {uri: {k: dict(v) for k, v in entries.items()}
+                    for uri, entries in outstanding_requesters.get('uriList', {}).items()}
+    }
+
+
+def get_shard(ip, shards):
+    """
+    Shard of a client IP. crc32 is stable across processes, unlike hash().
+    """
+    return zlib.crc32(ip.encode('utf-8')) % shards
+
+
+def get_shard_prefix(output_key_name):
+    return output_key_name + '.shard-'
+
+
+def get_shard_key(output_key_name, shard):
+    return '%s%03d' % (get_shard_prefix(output_key_name), shard)
+
+
+def split_requesters(outstanding_requesters, shards):
+    """
+    Split outstanding requesters by client IP shard. Only shards holding at least
+    one entry are returned.
+    """
+    parts = {}
+    for k, v in outstanding_requesters.get('general', {}).items():
+        part = parts.setdefault(get_shard(k, shards), {'general': {}, 'uriList': {}})
+        part['general'][k] = v
+    for uri, entries in outstanding_requesters.get('uriList', {}).items():
+        for k, v in entries.items():
+            part = parts.setdefault(get_shard(k, shards), {'general': {}, 'uriList': {}})
+            part['uriList'].setdefault(uri, {})[k] = v
+    return parts
+
+
+def union_requesters(parts):
+    """
+    Assemble shards (whose IPs are disjoint) into one outstanding requesters dict
+    """
+    unified = {'general': {}, 'uriList': {}}
+    for part in parts:
+        unified['general'].update(part.get('general', {}))
+        for uri, entries in part.get('uriList', {}).items():
+            unified['uriList'].setdefault(uri, {}).update(entries)
+    return unified
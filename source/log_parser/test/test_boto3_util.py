@@ -0,0 +1,35 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import unittest
+from unittest.mock import Mock, patch
+from botocore.exceptions import ClientError
+from lib import boto3_util
+from lib.boto3_util import LazyClient, get_client, reset_clients
+from lib.waflibv2 import giveup_unless
+
+
+class TestLazyClients(unittest.TestCase):
+    def setUp(self):
+        reset_clients()
+
+    def tearDown(self):
+        reset_clients()
+
+    @patch('lib.boto3_util.create_client')
+    def test_client_is_created_on_first_use_and_shared(self, create_client):
+        create_client.side_effect = lambda service_name: Mock(service=service_name)
+        client = LazyClient('wafv2')
+        create_client.assert_not_called()
+
+        self.assertEqual(client.service, 'wafv2')
+        self.assertIs(get_client('wafv2'), LazyClient('wafv2').factory('wafv2'))
+        create_client.assert_called_once_with('wafv2')
+        self.assertEqual(list(boto3_util.CLIENTS), [('client', 'wafv2')])
+
+    def test_waf_errors_retried_by_code(self):
+        giveup = giveup_unless('WAFInternalErrorException')
+
+        self.assertFalse(giveup(ClientError({'Error': {'Code': 'WAFInternalErrorException'}}, 'GetIPSet')))
+        self.assertTrue(giveup(ClientError({'Error': {'Code': 'WAFNonexistentItemException'}}, 'GetIPSet')))
+        self.assertTrue(giveup(ValueError()))
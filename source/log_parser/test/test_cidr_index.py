@@ -0,0 +1,74 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import os
+import unittest
+from unittest.mock import Mock, patch
+from lib.cidr_index import CIDRIndex, get_allowlist_index, ALLOWLIST_INDEXES
+from lambda_log_parser import LambdaLogParser
+
+ALLOWLIST_ENV = {
+    'IP_SET_NAME_WHITELISTV4': 'WhitelistSetIPV4',
+    'IP_SET_ID_WHITELISTV4': 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/WhitelistSetIPV4/abcdef12',
+}
+
+
+class TestCIDRIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = CIDRIndex(['10.0.0.0/8', '10.1.2.0/24', '192.0.2.7/32', '2001:DB8::/32', 'not an ip'])
+
+    def test_longest_prefix_match(self):
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.lookup('10.1.2.3'), '10.1.2.0/24')
+        self.assertEqual(self.index.lookup('10.9.9.9/32'), '10.0.0.0/8')
+        self.assertEqual(self.index.lookup('10.1.0.0/16'), '10.0.0.0/8')
+        self.assertEqual(self.index.lookup('2001:db8:1::1'), '2001:db8::/32')
+        self.assertIsNone(self.index.lookup('192.0.2.8'))
+        # A range is only covered when all of it is allowlisted
+        self.assertFalse(self.index.covers('192.0.2.0/24'))
+        self.assertTrue(self.index.covers('192.0.2.7/32'))
+
+    def test_default_route(self):
+        self.assertTrue(CIDRIndex(['0.0.0.0/0']).covers('198.51.100.1'))
+        self.assertFalse(CIDRIndex(['0.0.0.0/0']).covers('2001:db8::1'))
+
+
+class TestAllowlistIndex(unittest.TestCase):
+    def setUp(self):
+        ALLOWLIST_INDEXES.clear()
+        self.waflib = Mock()
+        self.waflib.get_ip_set.return_value = {'IPSet': {'Addresses': ['192.0.2.0/24']}}
+
+    def test_not_configured(self):
+        self.assertEqual(len(get_allowlist_index(Mock(), 'REGIONAL', self.waflib)), 0)
+        self.waflib.get_ip_set.assert_not_called()
+
+    @patch.dict(os.environ, ALLOWLIST_ENV)
+    def test_cached_across_invocations(self):
+        get_allowlist_index(Mock(), 'REGIONAL', self.waflib, now=1000)
+        index = get_allowlist_index(Mock(), 'REGIONAL', self.waflib, now=1100)
+
+        self.assertTrue(index.covers('192.0.2.9'))
+        self.assertEqual(self.waflib.get_ip_set.call_count, 1)
+
+        get_allowlist_index(Mock(), 'REGIONAL', self.waflib, now=2000)
+        self.assertEqual(self.waflib.get_ip_set.call_count, 2)
+
+    @patch.dict(os.environ, ALLOWLIST_ENV)
+    def test_failed_read_is_not_cached(self):
+        self.waflib.get_ip_set.return_value = None
+
+        self.assertEqual(len(get_allowlist_index(Mock(), 'REGIONAL', self.waflib)), 0)
+        self.assertEqual(ALLOWLIST_INDEXES, {})
+
+    @patch.dict(os.environ, ALLOWLIST_ENV)
+    def test_build_ip_list_to_block_skips_allowlisted(self):
+        parser = LambdaLogParser(Mock())
+        parser.waflib.get_ip_set = self.waflib.get_ip_set
+
+        addresses_v4, addresses_v6 = parser.build_ip_list_to_block({
+            '192.0.2.1': {}, '198.51.100.1': {}, '2001:db8::1': {}})
+
+        self.assertEqual(addresses_v4, ['198.51.100.1/32'])
+        self.assertEqual(addresses_v6, ['2001:db8::1/128'])
+        self.assertEqual(parser.stage_timer.get_value('AllowlistedSkipped'), 1)
@@ -0,0 +1,37 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import unittest
+from unittest.mock import Mock
+from lambda_log_parser import LambdaLogParser
+
+
+class TestNewestRecordTime(unittest.TestCase):
+    def setUp(self):
+        self.log = Mock()
+        self.parser = LambdaLogParser(self.log)
+        self.parser.config = {'general': {'requestThreshold': 100, 'errorCodes': ['400']}}
+
+    def read_lines(self, lines, log_type):
+        counter = {'general': {}, 'uriList': {}}
+        for line in lines:
+            self.parser.read_contents(line, log_type, {}, counter, [])
+
+    def test_waf_newest_record(self):
+        lines = [json.dumps({'timestamp': ts, 'httpRequest': {'clientIp': '192.0.2.1', 'uri': '/'}}).encode('utf-8')
+                 for ts in (1616163600000, 1616163660500, 1616163630000)]
+        self.read_lines(lines, 'waf')
+
+        self.assertEqual(self.parser.get_newest_record_epoch('waf'), 1616163660.5)
+
+    def test_alb_newest_record(self):
+        lines = [('http %s app/lb/50dc6c495c0c9188 192.0.2.1:46532 10.0.0.100:80 0.000 0.001 0.000 200 200 '
+                  '34 366 "GET https://example.com:443/test HTTP/1.1"' % ts).encode('utf-8')
+                 for ts in ('2021-03-19T14:59:00.123456Z', '2021-03-19T15:00:00.000000Z')]
+        self.read_lines(lines, 'alb')
+
+        self.assertEqual(self.parser.get_newest_record_epoch('alb'), 1616166000.0)
+
+    def test_no_records(self):
+        self.assertIsNone(self.parser.get_newest_record_epoch('cloudfront'))
@@ -0,0 +1,161 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import json
+import hashlib
+import datetime
+import unittest
+from unittest.mock import Mock, patch
+from botocore.exceptions import ClientError
+import expiry_sweeper
+from expiry_sweeper import ExpirySweeper, ExpiryIndex
+from requester_state import encode_state, decode_state
+
+NOW = 1742464800
+BLOCK_PERIOD = 240
+ENV = {
+    'STACK_NAME': 'stack',
+    'WAF_ACCESS_LOG_BUCKET': 'waf-bucket',
+    'IP_SET_NAME_HTTP_FLOODV4': 'floodv4', 'IP_SET_ID_HTTP_FLOODV4': 'arn:floodv4/id4',
+    'IP_SET_NAME_HTTP_FLOODV6': 'floodv6', 'IP_SET_ID_HTTP_FLOODV6': 'arn:floodv6/id6',
+}
+
+
+def entry(age_minutes):
+    return {'max_counter_per_min': 500, 'updated_at': NOW - age_minutes * 60}
+
+
+class FakeStore(object):
+    def __init__(self, objects):
+        self.objects = objects
+        self.reads = 0
+        self.before_write = None
+
+    def etag(self, key_name):
+        return '"%s"' % hashlib.md5(self.objects[key_name]).hexdigest()
+
+    def get_head_object(self, bucket_name, key_name):
+        if key_name not in self.objects:
+            return None
+        return {'LastModified': datetime.datetime.now(datetime.timezone.utc), 'ETag': self.etag(key_name)}
+
+    def read_json_config_file_from_s3(self, bucket_name, key_name):
+        return json.loads(self.objects[key_name])
+
+    def read_object(self, bucket_name, key_name):
+        self.reads += 1
+        return self.objects[key_name], self.etag(key_name)
+
+    def put_object_body(self, bucket_name, key_name, body, content_type=None, if_match=None, if_none_match=None):
+        if self.before_write:
+            self.before_write()
+        if if_match and if_match != self.etag(key_name):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': ''}}, 'PutObject')
+        self.objects[key_name] = body
+        return {'ETag': self.etag(key_name)}
+
+
+class TestExpiryIndex(unittest.TestCase):
+    def test_pops_only_due_entries_in_order(self):
+        index = ExpiryIndex({'general': {'192.0.2.1': entry(300), '192.0.2.2': entry(10), '192.0.2.3': entry(250)},
+                             'uriList': {'/login': {'192.0.2.4': entry(245)}}}, BLOCK_PERIOD * 60)
+
+        self.assertEqual(index.pop_due(NOW), [(None, '192.0.2.1'), (None, '192.0.2.3'), ('/login', '192.0.2.4')])
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.next_expiry(), NOW - 600 + BLOCK_PERIOD * 60)
+
+
+@patch.dict('os.environ', ENV)
+class TestExpirySweeper(unittest.TestCase):
+    def setUp(self):
+        expiry_sweeper.EXPIRY_INDEXES.clear()
+        self.store = FakeStore({
+            'stack-waf_log_conf.json': json.dumps({'general': {'blockPeriod': BLOCK_PERIOD}}).encode('utf-8'),
+            'stack-waf_log_out.json': encode_state({
+                'general': {'192.0.2.1': entry(300), '192.0.2.2': entry(10), '2001:db8::1': entry(500),
+                            '198.51.100.1': entry(300)},
+                'uriList': {'/login': {'198.51.100.1': entry(5)}}
+            })
+        })
+        with patch('expiry_sweeper.S3'), patch('expiry_sweeper.WAFLIBv2'):
+            self.sweeper = ExpirySweeper(Mock())
+        self.sweeper.s3_util = self.store
+        self.sweeper.waflib.which_ip_version.side_effect = lambda log, ip: 'IPV6' if ':' in ip else 'IPV4'
+        self.sweeper.waflib.set_ip_cidr.side_effect = lambda log, ip: ip + ('/128' if ':' in ip else '/32')
+        self.sweeper.waflib.aggregation_policy = None
+        # Keep the metrics readable after the sweep
+        self.sweeper.stage_timer.publish = Mock()
+
+    def test_removes_expired_entries_in_one_update_per_ip_set(self):
+        self.sweeper.sweep(NOW)
+
+        state = decode_state(self.store.objects['stack-waf_log_out.json'])
+        self.assertEqual(set(state['general']), {'192.0.2.2'})
+        self.assertEqual(set(state['uriList']['/login']), {'198.51.100.1'})
+        # 198.51.100.1 is still blocked through its uriList entry
+        calls = self.sweeper.waflib.remove_addresses_from_sharded_ip_set.call_args_list
+        self.assertEqual([c[0][2:] for c in calls], [([('floodv4', 'arn:floodv4/id4')], ['192.0.2.1/32']),
+                                                     ([('floodv6', 'arn:floodv6/id6')], ['2001:db8::1/128'])])
+        self.assertEqual(self.sweeper.stage_timer.get_value('EntriesExpired'), 3)
+
+    @patch('expiry_sweeper.LambdaLogParser')
+    def test_aggregated_ip_sets_are_rebuilt_from_remaining_requesters(self, log_parser_class):
+        self.sweeper.waflib.aggregation_policy = Mock()
+        log_parser_class.get_state_shards.return_value = 0
+        log_parser = log_parser_class.return_value
+
+        self.sweeper.sweep(NOW)
+
+        # Expired addresses may be blocked through a wider CIDR, no exact removal
+        self.sweeper.waflib.remove_addresses_from_sharded_ip_set.assert_not_called()
+        log_parser.update_ip_set.assert_called_once()
+        ip_set_type, outstanding_requesters = log_parser.update_ip_set.call_args[0]
+        self.assertIs(ip_set_type, log_parser.flood)
+        self.assertEqual(set(outstanding_requesters['general']), {'192.0.2.2'})
+        self.assertEqual(set(outstanding_requesters['uriList']['/login']), {'198.51.100.1'})
+        self.assertEqual(self.sweeper.stage_timer.get_value('IPSetsRebuilt'), 1)
+
+    @patch('expiry_sweeper.submit_intent')
+    def test_removals_are_queued_for_the_ip_set_writer(self, submit_intent):
+        self.sweeper.intent_queue = Mock()
+        self.sweeper.sweep(NOW)
+
+        # The IP set writer owns the IP sets, the sweeper does not write them
+        self.sweeper.waflib.remove_addresses_from_sharded_ip_set.assert_not_called()
+        self.assertEqual([c[0][2:] for c in submit_intent.call_args_list],
+                         [('floodv4', 'arn:floodv4/id4', 'remove', ['192.0.2.1/32']),
+                          ('floodv6', 'arn:floodv6/id6', 'remove', ['2001:db8::1/128'])])
+        self.assertEqual(self.sweeper.stage_timer.get_value('IPSetIntentsSubmitted'), 2)
+
+    @patch('expiry_sweeper.LambdaLogParser')
+    def test_aggregated_rebuild_uses_the_intent_queue(self, log_parser_class):
+        self.sweeper.waflib.aggregation_policy = Mock()
+        self.sweeper.intent_queue = Mock()
+        log_parser_class.get_state_shards.return_value = 0
+
+        self.sweeper.sweep(NOW)
+
+        # update_ip_set queues a replace intent when the log parser has an intent queue
+        self.assertIs(log_parser_class.return_value.intent_queue, self.sweeper.intent_queue)
+        log_parser_class.return_value.update_ip_set.assert_called_once()
+
+    def test_unchanged_state_is_not_downloaded_again(self):
+        self.sweeper.sweep(NOW)
+        self.sweeper.waflib.remove_addresses_from_sharded_ip_set.reset_mock()
+        reads = self.store.reads
+
+        self.sweeper.sweep(NOW + 60)
+
+        self.assertEqual(self.store.reads, reads)
+        self.sweeper.waflib.remove_addresses_from_sharded_ip_set.assert_not_called()
+
+    def test_conflicting_write_skips_ip_set_update(self):
+        def log_parser_write():
+            self.store.objects['stack-waf_log_out.json'] = encode_state({'general': {}, 'uriList': {}})
+        self.store.before_write = log_parser_write
+
+        self.sweeper.sweep(NOW)
+
+        self.sweeper.waflib.remove_addresses_from_sharded_ip_set.assert_not_called()
+        self.assertEqual(self.sweeper.stage_timer.get_value('StateConflicts'), 1)
+        self.assertEqual(expiry_sweeper.EXPIRY_INDEXES, {})
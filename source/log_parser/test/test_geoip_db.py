@@ -0,0 +1,124 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+import geoip_db
+from geoip_db import GeoIPDatabase, write_database, load_database, get_network_prefix
+from lambda_log_parser import LambdaLogParser
+from requester_state import FORMAT_DATE_TIME
+
+ROWS = [
+    ('198.51.100.0/24', 'CN', 64500),
+    ('192.0.2.0/24', 'US', 64501),
+    ('203.0.113.0/25', '', 64502),
+    ('2001:db8::/32', 'DE', 64503),
+]
+
+
+class TestGeoIPDatabase(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'geoip.db')
+        write_database(self.path, ROWS)
+        self.db = GeoIPDatabase(self.path, cache_size=16)
+
+    def tearDown(self):
+        self.db.close()
+        geoip_db.DATABASES.clear()
+        shutil.rmtree(self.work_dir)
+
+    def test_lookup(self):
+        self.assertEqual(self.db.lookup('198.51.100.7'), ('CN', 64500))
+        self.assertEqual(self.db.lookup('192.0.2.255'), ('US', 64501))
+        self.assertEqual(self.db.lookup('203.0.113.1'), (None, 64502))
+        self.assertEqual(self.db.lookup('2001:db8::1'), ('DE', 64503))
+
+    def test_lookup_misses(self):
+        self.assertIsNone(self.db.lookup('10.0.0.1'))
+        self.assertIsNone(self.db.lookup('203.0.113.200'))
+        self.assertIsNone(self.db.lookup('255.255.255.255'))
+        self.assertIsNone(self.db.lookup('2001:db9::1'))
+        self.assertIsNone(self.db.lookup('x.x.x.x'))
+
+    def test_hot_ips_are_cached(self):
+        for _ in range(3):
+            self.db.lookup('198.51.100.7')
+
+        cache_info = self.db.get_cache_info()
+        self.assertEqual((cache_info.hits, cache_info.misses), (2, 1))
+
+    def test_load_database(self):
+        self.assertIsNone(load_database(os.path.join(self.work_dir, 'missing.db')))
+        with patch.dict('os.environ', {'GEOIP_DB_PATH': self.path}):
+            self.assertIs(load_database(), load_database())
+
+    def test_network_prefix(self):
+        self.assertEqual(get_network_prefix('198.51.100.7', 24, 64), '198.51.100.0/24')
+        self.assertEqual(get_network_prefix('2001:db8::1:2', 24, 64), '2001:db8::/64')
+        self.assertEqual(get_network_prefix('198.51.100.7', 32, 128), '198.51.100.7')
+        self.assertEqual(get_network_prefix('x.x.x.x', 24, 64), 'x.x.x.x')
+
+
+class TestEnrichedThresholds(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        path = os.path.join(self.work_dir, 'geoip.db')
+        write_database(path, ROWS)
+        self.env = patch.dict('os.environ', {'GEOIP_DB_PATH': path})
+        self.env.start()
+        self.parser = LambdaLogParser(Mock())
+        self.parser.config = {'general': {'errorThreshold': 10, 'errorCodes': ['403'],
+                                          'errorThresholdByCountry': {'CN': 2}, 'errorThresholdByAsn': {'64502': 4}},
+                              'uriList': {}}
+        self.parser.configure_enrichment()
+
+    def tearDown(self):
+        self.env.stop()
+        geoip_db.DATABASES.clear()
+        shutil.rmtree(self.work_dir)
+
+    def test_threshold_by_country_then_asn(self):
+        self.assertEqual(self.parser.get_requester_threshold('198.51.100.7', 'errorThreshold'), 2)
+        self.assertEqual(self.parser.get_requester_threshold('203.0.113.1', 'errorThreshold'), 4)
+        self.assertEqual(self.parser.get_requester_threshold('192.0.2.1', 'errorThreshold'), 10)
+        self.assertEqual(self.parser.get_requester_threshold('10.0.0.1', 'errorThreshold'), 10)
+
+    def test_outstanding_requesters_use_enriched_thresholds(self):
+        counter = {'general': {'2025-03-20T10:00 198.51.100.7': 3, '2025-03-20T10:00 192.0.2.1': 3}, 'uriList': {}}
+
+        outstanding = self.parser.get_outstanding_requesters('alb', counter, {'general': {}, 'uriList': {}})
+
+        self.assertEqual(set(outstanding['general']), {'198.51.100.7'})
+
+    def test_stored_requesters_are_merged_with_enriched_thresholds(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        updated_at = (now - datetime.timedelta(seconds=60)).strftime(FORMAT_DATE_TIME)
+        self.parser.config['general']['blockPeriod'] = 240
+        remote = {'general': {'198.51.100.7': {'max_counter_per_min': 3, 'updated_at': updated_at},
+                              '192.0.2.1': {'max_counter_per_min': 3, 'updated_at': updated_at}}}
+        outstanding = {'general': {}, 'uriList': {}}
+
+        _, force_update = self.parser.merge_general_outstanding_requesters(
+            'errorThreshold', remote, outstanding, now.strftime(FORMAT_DATE_TIME), now, False)
+
+        # Blocked under the CN threshold of 2, kept; below the general threshold of 10, dropped
+        self.assertEqual(set(outstanding['general']), {'198.51.100.7'})
+        self.assertTrue(force_update)
+
+    def test_prefix_level_counting(self):
+        self.parser.config['general']['prefixLength'] = {'ipv4': 24}
+        self.parser.configure_enrichment()
+        counter = {'general': {}, 'uriList': {}}
+        for ip in ('198.51.100.1', '198.51.100.2', '198.51.100.3'):
+            line = ('h2 2025-03-20T10:00:01.000000Z app/alb %s:443 10.0.0.1:80 0.0 0.0 0.0 403 403 0 0 '
+                    '"GET https://example.com:443/admin HTTP/1.1" "curl" - -' % ip).encode('utf8')
+            self.parser.read_contents(line, 'alb', {'general': {}, 'uriList': {}}, counter, [])
+
+        self.assertEqual(counter['general'], {'2025-03-20T10:00 198.51.100.0/24': 3})
+        outstanding = self.parser.get_outstanding_requesters('alb', counter, {'general': {}, 'uriList': {}})
+        self.assertEqual(set(outstanding['general']), {'198.51.100.0/24'})
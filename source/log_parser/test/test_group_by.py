@@ -0,0 +1,118 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import json
+import datetime
+import unittest
+from unittest.mock import Mock, patch
+from lambda_log_parser import LambdaLogParser, get_group_by_dimensions
+from requester_state import FORMAT_DATE_TIME, encode_state, decode_state
+
+TIMESTAMP = 1742464800000
+
+
+def waf_line(ip, country='US', uri='/', method='GET', timestamp=TIMESTAMP):
+    return json.dumps({'timestamp': timestamp, 'httpRequest': {
+        'clientIp': ip, 'country': country, 'uri': uri, 'httpMethod': method}}).encode('utf-8')
+
+
+class TestGroupByDimensions(unittest.TestCase):
+    def test_same_columns_as_athena(self):
+        self.assertEqual(get_group_by_dimensions('None', ''), ())
+        self.assertEqual(get_group_by_dimensions('None', '{"TR": 30}'), ('country',))
+        self.assertEqual(get_group_by_dimensions('Country', ''), ('country',))
+        self.assertEqual(get_group_by_dimensions('URI', ''), ('uri',))
+        self.assertEqual(get_group_by_dimensions('URI', '{"TR": 30}'), ('country', 'uri'))
+        self.assertEqual(get_group_by_dimensions('Country and URI', ''), ('country', 'uri'))
+        self.assertEqual(get_group_by_dimensions('Method and URI', ''), ('uri', 'method'))
+
+
+class TestGroupByCounting(unittest.TestCase):
+    def setUp(self):
+        self.parser = LambdaLogParser(Mock())
+        self.parser.config = {'general': {'requestThreshold': 10, 'blockPeriod': 240}, 'uriList': {}}
+        self.counter = {'general': {}, 'uriList': {}}
+
+    def parse(self, lines):
+        for line in lines:
+            self.parser.read_contents(line, 'waf', {'general': {}, 'uriList': {}}, self.counter, [])
+        return self.parser.get_outstanding_requesters('waf', self.counter, {'general': {}, 'uriList': {}})
+
+    @patch.dict('os.environ', {'HTTP_FLOOD_ATHENA_GROUP_BY': 'None', 'REQUEST_THRESHOLD_BY_COUNTRY': ''})
+    def test_ip_only_keys_are_unchanged(self):
+        self.parser.configure_group_by('waf')
+
+        self.parse([waf_line('192.0.2.1')])
+
+        self.assertEqual(len(self.counter['general']), 1)
+        self.assertEqual(list(self.counter['general'])[0].split(' ')[-1], '192.0.2.1')
+        self.assertEqual(len(list(self.counter['general'])[0].split(' ')), 2)
+
+    @patch.dict('os.environ', {'HTTP_FLOOD_ATHENA_GROUP_BY': 'None', 'REQUEST_THRESHOLD_BY_COUNTRY': '{"TR": 3}'})
+    def test_threshold_by_country(self):
+        self.parser.configure_group_by('waf')
+
+        outstanding = self.parse([waf_line('192.0.2.1', 'TR')] * 3 + [waf_line('192.0.2.2', 'US')] * 3)
+
+        self.assertEqual(set(outstanding['general']), {'192.0.2.1'})
+        self.assertEqual(outstanding['general']['192.0.2.1']['max_counter_per_min'], 3)
+
+    @patch.dict('os.environ', {'HTTP_FLOOD_ATHENA_GROUP_BY': 'None', 'REQUEST_THRESHOLD_BY_COUNTRY': '{"TR": 3}'})
+    def test_country_threshold_holds_for_the_block_period(self):
+        self.parser.configure_group_by('waf')
+        stored = decode_state(encode_state(self.parse([waf_line('192.0.2.1', 'TR')] * 3)))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        outstanding = {'general': {}, 'uriList': {}}
+
+        _, force_update = self.parser.merge_general_outstanding_requesters(
+            'requestThreshold', stored, outstanding, now.strftime(FORMAT_DATE_TIME), now, False)
+
+        # Still checked against the TR threshold the entry was admitted under
+        self.assertEqual(outstanding['general']['192.0.2.1']['country'], 'TR')
+        self.assertFalse(force_update)
+
+    @patch.dict('os.environ', {'HTTP_FLOOD_ATHENA_GROUP_BY': 'URI', 'REQUEST_THRESHOLD_BY_COUNTRY': ''})
+    def test_group_by_uri(self):
+        self.parser.config['general']['requestThreshold'] = 4
+        self.parser.configure_group_by('waf')
+
+        # 6 requests spread over 3 URIs stay below the threshold, 4 on one URI do not
+        outstanding = self.parse([waf_line('192.0.2.1', uri='/%d' % (i % 3)) for i in range(6)] +
+                                 [waf_line('192.0.2.2', uri='/login')] * 4)
+
+        self.assertEqual(set(outstanding['general']), {'192.0.2.2'})
+        # Dimension values are stored once, keys only carry their index
+        self.assertEqual(len(self.parser.group_key_list), 4)
+        login_keys = [k for k in self.counter['general'] if k.endswith(' 192.0.2.2')]
+        self.assertEqual([k.split(' ')[-2] for k in login_keys], [str(self.parser.group_keys[('/login',)])])
+
+    @patch.dict('os.environ', {'HTTP_FLOOD_ATHENA_GROUP_BY': 'Country', 'REQUEST_THRESHOLD_BY_COUNTRY': '{"TR": 3}'})
+    def test_configuration_file_thresholds_take_precedence(self):
+        self.parser.config['general']['requestThresholdByCountry'] = {'TR': 5}
+        self.parser.configure_group_by('waf')
+
+        outstanding = self.parse([waf_line('192.0.2.1', 'TR')] * 4)
+
+        self.assertEqual(outstanding['general'], {})
+
+    @patch.dict('os.environ', {'HTTP_FLOOD_ATHENA_GROUP_BY': 'Country', 'REQUEST_THRESHOLD_BY_COUNTRY': ''})
+    def test_app_logs_are_not_grouped(self):
+        self.parser.configure_group_by('alb')
+
+        self.assertEqual(self.parser.group_by_dimensions, ())
+
+
+class TestLogFilters(unittest.TestCase):
+    def setUp(self):
+        self.parser = LambdaLogParser(Mock())
+
+    @patch.dict('os.environ', {'WAF_LOG_FILTERS': '[{"Behavior": "DROP", "Actions": ["BLOCK"]}]'})
+    def test_filters_in_effect_are_recorded(self):
+        self.parser.configure_log_filters('waf')
+
+        self.assertEqual(self.parser.log_filters, [{'Behavior': 'DROP', 'Requirement': 'MEETS_ALL',
+                                                    'Conditions': [{'ActionCondition': {'Action': 'BLOCK'}}]}])
+        self.assertEqual(self.parser.stage_timer.get_value('WAFLogFilters'), 1)
+
+        self.parser.configure_log_filters('alb')
+        self.assertEqual(self.parser.log_filters, [])
@@ -2,13 +2,16 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import unittest
-from unittest.mock import Mock
-from lib.waflibv2 import WAFLIBv2
+from unittest.mock import Mock, patch
+from botocore.exceptions import ClientError
+from lib.waflibv2 import WAFLIBv2, IP_SET_SNAPSHOTS, WEB_ACL_IP_SETS, get_ip_set_shards, get_address_shard
 
 class TestIPAddressHandler(unittest.TestCase):
     def setUp(self):
         self.log = Mock()
         self.handler = WAFLIBv2()
+        IP_SET_SNAPSHOTS.clear()
+        WEB_ACL_IP_SETS.clear()
 
     def test_merge_addresses_within_limit(self):
         addresses = ["192.0.2.1/32", "192.0.2.2/32"]
@@ -53,3 +56,248 @@ class TestIPAddressHandler(unittest.TestCase):
         unique_addresses = list(set(addresses))
         for addr in unique_addresses:
             self.assertIn(addr, result, f"Address {addr} should be in result")
+
+    def test_prefix_keys(self):
+        self.assertEqual(self.handler.which_ip_version(self.log, "198.51.100.0/24"), "IPV4")
+        self.assertEqual(self.handler.set_ip_cidr(self.log, "198.51.100.7/24"), "198.51.100.0/24")
+        self.assertEqual(self.handler.which_ip_version(self.log, "2001:db8::/64"), "IPV6")
+        self.assertEqual(self.handler.set_ip_cidr(self.log, "198.51.100.7"), "198.51.100.7/32")
+
+
+    def test_diff_addresses_canonical(self):
+        current_list = ["192.0.2.1/32", "2001:DB8::1/128", "192.0.2.9/32"]
+        desired_list = ["192.0.2.1/32", "2001:db8::1/128", "198.51.100.7/24"]
+
+        additions, removals = self.handler.diff_addresses(current_list, desired_list)
+
+        self.assertEqual(additions, ["198.51.100.7/24"])
+        self.assertEqual(removals, ["192.0.2.9/32"])
+
+    @patch('lib.waflibv2.client')
+    def test_sync_ip_set_skips_noop_write(self, client):
+        arn = 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/IPSet/abcdef12'
+        client.get_ip_set.return_value = {
+            'IPSet': {'Description': 'test', 'Addresses': ["192.0.2.1/32", "192.0.2.2/32"]},
+            'LockToken': 'token'
+        }
+
+        result = self.handler.sync_ip_set(self.log, 'REGIONAL', 'IPSet', arn, ["192.0.2.2/32", "192.0.2.1/32"])
+
+        self.assertEqual(result, {'Added': 0, 'Removed': 0, 'Updated': False, 'Response': None, 'Error': None})
+        client.update_ip_set.assert_not_called()
+
+        result = self.handler.sync_ip_set(self.log, 'REGIONAL', 'IPSet', arn, ["192.0.2.2/32", "192.0.2.3/32"])
+
+        self.assertEqual((result['Added'], result['Removed'], result['Updated']), (1, 1, True))
+        client.update_ip_set.assert_called_once()
+
+    @patch('lib.waflibv2.client')
+    def test_sync_ip_set_writes_with_cached_lock_token(self, client):
+        arn = 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/IPSet/abcdef12'
+        client.get_ip_set.return_value = {
+            'IPSet': {'Description': 'test', 'Addresses': ["192.0.2.1/32"]},
+            'LockToken': 'token-1'
+        }
+        client.update_ip_set.side_effect = [{'NextLockToken': 'token-2'}, {'NextLockToken': 'token-3'}]
+
+        self.handler.sync_ip_set(self.log, 'REGIONAL', 'IPSet', arn, ["192.0.2.1/32", "192.0.2.2/32"])
+        result = self.handler.sync_ip_set(self.log, 'REGIONAL', 'IPSet', arn, ["192.0.2.2/32"])
+
+        self.assertEqual((result['Added'], result['Removed'], result['Updated']), (0, 1, True))
+        client.get_ip_set.assert_called_once()
+        self.assertEqual(client.update_ip_set.call_args.kwargs['LockToken'], 'token-2')
+        self.assertEqual(IP_SET_SNAPSHOTS[('REGIONAL', 'abcdef12')]['LockToken'], 'token-3')
+
+        # The cache matches the addresses, but another writer changed the IPSet since:
+        # the IPSet is read again before skipping, and the change is corrected
+        client.get_ip_set.return_value = {
+            'IPSet': {'Description': 'test', 'Addresses': ["192.0.2.2/32", "203.0.113.1/32"]},
+            'LockToken': 'token-4'
+        }
+        client.update_ip_set.side_effect = [{'NextLockToken': 'token-5'}]
+        result = self.handler.sync_ip_set(self.log, 'REGIONAL', 'IPSet', arn, ["192.0.2.2/32"])
+
+        self.assertEqual((result['Added'], result['Removed'], result['Updated']), (0, 1, True))
+        self.assertEqual(client.get_ip_set.call_count, 2)
+        self.assertEqual(client.update_ip_set.call_args.kwargs['LockToken'], 'token-4')
+
+        # Nothing to write: skipped once the IPSet read again confirms it
+        client.get_ip_set.return_value = {
+            'IPSet': {'Description': 'test', 'Addresses': ["192.0.2.2/32"]},
+            'LockToken': 'token-5'
+        }
+        result = self.handler.sync_ip_set(self.log, 'REGIONAL', 'IPSet', arn, ["192.0.2.2/32"])
+
+        self.assertFalse(result['Updated'])
+        self.assertEqual(client.get_ip_set.call_count, 3)
+        self.assertEqual(client.update_ip_set.call_count, 3)
+
+    @patch('lib.waflibv2.client')
+    def test_patch_ip_set_reads_again_on_stale_lock_token(self, client):
+        arn = 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/IPSet/abcdef12'
+        IP_SET_SNAPSHOTS[('REGIONAL', 'abcdef12')] = {
+            'LockToken': 'stale', 'Description': 'test', 'Addresses': [], 'Digest': '', 'LoadedAt': 2 ** 40
+        }
+        client.get_ip_set.return_value = {
+            'IPSet': {'Description': 'test', 'Addresses': ["198.51.100.1/32"]},
+            'LockToken': 'fresh'
+        }
+        lock_error = ClientError({'Error': {'Code': 'WAFOptimisticLockException'}}, 'UpdateIPSet')
+        client.update_ip_set.side_effect = [lock_error, {'NextLockToken': 'next'}]
+
+        response = self.handler.patch_ip_set(self.log, 'REGIONAL', 'IPSet', arn, ["192.0.2.1/32"], 10)
+
+        self.assertEqual(response, {'NextLockToken': 'next'})
+        client.get_ip_set.assert_called_once()
+        self.assertEqual(client.update_ip_set.call_args.kwargs['LockToken'], 'fresh')
+        self.assertEqual(client.update_ip_set.call_args.kwargs['Addresses'], ["192.0.2.1/32", "198.51.100.1/32"])
+
+    @patch.dict('os.environ', {'IP_SET_SHARDS_HTTP_FLOODV4':
+                               'arn:aws:wafv2:us-east-1:1:regional/ipset/Shard1/id1, arn:aws:wafv2:us-east-1:1:regional/ipset/Shard2/id2',
+                               'WAF_WEB_ACL_ARN': 'arn:aws:wafv2:us-east-1:1:regional/webacl/WebACL/acl', 'SCOPE': 'REGIONAL'})
+    @patch('lib.waflibv2.client')
+    def test_get_ip_set_shards(self, client):
+        client.get_web_acl.return_value = {'WebACL': {'Rules': [
+            {'Statement': {'IPSetReferenceStatement': {'ARN': 'arn:ipset/IPSet/id0'}}},
+            {'Statement': {'OrStatement': {'Statements': [
+                {'IPSetReferenceStatement': {'ARN': 'arn:aws:wafv2:us-east-1:1:regional/ipset/Shard1/id1'}},
+                {'IPSetReferenceStatement': {'ARN': 'arn:aws:wafv2:us-east-1:1:regional/ipset/Shard2/id2'}}]}}}]}}
+
+        self.assertEqual(get_ip_set_shards('IPSet', 'arn:ipset/IPSet/id0', 'HTTP_FLOODV4'), [
+            ('IPSet', 'arn:ipset/IPSet/id0'),
+            ('Shard1', 'arn:aws:wafv2:us-east-1:1:regional/ipset/Shard1/id1'),
+            ('Shard2', 'arn:aws:wafv2:us-east-1:1:regional/ipset/Shard2/id2')
+        ])
+        self.assertEqual(get_ip_set_shards('IPSet', None, 'HTTP_FLOODV4'), [])
+        # The web ACL is read once
+        get_ip_set_shards('IPSet', 'arn:ipset/IPSet/id0', 'HTTP_FLOODV4')
+        client.get_web_acl.assert_called_once_with(Scope='REGIONAL', Name='WebACL', Id='acl')
+
+    @patch.dict('os.environ', {'IP_SET_SHARDS_HTTP_FLOODV4': 'arn:aws:wafv2:us-east-1:1:regional/ipset/Shard1/id1',
+                               'WAF_WEB_ACL_ARN': 'arn:aws:wafv2:us-east-1:1:regional/webacl/WebACL/acl', 'SCOPE': 'REGIONAL'})
+    @patch('lib.waflibv2.client')
+    def test_get_ip_set_shards_refuses_unreferenced_shards(self, client):
+        # Addresses written to a shard that no rule references would not be blocked
+        client.get_web_acl.return_value = {'WebACL': {'Rules': [
+            {'Statement': {'IPSetReferenceStatement': {'ARN': 'arn:ipset/IPSet/id0'}}}]}}
+        self.assertEqual(get_ip_set_shards('IPSet', 'arn:ipset/IPSet/id0', 'HTTP_FLOODV4'),
+                         [('IPSet', 'arn:ipset/IPSet/id0')])
+
+        WEB_ACL_IP_SETS.clear()
+        client.get_web_acl.side_effect = Exception('AccessDenied')
+        self.assertEqual(get_ip_set_shards('IPSet', 'arn:ipset/IPSet/id0', 'HTTP_FLOODV4'),
+                         [('IPSet', 'arn:ipset/IPSet/id0')])
+
+    def test_spread_addresses_fills_other_shards_before_dropping(self):
+        addresses = ['192.0.2.%d/32' % i for i in range(256)]
+        # Ranked: every address of shard 0 first, more than a shard holds
+        addresses.sort(key=lambda address: get_address_shard(address, 4) != 0)
+
+        parts = self.handler.spread_addresses(addresses, 4, 40)
+
+        self.assertTrue(all(len(part) == 40 for part in parts))
+        self.assertEqual(sorted(a for part in parts for a in part), sorted(addresses[:160]))
+        self.assertTrue(all(get_address_shard(address, 4) == 0 for address in parts[0]))
+
+    @patch('lib.waflibv2.client')
+    def test_sync_sharded_ip_sets_rewrites_only_changed_shards(self, client):
+        shards = [('Shard%d' % i, 'arn:ipset/Shard%d/id%d' % (i, i)) for i in range(4)]
+        ip_sets = {'id%d' % i: [] for i in range(4)}
+        client.get_ip_set.side_effect = lambda Scope, Name, Id: {
+            'IPSet': {'Description': Name, 'Addresses': list(ip_sets[Id])}, 'LockToken': 'token'}
+
+        def update_ip_set(Scope, Name, Description, Id, Addresses, LockToken):
+            ip_sets[Id] = list(Addresses)
+            return {'NextLockToken': 'token'}
+        client.update_ip_set.side_effect = update_ip_set
+
+        addresses = ['192.0.2.%d/32' % i for i in range(40)]
+        result, = self.handler.sync_sharded_ip_sets(self.log, 'REGIONAL', [(shards, addresses)], 20)
+
+        self.assertEqual((result['Added'], result['Truncated'], result['Error']), (40, 0, None))
+        self.assertEqual(sorted(a for shard in ip_sets.values() for a in shard), sorted(addresses))
+        self.assertTrue(all(ip_sets.values()))
+
+        client.update_ip_set.reset_mock()
+        result, = self.handler.sync_sharded_ip_sets(self.log, 'REGIONAL', [(shards, addresses[1:])], 20)
+
+        self.assertEqual((result['Removed'], result['Updated']), (1, True))
+        client.update_ip_set.assert_called_once()
+
+        # Each shard holds at most ip_range_limit addresses, the first ones
+        result, = self.handler.sync_sharded_ip_sets(self.log, 'REGIONAL', [(shards, addresses)], 5)
+
+        self.assertEqual(result['Truncated'], 20)
+        self.assertTrue(all(len(shard) == 5 for shard in ip_sets.values()))
+
+    @patch.dict('os.environ', {'WAF_UPDATE_WORKERS': '2'})
+    @patch('lib.waflibv2.client')
+    def test_sync_ip_sets_isolates_errors(self, client):
+        def get_ip_set(Scope, Name, Id):
+            if Name == 'IPSetV6':
+                raise Exception('throttled')
+            return {'IPSet': {'Description': 'test', 'Addresses': []}, 'LockToken': 'token'}
+        client.get_ip_set.side_effect = get_ip_set
+
+        result_v4, result_v6 = self.handler.sync_ip_sets(self.log, 'REGIONAL', [
+            ('IPSetV4', 'arn:v4', ["192.0.2.1/32"]),
+            ('IPSetV6', 'arn:v6', ["2001:db8::1/128"])
+        ])
+
+        self.assertEqual((result_v4['Added'], result_v4['Updated'], result_v4['Error']), (1, True, None))
+        self.assertFalse(result_v6['Updated'])
+        self.assertIsNotNone(result_v6['Error'])
+        client.update_ip_set.assert_called_once()
+
+    def test_aggregate_addresses(self):
+        addresses = ["192.0.2.5/32", "192.0.2.0/32", "192.0.2.1/32", "192.0.2.2/32", "192.0.2.3/32",
+                     "2001:db8::1/128", "2001:db8::/128", "10.1.0.0/16", "10.0.0.0/8"]
+
+        result = self.handler.aggregate_addresses(addresses)
+
+        # Each CIDR keeps the position of its first member
+        self.assertEqual(result, ["192.0.2.5/32", "192.0.2.0/30", "2001:db8::/127", "10.0.0.0/8"])
+
+    def test_aggregate_addresses_widen(self):
+        dense = [f"198.51.100.{i}/32" for i in range(0, 200, 2)]
+        sparse = [f"203.0.113.{i}/32" for i in range(0, 20, 2)]
+        policy = {'widen_prefix': {4: 24, 6: None}, 'widen_density': 0.3}
+
+        result = self.handler.aggregate_addresses(dense + sparse, policy)
+
+        self.assertEqual(result[0], "198.51.100.0/24")
+        self.assertEqual(result[1:], sparse)
+
+    def test_merge_addresses_aggregated_before_truncation(self):
+        self.handler.aggregation_policy = {}
+        addresses = [f"192.0.2.{i}/32" for i in range(4)]
+        current_list = [f"192.0.2.{i}/32" for i in range(8, 16)] + ["198.51.100.1/32"]
+
+        result = self.handler.merge_and_truncate_addresses(self.log, addresses, current_list, 2)
+
+        self.assertEqual(result, ["192.0.2.0/30", "192.0.2.8/29"])
+
+    def test_logging_filter_rules(self):
+        rules = '[{"Behavior": "drop", "Actions": ["BLOCK"]}, {"Behavior": "DROP", "Label": "partner:allowed"},' \
+                ' {"Behavior": "SKIP", "Action": "BLOCK"}]'
+
+        logging_filter = self.handler.get_logging_filter(self.log, True, 'badbot', rules)
+
+        self.assertEqual(logging_filter['DefaultBehavior'], 'DROP')
+        self.assertEqual([f['Conditions'] for f in logging_filter['Filters']], [
+            [{'LabelNameCondition': {'LabelName': 'badbot'}}],
+            [{'ActionCondition': {'Action': 'BLOCK'}}],
+            [{'LabelNameCondition': {'LabelName': 'partner:allowed'}}]
+        ])
+        self.assertEqual(logging_filter['Filters'][1]['Behavior'], 'DROP')
+        self.log.error.assert_called_once()
+        self.assertIsNone(self.handler.get_logging_filter(self.log, False, 'badbot', 'not json'))
+
+    def test_logging_filter_default_behavior(self):
+        rules = '{"DefaultBehavior": "DROP", "Filters": [{"Behavior": "KEEP", "Actions": ["BLOCK"]}]}'
+
+        logging_filter = self.handler.get_logging_filter(self.log, False, 'badbot', rules)
+
+        self.assertEqual(logging_filter, {'DefaultBehavior': 'DROP', 'Filters': [
+            {'Behavior': 'KEEP', 'Requirement': 'MEETS_ALL', 'Conditions': [{'ActionCondition': {'Action': 'BLOCK'}}]}
+        ]})
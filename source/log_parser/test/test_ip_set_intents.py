@@ -0,0 +1,157 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import json
+import unittest
+from unittest.mock import Mock, patch
+from botocore.exceptions import ClientError
+from lib.waflibv2 import WAFLIBv2, IP_SET_SNAPSHOTS
+from ip_set_intents import InMemoryIntentQueue, SQSEventBatch, SQSIntentQueue, IPSetIntentWriter, submit_intent, \
+    coalesce_intents, is_intent_event
+
+ARN_V4 = 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/IPSetV4/abcdef12'
+
+
+class FakeWAFClient(object):
+    """
+    IP sets with lock tokens, enough for the get and update calls of the writer
+    """
+
+    def __init__(self, ip_sets):
+        self.ip_sets = {ip_set_id: {'Addresses': list(addresses), 'LockToken': 0}
+                        for ip_set_id, addresses in ip_sets.items()}
+        self.updates = 0
+
+    def get_ip_set(self, Scope, Name, Id):
+        ip_set = self.ip_sets[Id]
+        return {'IPSet': {'Description': Name, 'Addresses': list(ip_set['Addresses'])},
+                'LockToken': str(ip_set['LockToken'])}
+
+    def update_ip_set(self, Scope, Name, Id, Addresses, LockToken, Description):
+        ip_set = self.ip_sets[Id]
+        if LockToken != str(ip_set['LockToken']):
+            raise ClientError({'Error': {'Code': 'WAFOptimisticLockException'}}, 'UpdateIPSet')
+        self.updates += 1
+        ip_set['Addresses'] = list(Addresses)
+        ip_set['LockToken'] += 1
+        return {'NextLockToken': str(ip_set['LockToken'])}
+
+
+@patch('lib.waflibv2.rate_limiter', False)
+class TestIPSetIntents(unittest.TestCase):
+    def setUp(self):
+        self.log = Mock()
+        self.queue = InMemoryIntentQueue()
+        self.writer = IPSetIntentWriter(self.log, self.queue, WAFLIBv2())
+        IP_SET_SNAPSHOTS.clear()
+
+    def test_coalesce_intents_in_submission_order(self):
+        intents = [
+            {'Action': 'add', 'Addresses': ['192.0.2.1', '192.0.2.2/32']},
+            {'Action': 'remove', 'Addresses': ['192.0.2.1/32', '198.51.100.1/32']},
+            {'Action': 'add', 'Addresses': ['198.51.100.1/32'], 'Limit': 5}
+        ]
+
+        replacement, additions, removals, limit = coalesce_intents(intents)
+
+        self.assertIsNone(replacement)
+        self.assertEqual(additions, ['192.0.2.2/32', '198.51.100.1/32'])
+        self.assertEqual(removals, {'192.0.2.1/32'})
+        self.assertEqual(limit, 5)
+
+    def test_drain_applies_one_write_per_ip_set(self):
+        client = FakeWAFClient({'abcdef12': ['203.0.113.1/32', '192.0.2.1/32']})
+        submit_intent(self.queue, 'REGIONAL', 'IPSetV4', ARN_V4, 'add', ['192.0.2.2/32'], now=1)
+        submit_intent(self.queue, 'REGIONAL', 'IPSetV4', ARN_V4, 'add', ['192.0.2.3/32'], now=2)
+        submit_intent(self.queue, 'REGIONAL', 'IPSetV4', ARN_V4, 'remove', ['192.0.2.1/32', '192.0.2.3/32'], now=3)
+
+        with patch('lib.waflibv2.client', client):
+            written = self.writer.drain(now=4)
+
+        self.assertEqual(written, 1)
+        self.assertEqual(client.updates, 1)
+        self.assertEqual(client.ip_sets['abcdef12']['Addresses'], ['192.0.2.2/32', '203.0.113.1/32'])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_drain_joins_parts_and_retries_on_conflict(self):
+        client = FakeWAFClient({'abcdef12': ['203.0.113.1/32']})
+        addresses = ['192.0.2.%d/32' % i for i in range(5)]
+        with patch.dict('os.environ', {'INTENT_MAX_ADDRESSES': '2'}):
+            submit_intent(self.queue, 'REGIONAL', 'IPSetV4', ARN_V4, 'replace', addresses, now=1)
+        self.assertEqual(len(self.queue), 3)
+
+        with patch('lib.waflibv2.client', client):
+            self.writer.waflib.get_ip_set_snapshot(self.log, 'REGIONAL', 'IPSetV4', 'abcdef12')
+            # Another writer changes the IP set: the cached lock token is stale
+            client.ip_sets['abcdef12']['LockToken'] += 1
+            self.writer.drain(now=2)
+
+        self.assertEqual(client.ip_sets['abcdef12']['Addresses'], addresses)
+        self.assertEqual(len(self.queue), 0)
+
+    def test_drain_keeps_incomplete_and_failed_intents(self):
+        client = FakeWAFClient({})
+        with patch.dict('os.environ', {'INTENT_MAX_ADDRESSES': '1'}):
+            submit_intent(self.queue, 'REGIONAL', 'IPSetV4', ARN_V4, 'add', ['192.0.2.1/32', '192.0.2.2/32'], now=1)
+        receipt, part = self.queue.receive(1)[0]
+        self.queue.delete([receipt])
+
+        with patch('lib.waflibv2.client', client):
+            self.assertEqual(self.writer.drain(now=2), 0)
+            self.assertEqual(len(self.queue), 1)
+
+            # Parts of an incomplete intent are dropped once they time out
+            self.writer.drain(now=1000)
+            self.assertEqual(len(self.queue), 0)
+
+            # The IP set cannot be read: the intent is left for the next drain
+            submit_intent(self.queue, 'REGIONAL', 'IPSetV4', ARN_V4, 'add', ['192.0.2.1/32'], now=1000)
+            self.writer.drain(now=1001)
+            self.assertEqual(len(self.queue), 1)
+
+    def test_intents_after_an_incomplete_one_wait_for_it(self):
+        client = FakeWAFClient({'abcdef12': ['203.0.113.1/32']})
+        with patch.dict('os.environ', {'INTENT_MAX_ADDRESSES': '1'}):
+            submit_intent(self.queue, 'REGIONAL', 'IPSetV4', ARN_V4, 'replace', ['192.0.2.1/32', '192.0.2.2/32'],
+                          now=1)
+        submit_intent(self.queue, 'REGIONAL', 'IPSetV4', ARN_V4, 'replace', ['198.51.100.1/32'], now=2)
+        # The second part of the older replace is delivered late
+        late_part = self.queue.messages[1]
+        del self.queue.messages[1]
+
+        with patch('lib.waflibv2.client', client):
+            self.assertEqual(self.writer.drain(now=3), 0)
+            self.assertEqual(len(self.queue), 2)
+            self.queue.messages.insert(1, late_part)
+            self.writer.drain(now=4)
+
+        self.assertEqual(client.updates, 1)
+        self.assertEqual(client.ip_sets['abcdef12']['Addresses'], ['198.51.100.1/32'])
+
+    def test_sqs_event_batch(self):
+        client = FakeWAFClient({'abcdef12': []})
+        submit_intent(self.queue, 'REGIONAL', 'IPSetV4', ARN_V4, 'add', ['192.0.2.1/32'], now=1, detected_at=0.5)
+        with patch.dict('os.environ', {'INTENT_MAX_ADDRESSES': '1'}):
+            submit_intent(self.queue, 'REGIONAL', 'IPSetV4', ARN_V4, 'add', ['192.0.2.2/32', '192.0.2.3/32'], now=2)
+        records = [{'eventSource': 'aws:sqs', 'messageId': 'm%d' % i, 'body': json.dumps(message)}
+                   for i, (_, message) in enumerate(self.queue.receive(2))]
+        batch = SQSEventBatch(records)
+        writer = IPSetIntentWriter(self.log, batch, WAFLIBv2())
+
+        with patch('lib.waflibv2.client', client):
+            writer.drain(now=3)
+
+        self.assertTrue(is_intent_event({'Records': records}))
+        self.assertEqual(batch.batch_response(), {'batchItemFailures': [{'itemIdentifier': 'm1'}]})
+        self.assertEqual(client.ip_sets['abcdef12']['Addresses'], ['192.0.2.1/32'])
+        self.assertGreater(writer.stage_timer.get_value('DetectionLatency'), 0)
+
+    @patch('ip_set_intents.get_client')
+    def test_sqs_intent_queue_groups_by_ip_set(self, get_client):
+        queue = SQSIntentQueue('https://sqs.us-east-1.amazonaws.com/123456789012/intents.fifo')
+        intent_id = submit_intent(queue, 'REGIONAL', 'IPSetV4', ARN_V4, 'add', ['192.0.2.1/32'])
+
+        get_client.assert_called_once_with('sqs')
+        kwargs = get_client.return_value.send_message.call_args.kwargs
+        self.assertEqual(kwargs['MessageGroupId'], 'abcdef12')
+        self.assertEqual(kwargs['MessageDeduplicationId'], intent_id + '-0')
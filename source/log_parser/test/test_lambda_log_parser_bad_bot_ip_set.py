@@ -4,7 +4,9 @@
 import unittest
 from unittest.mock import Mock, patch
 import os
+from lib.waflibv2 import WAFLIBv2
 from lambda_log_parser import LambdaLogParser
+from ip_set_intents import InMemoryIntentQueue
 
 class TestLambdaLogParser(unittest.TestCase):
 
@@ -12,7 +14,7 @@ class TestLambdaLogParser(unittest.TestCase):
         self.log = Mock()
         self.parser = LambdaLogParser(self.log)
         self.parser.waflib = Mock()
-        self.parser.delay_between_updates = 0  # Set to 0 for testing
+        self.parser.waflib.patch_sharded_ip_sets.return_value = []
 
     @patch.dict(os.environ, {
         'IP_SET_NAME_BAD_BOTV4': 'BadBotIPSetV4',
@@ -28,15 +30,13 @@ class TestLambdaLogParser(unittest.TestCase):
 
         self.parser.bad_bot_ips_to_ip_set(ips)
 
-        self.parser.waflib.patch_ip_set.assert_any_call(
-            self.log, self.parser.scope, 'BadBotIPSetV4',
-            'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/BadBotIPSetV4/abcdef12-3456-7890-abcd-ef1234567890',
-            ['192.0.2.1/32'], 10000
-        )
-        self.parser.waflib.patch_ip_set.assert_any_call(
-            self.log, self.parser.scope, 'BadBotIPSetV6',
-            'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/BadBotIPSetV6/abcdef12-3456-7890-abcd-ef1234567890',
-            ['2001:db8::1/128'], 10000
+        self.parser.waflib.patch_sharded_ip_sets.assert_called_once_with(
+            self.log, self.parser.scope, [
+                ([('BadBotIPSetV4', 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/BadBotIPSetV4/abcdef12-3456-7890-abcd-ef1234567890')],
+                 ['192.0.2.1/32']),
+                ([('BadBotIPSetV6', 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/BadBotIPSetV6/abcdef12-3456-7890-abcd-ef1234567890')],
+                 ['2001:db8::1/128'])
+            ], 10000
         )
 
     @patch.dict(os.environ, {
@@ -51,10 +51,11 @@ class TestLambdaLogParser(unittest.TestCase):
 
         self.parser.bad_bot_ips_to_ip_set(ips)
 
-        self.parser.waflib.patch_ip_set.assert_called_once_with(
-            self.log, self.parser.scope, 'BadBotIPSetV4',
-            'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/BadBotIPSetV4/abcdef12-3456-7890-abcd-ef1234567890',
-            ['192.0.2.1/32', '203.0.113.1/32'], 10000
+        self.parser.waflib.patch_sharded_ip_sets.assert_called_once_with(
+            self.log, self.parser.scope, [
+                ([('BadBotIPSetV4', 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/BadBotIPSetV4/abcdef12-3456-7890-abcd-ef1234567890')],
+                 ['192.0.2.1/32', '203.0.113.1/32'])
+            ], 10000
         )
 
     @patch.dict(os.environ, {
@@ -69,4 +70,42 @@ class TestLambdaLogParser(unittest.TestCase):
 
         self.parser.bad_bot_ips_to_ip_set(ips)
 
-        self.parser.waflib.patch_ip_set.assert_not_called()
\ No newline at end of file
+        self.parser.waflib.patch_sharded_ip_sets.assert_not_called()
+
+    @patch.dict(os.environ, {
+        'IP_SET_NAME_BAD_BOTV4': 'BadBotIPSetV4',
+        'LIMIT_IP_ADDRESS_RANGES_PER_IP_MATCH_CONDITION': '2',
+        'IP_SET_ID_BAD_BOTV4': 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/BadBotIPSetV4/abcdef12-3456-7890-abcd-ef1234567890'
+    })
+    def test_bad_bot_ips_to_ip_set_keeps_top_hits(self):
+        ips = ['192.0.2.1', '192.0.2.2', '192.0.2.2', '192.0.2.3', '192.0.2.1', '192.0.2.4']
+        self.parser.waflib.which_ip_version.return_value = 'IPV4'
+        self.parser.waflib.set_ip_cidr.side_effect = lambda _, ip: ip + '/32'
+
+        self.parser.bad_bot_ips_to_ip_set(ips)
+
+        # Two hits each, 192.0.2.1 was seen last
+        self.parser.waflib.patch_sharded_ip_sets.assert_called_once_with(
+            self.log, self.parser.scope, [
+                ([('BadBotIPSetV4', 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/BadBotIPSetV4/abcdef12-3456-7890-abcd-ef1234567890')],
+                 ['192.0.2.1/32', '192.0.2.2/32'])
+            ], 2
+        )
+
+    @patch.dict(os.environ, {
+        'IP_SET_NAME_BAD_BOTV4': 'BadBotIPSetV4',
+        'LIMIT_IP_ADDRESS_RANGES_PER_IP_MATCH_CONDITION': '10000',
+        'IP_SET_ID_BAD_BOTV4': 'arn:aws:wafv2:us-east-1:123456789012:regional/ipset/BadBotIPSetV4/abcdef12-3456-7890-abcd-ef1234567890'
+    })
+    def test_bad_bot_ips_to_ip_set_submits_intents(self):
+        self.parser.intent_queue = InMemoryIntentQueue()
+        self.parser.waflib.shard_addresses.side_effect = WAFLIBv2().shard_addresses
+        self.parser.waflib.which_ip_version.return_value = 'IPV4'
+        self.parser.waflib.set_ip_cidr.side_effect = lambda _, ip: ip + '/32'
+
+        self.parser.bad_bot_ips_to_ip_set(['192.0.2.1'])
+
+        self.parser.waflib.patch_sharded_ip_sets.assert_not_called()
+        _, intent = self.parser.intent_queue.receive(10)[0]
+        self.assertEqual((intent['Name'], intent['Action'], intent['Addresses'], intent['Limit']),
+                         ('BadBotIPSetV4', 'add', ['192.0.2.1/32'], 10000))
@@ -3,6 +3,7 @@
 
 from os import environ
 from types import SimpleNamespace
+from unittest.mock import patch
 
 from log_parser import log_parser
 
@@ -133,4 +134,20 @@ def test_lambda_parser_unsupported_log_type(cloudfront_log_lambda_parser_test_ev
         assert str(e) == TYPE_ERROR_MESSAGE
     finally:
         environ.pop('APP_ACCESS_LOG_BUCKET')
-        environ.pop('LOG_TYPE')
\ No newline at end of file
+        environ.pop('LOG_TYPE')
+
+
+def test_expiry_sweeper_event():
+    event = {"resourceType": "LambdaLogParserExpirySweeper"}
+    result = {"message": "[lambda_handler] Expiry sweeper event processed."}
+    with patch('log_parser.log_parser.ExpirySweeper') as sweeper:
+        assert result == log_parser.lambda_handler(event, context)
+    sweeper.return_value.sweep.assert_called_once_with()
+
+
+def test_ip_set_intent_event():
+    event = {"Records": [{"eventSource": "aws:sqs", "messageId": "m0", "body": "{}"}]}
+    result = {"message": "[lambda_handler] IP set intents processed.", "batchItemFailures": []}
+    with patch('log_parser.log_parser.IPSetIntentWriter') as writer:
+        assert result == log_parser.lambda_handler(event, context)
+    writer.return_value.run.assert_called_once_with()
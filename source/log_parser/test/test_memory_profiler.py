@@ -0,0 +1,64 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import tracemalloc
+import unittest
+from unittest.mock import Mock, patch
+from lib.memory_profiler import MemoryProfiler, count_entries, deep_getsizeof
+from lib.stage_metrics import StageTimer
+
+
+class TestMemoryProfiler(unittest.TestCase):
+    def setUp(self):
+        self.log = Mock()
+
+    def tearDown(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def test_disabled_by_default(self):
+        profiler = MemoryProfiler(self.log, 'Test')
+        profiler.track(counter={'general': {}, 'uriList': {}})
+
+        self.assertIsNone(profiler.snapshot('Parse'))
+        self.assertEqual(profiler.tracked, {})
+        self.log.info.assert_not_called()
+
+    @patch.dict('os.environ', {'MEMORY_PROFILING_ENABLED': 'true', 'MEMORY_PROFILING_TOP_ALLOCATIONS': '3'})
+    def test_snapshot_reports_stage_and_tracked_sizes(self):
+        profiler = MemoryProfiler(self.log, 'Test')
+        counter = {'general': {'2023-04-24T21:10 192.0.2.1': 3}, 'uriList': {'/login': {'k1': 1, 'k2': 2}}}
+        profiler.track(counter=counter)
+
+        first = profiler.snapshot('Parse')['memory_profile']
+        allocations = [bytearray(1024) for _ in range(100)]
+        second = profiler.snapshot('Merge')['memory_profile']
+
+        self.assertTrue(tracemalloc.is_tracing())
+        self.assertEqual(first['stage'], 'Parse')
+        self.assertEqual(second['stage'], 'Merge')
+        self.assertEqual(second['tracked']['counter']['entries'], 3)
+        self.assertGreater(second['tracked']['counter']['size_bytes'], 0)
+        self.assertGreater(second['peak_rss_bytes'], 0)
+        self.assertLessEqual(len(second['top_allocations']), 3)
+        self.assertTrue(any(a['size_diff_bytes'] >= 100 * 1024 for a in second['top_allocations']))
+        self.assertEqual(self.log.info.call_count, 2)
+        del allocations
+
+    @patch.dict('os.environ', {'MEMORY_PROFILING_ENABLED': 'true'})
+    def test_stage_timer_checkpoints_on_stage_exit(self):
+        timer = StageTimer(self.log, 'Test')
+        with timer.stage('Download'):
+            pass
+        timer.checkpoint('Parse')
+
+        stages = [c[0][0]['memory_profile']['stage'] for c in self.log.info.call_args_list]
+        self.assertEqual(stages, ['Download', 'Parse'])
+
+    def test_count_entries_and_deep_size(self):
+        requesters = {'general': {'192.0.2.1': {}}, 'uriList': {'/a': {'192.0.2.2': {}, '192.0.2.3': {}}}}
+
+        self.assertEqual(count_entries(requesters), 3)
+        self.assertEqual(count_entries(['192.0.2.1']), 1)
+        self.assertIsNone(count_entries(42))
+        self.assertGreater(deep_getsizeof(requesters), deep_getsizeof({}))
@@ -0,0 +1,83 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import unittest
+from unittest.mock import patch
+from botocore.exceptions import ClientError
+from lib import waflibv2
+from lib.waflibv2 import TokenBucket, SharedTokenBucket, InMemoryBucketStore, AdaptiveRateLimiter, call_waf
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(2, 3, clock=self.clock)
+
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+        self.clock.now += 0.5
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_shared_bucket_is_shared(self):
+        store = InMemoryBucketStore()
+        first = SharedTokenBucket(store, 'wafv2', 1, 2, clock=self.clock)
+        second = SharedTokenBucket(store, 'wafv2', 1, 2, clock=self.clock)
+
+        self.assertEqual(first.reserve(), 0)
+        self.assertEqual(second.reserve(), 0)
+        self.assertAlmostEqual(first.reserve(), 1)
+        self.clock.now += 1
+        self.assertEqual(second.reserve(), 0)
+
+    def test_limiter_waits_for_tokens(self):
+        limiter = AdaptiveRateLimiter(TokenBucket(1, 1, clock=self.clock), 0.1, 4, sleep=self.clock.sleep)
+
+        limiter.acquire()
+        limiter.acquire()
+
+        self.assertAlmostEqual(limiter.waited, 1)
+        self.assertAlmostEqual(self.clock.now, 1001)
+
+
+class TestCallWAF(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = AdaptiveRateLimiter(TokenBucket(2, 4, clock=self.clock), 0.5, 3, increase=0.5,
+                                           sleep=self.clock.sleep)
+
+    @patch('lib.waflibv2.client')
+    def test_rate_adapts_to_throttling(self, client):
+        client.get_ip_set.side_effect = ClientError(
+            {'Error': {'Code': 'WAFLimitsExceededException', 'Message': ''}}, 'GetIPSet')
+
+        with patch.object(waflibv2, 'rate_limiter', self.limiter):
+            for _ in range(3):
+                with self.assertRaises(ClientError):
+                    call_waf('get_ip_set', Scope='REGIONAL', Name='IPSet', Id='id')
+            self.assertEqual(self.limiter.bucket.rate, 0.5)
+
+            client.get_ip_set.side_effect = None
+            for _ in range(6):
+                call_waf('get_ip_set', Scope='REGIONAL', Name='IPSet', Id='id')
+            self.assertEqual(self.limiter.bucket.rate, 3)
+
+    @patch.dict('os.environ', {'WAF_API_RATE': '0'})
+    @patch('lib.waflibv2.client')
+    def test_disabled(self, client):
+        with patch.object(waflibv2, 'rate_limiter', None):
+            call_waf('list_web_acls', Scope='REGIONAL')
+            self.assertIsNone(waflibv2.get_rate_limiter())
+        client.list_web_acls.assert_called_once_with(Scope='REGIONAL')
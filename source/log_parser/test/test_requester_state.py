@@ -0,0 +1,118 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import json
+import zlib
+import struct
+import unittest
+from unittest.mock import Mock, patch
+from requester_state import encode_state, decode_state, encode_json_state, is_binary_state, \
+    parse_updated_at, to_epoch_seconds, STATE_MAGIC, CODEC_ZLIB
+from lambda_log_parser import LambdaLogParser
+
+UPDATED_AT = "2025-03-20 10:00:00 UTC+0000"
+UPDATED_AT_EPOCH = 1742464800
+
+
+class TestRequesterState(unittest.TestCase):
+    def setUp(self):
+        self.state = {
+            'general': {
+                '192.0.2.1': {'max_counter_per_min': 150, 'updated_at': UPDATED_AT},
+                '2001:db8::1': {'max_counter_per_min': '7', 'updated_at': UPDATED_AT_EPOCH},
+                '2001:DB8::2': {'max_counter_per_min': 3, 'updated_at': UPDATED_AT},
+            },
+            'uriList': {
+                '/login': {'198.51.100.7': {'max_counter_per_min': 42, 'updated_at': UPDATED_AT}}
+            }
+        }
+
+    def test_round_trip(self):
+        body = encode_state(self.state)
+        decoded = decode_state(body)
+
+        self.assertTrue(is_binary_state(body))
+        self.assertEqual(decoded['general']['192.0.2.1'], {'max_counter_per_min': 150, 'updated_at': UPDATED_AT_EPOCH})
+        self.assertEqual(decoded['general']['2001:db8::1']['max_counter_per_min'], 7)
+        # Non canonical IPs are kept as strings so keys are preserved
+        self.assertIn('2001:DB8::2', decoded['general'])
+        self.assertEqual(decoded['uriList']['/login']['198.51.100.7']['max_counter_per_min'], 42)
+
+    def test_country_round_trip(self):
+        self.state['general']['192.0.2.1']['country'] = 'TR'
+
+        decoded = decode_state(encode_state(self.state))
+
+        self.assertEqual(decoded['general']['192.0.2.1']['country'], 'TR')
+        self.assertNotIn('country', decoded['general']['2001:db8::1'])
+
+    def test_version_1_is_decoded(self):
+        payload = struct.pack('<IB4sII', 1, 4, bytes([192, 0, 2, 1]), 150, UPDATED_AT_EPOCH) + struct.pack('<I', 0)
+        body = struct.pack('<4sBB', STATE_MAGIC, 1, CODEC_ZLIB) + zlib.compress(payload)
+
+        self.assertEqual(decode_state(body), {
+            'general': {'192.0.2.1': {'max_counter_per_min': 150, 'updated_at': UPDATED_AT_EPOCH}}, 'uriList': {}})
+
+    def test_binary_is_smaller_than_json(self):
+        general = {'10.0.%d.%d' % (i // 256, i % 256): {'max_counter_per_min': i, 'updated_at': UPDATED_AT}
+                   for i in range(10000)}
+        state = {'general': general, 'uriList': {}}
+
+        self.assertLess(len(encode_state(state)) * 5, len(json.dumps(state)))
+        self.assertEqual(len(decode_state(encode_state(state))['general']), 10000)
+
+    def test_legacy_json_is_decoded(self):
+        body = json.dumps(self.state).encode('utf-8')
+
+        self.assertFalse(is_binary_state(body))
+        self.assertEqual(decode_state(body), self.state)
+
+    def test_json_state_uses_legacy_dates(self):
+        decoded = json.loads(encode_json_state(decode_state(encode_state(self.state))))
+
+        self.assertEqual(decoded['general']['2001:db8::1']['updated_at'], UPDATED_AT)
+
+    def test_unsupported_version(self):
+        body = bytearray(encode_state(self.state))
+        body[len(STATE_MAGIC)] = 99
+
+        with self.assertRaises(ValueError):
+            decode_state(bytes(body))
+
+    def test_updated_at_helpers(self):
+        self.assertEqual(to_epoch_seconds(UPDATED_AT), UPDATED_AT_EPOCH)
+        self.assertEqual(parse_updated_at(UPDATED_AT), parse_updated_at(UPDATED_AT_EPOCH))
+
+
+class TestStateReadWrite(unittest.TestCase):
+    def setUp(self):
+        self.parser = LambdaLogParser(Mock())
+        self.parser.s3_util = Mock()
+        self.state = {'general': {'192.0.2.1': {'max_counter_per_min': 150, 'updated_at': UPDATED_AT}},
+                      'uriList': {}}
+
+    @patch.dict('os.environ', {'REQUESTER_STATE_FORMAT': 'binary'})
+    def test_write_output_binary(self):
+        self.parser.write_output('bucket', 'log.gz', 'stack-waf_log_out.json', self.state)
+
+        bucket, key, body, content_type = self.parser.s3_util.put_object_body.call_args[0]
+        self.assertEqual(key, 'stack-waf_log_out.json')
+        self.assertTrue(is_binary_state(body))
+        self.assertEqual(content_type, 'application/octet-stream')
+
+    def test_write_output_json_by_default(self):
+        # A rollback to a release reading JSON only must still find its state
+        self.parser.write_output('bucket', 'log.gz', 'stack-waf_log_out.json', self.state)
+
+        body = self.parser.s3_util.put_object_body.call_args[0][2]
+        self.assertEqual(json.loads(body), self.state)
+
+    def test_get_current_blocked_ips_migrates_json(self):
+        self.parser.s3_util.read_object.return_value = (json.dumps(self.state).encode('utf-8'), '"etag1"')
+        self.assertEqual(self.parser.get_current_blocked_ips('bucket', 'log.gz', 'out.json'), self.state)
+
+        self.assertEqual(self.parser.state_etag, '"etag1"')
+
+        self.parser.s3_util.read_object.return_value = (encode_state(self.state), '"etag2"')
+        self.assertEqual(self.parser.get_current_blocked_ips('bucket', 'log.gz', 'out.json')['general']['192.0.2.1'],
+                         {'max_counter_per_min': 150, 'updated_at': UPDATED_AT_EPOCH})
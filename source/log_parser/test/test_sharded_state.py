@@ -0,0 +1,166 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import datetime
+import hashlib
+import unittest
+from unittest.mock import Mock, patch
+from botocore.exceptions import ClientError
+import lambda_log_parser
+from lambda_log_parser import LambdaLogParser
+from requester_state import encode_state, decode_state, get_shard, get_shard_key, split_requesters, \
+    union_requesters
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+NOW_STR = NOW.strftime("%Y-%m-%d %H:%M:%S %Z%z")
+EXPIRED_STR = (NOW - datetime.timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S %Z%z")
+SHARDS = 8
+OUTPUT_KEY = 'stack-waf_log_out.json'
+
+
+class FakeShardStore(object):
+    """
+    S3 objects in memory with ETags, conditional writes and request accounting
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.reads = []
+        self.writes = []
+        self.heads = []
+        self.lists = 0
+
+    def etag(self, key_name):
+        return '"%s"' % hashlib.md5(self.objects[key_name]).hexdigest()
+
+    def get_head_object(self, bucket_name, key_name):
+        self.heads.append(key_name)
+        if key_name not in self.objects:
+            return None
+        return {'LastModified': NOW, 'ETag': self.etag(key_name), 'ContentLength': len(self.objects[key_name])}
+
+    def list_objects(self, bucket_name, prefix):
+        self.lists += 1
+        return {key: {'Key': key, 'LastModified': NOW, 'ETag': self.etag(key), 'Size': len(body)}
+                for key, body in self.objects.items() if key.startswith(prefix)}
+
+    def read_object(self, bucket_name, key_name):
+        self.reads.append(key_name)
+        return self.objects[key_name], self.etag(key_name)
+
+    def put_object_body(self, bucket_name, key_name, body, content_type=None, if_match=None, if_none_match=None):
+        if (if_match and (key_name not in self.objects or if_match != self.etag(key_name))) or \
+                (if_none_match and key_name in self.objects):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': ''}}, 'PutObject')
+        self.writes.append(key_name)
+        self.objects[key_name] = body
+        return {'ETag': self.etag(key_name)}
+
+    def state(self, key_name):
+        return decode_state(self.objects[key_name])
+
+
+def ip_in_shard(shard, exclude=()):
+    for i in range(1, 255):
+        for j in range(1, 255):
+            ip = '10.0.%d.%d' % (i, j)
+            if get_shard(ip, SHARDS) == shard and ip not in exclude:
+                return ip
+
+
+@patch.dict('os.environ', {'MAX_AGE_TO_UPDATE': '30', 'REQUESTER_STATE_SHARDS': str(SHARDS)})
+class TestShardedState(unittest.TestCase):
+    def setUp(self):
+        lambda_log_parser.SHARD_CACHE.clear()
+        self.store = FakeShardStore()
+        self.parser = LambdaLogParser(Mock())
+        self.parser.s3_util = self.store
+        self.parser.config = {'general': {'requestThreshold': 100, 'blockPeriod': 240}, 'uriList': {}}
+
+    def seed(self, shard, entries):
+        self.store.objects[get_shard_key(OUTPUT_KEY, shard)] = encode_state({'general': entries, 'uriList': {}})
+
+    def merge(self, ips):
+        local = {'general': {ip: {'max_counter_per_min': 150, 'updated_at': NOW_STR} for ip in ips}, 'uriList': {}}
+        return self.parser.merge_and_write_sharded_state('bucket', 'log.gz', 'waf', OUTPUT_KEY, local, SHARDS)
+
+    def test_writes_only_touched_shards(self):
+        ip = ip_in_shard(3)
+        other = ip_in_shard(5)
+        self.seed(5, {other: {'max_counter_per_min': 200, 'updated_at': NOW_STR}})
+
+        merged, need_update = self.merge([ip])
+
+        self.assertTrue(need_update)
+        self.assertEqual(self.store.writes, [get_shard_key(OUTPUT_KEY, 3)])
+        self.assertEqual(set(merged['general']), {ip, other})
+        self.assertEqual(self.parser.stage_timer.get_value('StateShardsTouched'), 1)
+
+    def test_compaction_drops_expired_entries(self):
+        kept = ip_in_shard(5)
+        expired = ip_in_shard(5, exclude=(kept,))
+        self.seed(5, {kept: {'max_counter_per_min': 200, 'updated_at': NOW_STR},
+                      expired: {'max_counter_per_min': 200, 'updated_at': EXPIRED_STR}})
+
+        merged, _ = self.merge([ip_in_shard(3)])
+
+        self.assertNotIn(expired, merged['general'])
+        self.assertEqual(set(self.store.state(get_shard_key(OUTPUT_KEY, 5))['general']), {kept})
+        self.assertEqual(self.parser.stage_timer.get_value('StateEntriesExpired'), 1)
+
+    def test_unchanged_shards_are_not_downloaded_again(self):
+        self.seed(5, {ip_in_shard(5): {'max_counter_per_min': 200, 'updated_at': NOW_STR}})
+        self.merge([ip_in_shard(3)])
+        self.store.reads = []
+
+        merged, _ = self.merge([ip_in_shard(3)])
+
+        # Only the touched shard is read back for the merge
+        self.assertEqual(self.store.reads, [get_shard_key(OUTPUT_KEY, 3)])
+        self.assertEqual(len(merged['general']), 2)
+
+    def test_compaction_lists_shards_once(self):
+        for shard in (2, 5, 7):
+            self.seed(shard, {ip_in_shard(shard): {'max_counter_per_min': 200, 'updated_at': NOW_STR}})
+
+        merged, _ = self.merge([ip_in_shard(3)])
+
+        self.assertEqual(len(merged['general']), 4)
+        self.assertEqual(self.store.lists, 1)
+        # Only the legacy state and the touched shard are probed one by one
+        self.assertEqual(self.store.heads, [OUTPUT_KEY, get_shard_key(OUTPUT_KEY, 3)])
+
+    def test_legacy_state_is_migrated(self):
+        legacy_ips = [ip_in_shard(1), ip_in_shard(6)]
+        self.store.objects[OUTPUT_KEY] = encode_state(
+            {'general': {ip: {'max_counter_per_min': 300, 'updated_at': NOW_STR} for ip in legacy_ips}, 'uriList': {}})
+
+        merged, _ = self.merge([ip_in_shard(3)])
+
+        self.assertEqual(set(merged['general']), set(legacy_ips) | {ip_in_shard(3)})
+        self.assertEqual(decode_state(self.store.objects[OUTPUT_KEY]), {'general': {}, 'uriList': {}})
+        self.store.writes = []
+        self.merge([ip_in_shard(3)])
+        self.assertEqual(self.store.writes, [get_shard_key(OUTPUT_KEY, 3)])
+
+    @patch.dict('os.environ', {'REQUESTER_STATE_FORMAT': 'json'})
+    def test_empty_json_legacy_state_is_not_migrated_again(self):
+        self.parser.write_output('bucket', 'log.gz', OUTPUT_KEY, {'general': {}, 'uriList': {}})
+        self.store.writes = []
+
+        self.merge([ip_in_shard(3)])
+
+        self.assertEqual(self.store.writes, [get_shard_key(OUTPUT_KEY, 3)])
+        self.assertNotIn(OUTPUT_KEY, self.store.reads)
+
+    def test_split_and_union(self):
+        requesters = {
+            'general': {ip_in_shard(s): {'max_counter_per_min': s, 'updated_at': NOW_STR} for s in range(SHARDS)},
+            'uriList': {'/login': {ip_in_shard(2): {'max_counter_per_min': 9, 'updated_at': NOW_STR}}}
+        }
+
+        parts = split_requesters(requesters, SHARDS)
+
+        self.assertEqual(len(parts), SHARDS)
+        self.assertEqual(parts[2]['uriList'], requesters['uriList'])
+        self.assertEqual(union_requesters(parts.values()), requesters)
@@ -0,0 +1,114 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import gzip
+import io
+import json
+import unittest
+from unittest.mock import Mock, patch
+from lib.stage_metrics import StageTimer, TimedReader, DetectionLatency, record_ip_set_sync
+
+
+class TestStageTimer(unittest.TestCase):
+    def setUp(self):
+        self.log = Mock()
+
+    def test_stage_durations_are_accumulated(self):
+        timer = StageTimer(self.log, 'Test')
+        with timer.stage('WAFUpdate'):
+            pass
+        first = timer.get_duration('WAFUpdate')
+        with timer.stage('WAFUpdate'):
+            pass
+
+        self.assertGreaterEqual(timer.get_duration('WAFUpdate'), first)
+        self.assertEqual(timer.get_duration('Unknown'), 0.0)
+
+    def test_rate_uses_stage_duration(self):
+        timer = StageTimer(self.log, 'Test')
+        timer.add_duration('Parse', 500)
+        timer.add_value('LinesProcessed', 100)
+        timer.add_value('LinesProcessed', 50)
+        timer.add_rate('LinesPerSecond', timer.get_value('LinesProcessed'), 'Parse')
+
+        self.assertEqual(timer.get_value('LinesPerSecond'), 300)
+
+    @patch('builtins.print')
+    def test_publish_emits_emf_and_resets(self, mock_print):
+        timer = StageTimer(self.log, 'Test')
+        timer.add_duration('Parse', 12.5)
+        timer.set_value('IPSetSizeV4', 3)
+        timer.publish(LogType='waf')
+
+        emf = json.loads(mock_print.call_args[0][0])
+        self.assertEqual(emf['Pipeline'], 'Test')
+        self.assertEqual(emf['LogType'], 'waf')
+        self.assertEqual(emf['ParseDuration'], [12.5])
+        self.assertEqual(emf['IPSetSizeV4'], [3.0])
+        self.assertIn('TotalDuration', emf)
+        self.assertEqual(timer.durations, {})
+        self.assertEqual(timer.values, {})
+
+    @patch.dict('os.environ', {'STAGE_METRICS_ENABLED': 'false'})
+    @patch('builtins.print')
+    def test_publish_disabled(self, mock_print):
+        timer = StageTimer(self.log, 'Test')
+        timer.add_duration('Parse', 1)
+        timer.publish()
+
+        mock_print.assert_not_called()
+
+    def test_record_ip_set_sync(self):
+        timer = StageTimer(self.log, 'Test')
+        record_ip_set_sync(timer, {'Added': 3, 'Removed': 1, 'Truncated': 2, 'Updated': True}, 'V4')
+        record_ip_set_sync(timer, {'Added': 0, 'Removed': 0, 'Updated': False}, 'V6')
+        record_ip_set_sync(timer, {'Added': 0, 'Removed': 0, 'Updated': False, 'Error': 'failed'}, 'V6')
+
+        self.assertEqual(timer.get_value('IPSetAddedV4'), 3)
+        self.assertEqual(timer.get_value('IPSetRemovedV4'), 1)
+        self.assertEqual(timer.get_value('IPSetShardOverflow'), 2)
+        self.assertEqual(timer.get_value('IPSetWritesSkipped'), 1)
+        self.assertEqual(timer.get_value('IPSetUpdateErrors'), 1)
+
+    def test_timed_reader_accounts_bytes(self):
+        timer = StageTimer(self.log, 'Test')
+        compressed = io.BytesIO(gzip.compress(b'line one\nline two\n'))
+        with gzip.open(compressed, 'r') as gzip_content:
+            reader = io.BufferedReader(TimedReader(gzip_content, timer, 'Decompress', 'DecompressedBytes'))
+            lines = list(reader)
+
+        self.assertEqual(lines, [b'line one\n', b'line two\n'])
+        self.assertEqual(timer.get_value('DecompressedBytes'), 18)
+        self.assertGreater(timer.get_duration('Decompress'), 0)
+
+
+class TestDetectionLatency(unittest.TestCase):
+    def test_record_all_stages(self):
+        timer = StageTimer(Mock(), 'Test')
+        latency = DetectionLatency()
+        latency.newest_record_at = 1000.0
+        latency.set_event_time('1970-01-01T00:16:50.000Z')
+        latency.processing_started_at = 1012.0
+        latency.api_started_at = 1012.5
+        latency.api_completed_at = 1013.0
+        latency.record(timer)
+
+        self.assertEqual(timer.get_value('DeliveryLatency'), 10000)
+        self.assertEqual(timer.get_value('QueueLatency'), 2000)
+        self.assertEqual(timer.get_value('ProcessingLatency'), 500)
+        self.assertEqual(timer.get_value('APILatency'), 500)
+        self.assertEqual(timer.get_value('DetectionLatency'), 13000)
+
+    def test_unknown_timestamps_drop_stages(self):
+        timer = StageTimer(Mock(), 'Test')
+        latency = DetectionLatency()
+        latency.set_event_time('not a date')
+        latency.api_started()
+        latency.api_completed()
+        latency.record(timer)
+
+        self.assertNotIn('DeliveryLatency', timer.values)
+        self.assertNotIn('QueueLatency', timer.values)
+        self.assertNotIn('DetectionLatency', timer.values)
+        self.assertIn('ProcessingLatency', timer.values)
+        self.assertIn('APILatency', timer.values)
@@ -0,0 +1,115 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import datetime
+import unittest
+from unittest.mock import Mock, patch
+from botocore.exceptions import ClientError
+from lambda_log_parser import LambdaLogParser, STATE_WRITE_MAX_TRIES
+from requester_state import encode_state, decode_state, StateConflictError
+
+NOW = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S %Z%z")
+
+
+class FakeStateStore(object):
+    """
+    Single S3 object with ETags and conditional writes. `concurrent_writes` are
+    applied, one per write attempt, right before the write, as if another
+    invocation had won the race.
+    """
+
+    def __init__(self, state=None, concurrent_writes=None):
+        self.body = encode_state(state) if state is not None else None
+        self.version = 0
+        self.concurrent_writes = list(concurrent_writes or [])
+        self.conditions = []
+
+    def get_head_object(self, bucket_name, key_name):
+        if self.body is None:
+            return None
+        return {'LastModified': datetime.datetime.now(datetime.timezone.utc)}
+
+    def read_object(self, bucket_name, key_name):
+        return self.body, '"%d"' % self.version
+
+    def put_object_body(self, bucket_name, key_name, body, content_type=None, if_match=None, if_none_match=None):
+        self.conditions.append((if_match, if_none_match))
+        if self.concurrent_writes:
+            self.write(self.concurrent_writes.pop(0))
+        if (if_match and if_match != '"%d"' % self.version) or (if_none_match and self.body is not None):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': ''}}, 'PutObject')
+        self.body = body
+        self.version += 1
+
+    def write(self, ips):
+        state = decode_state(self.body) if self.body is not None else {'general': {}, 'uriList': {}}
+        for ip in ips:
+            state['general'][ip] = {'max_counter_per_min': 500, 'updated_at': NOW}
+        self.body = encode_state(state)
+        self.version += 1
+
+
+@patch.dict('os.environ', {'MAX_AGE_TO_UPDATE': '30'})
+class TestStateConcurrency(unittest.TestCase):
+    def setUp(self):
+        self.parser = LambdaLogParser(Mock())
+        self.parser.config = {'general': {'requestThreshold': 100, 'blockPeriod': 240}, 'uriList': {}}
+        self.local = {'general': {'192.0.2.1': {'max_counter_per_min': 150, 'updated_at': NOW}}, 'uriList': {}}
+
+    def merge(self):
+        return self.parser.merge_and_write_state('bucket', 'log.gz', 'waf', 'stack-waf_log_out.json', self.local)
+
+    def test_first_write_is_create_only(self):
+        store = FakeStateStore()
+        self.parser.s3_util = store
+
+        self.merge()
+
+        self.assertEqual(store.conditions, [(None, '*')])
+        self.assertEqual(set(decode_state(store.body)['general']), {'192.0.2.1'})
+
+    def test_conflict_is_re_merged(self):
+        store = FakeStateStore({'general': {}, 'uriList': {}}, concurrent_writes=[['198.51.100.9']])
+        self.parser.s3_util = store
+
+        merged, need_update = self.merge()
+
+        self.assertTrue(need_update)
+        self.assertEqual(set(decode_state(store.body)['general']), {'192.0.2.1', '198.51.100.9'})
+        self.assertEqual(set(merged['general']), {'192.0.2.1', '198.51.100.9'})
+        self.assertEqual(store.conditions, [('"0"', None), ('"1"', None)])
+        self.assertEqual(self.parser.stage_timer.get_value('StateConflicts'), 1)
+        self.assertEqual(self.parser.stage_timer.get_value('StateWriteRetries'), 1)
+        self.assertEqual(self.parser.stage_timer.get_value('StateWriteAttempts'), 2)
+        # The caller's requesters are left untouched for the next attempt
+        self.assertEqual(set(self.local['general']), {'192.0.2.1'})
+
+    @patch('backoff._sync.time.sleep')
+    def test_gives_up_after_max_tries(self, _):
+        concurrent_writes = [['198.51.100.%d' % i] for i in range(STATE_WRITE_MAX_TRIES)]
+        self.parser.s3_util = FakeStateStore({'general': {}, 'uriList': {}}, concurrent_writes)
+
+        with self.assertRaises(StateConflictError):
+            self.merge()
+        self.assertEqual(self.parser.stage_timer.get_value('StateConflicts'), STATE_WRITE_MAX_TRIES)
+
+    @patch.dict('os.environ', {'STATE_CONDITIONAL_WRITES': 'false'})
+    def test_unconditional_writes(self):
+        store = FakeStateStore({'general': {}, 'uriList': {}})
+        self.parser.s3_util = store
+
+        self.merge()
+
+        self.assertEqual(store.conditions, [(None, None)])
+
+    def test_merge_keeps_every_remote_uri_entry(self):
+        self.parser.config['uriList'] = {'/login': {'requestThreshold': 10}}
+        remote = {'general': {}, 'uriList': {'/login': {
+            '198.51.100.1': {'max_counter_per_min': 50, 'updated_at': NOW},
+            '198.51.100.2': {'max_counter_per_min': 60, 'updated_at': NOW},
+        }}}
+        self.parser.s3_util = FakeStateStore(remote)
+
+        merged, _ = self.merge()
+
+        self.assertEqual(set(merged['uriList']['/login']), {'198.51.100.1', '198.51.100.2'})
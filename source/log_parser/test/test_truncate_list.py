@@ -0,0 +1,33 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+import os
+import unittest
+from unittest.mock import Mock, patch
+from lambda_log_parser import LambdaLogParser
+
+UPDATED_AT = "2025-03-20 10:00:00 UTC+0000"
+UPDATED_AT_EPOCH = 1742464800
+
+
+class TestTruncateList(unittest.TestCase):
+    def setUp(self):
+        self.parser = LambdaLogParser(Mock())
+        self.requesters = {
+            '192.0.2.1': {'max_counter_per_min': 150, 'updated_at': UPDATED_AT},
+            '192.0.2.2': {'max_counter_per_min': 900, 'updated_at': UPDATED_AT},
+            '192.0.2.3': {'max_counter_per_min': 150, 'updated_at': UPDATED_AT_EPOCH + 60},
+            '192.0.2.4': {'max_counter_per_min': '120', 'updated_at': UPDATED_AT},
+        }
+
+    @patch.dict(os.environ, {'LIMIT_IP_ADDRESS_RANGES_PER_IP_MATCH_CONDITION': '3'})
+    def test_keeps_most_aggressive_requesters(self):
+        result = self.parser.truncate_list(self.requesters)
+
+        # Highest rate first, the most recent one first on ties
+        self.assertEqual(list(result), ['192.0.2.2', '192.0.2.3', '192.0.2.1'])
+        self.assertEqual(self.parser.stage_timer.get_value('RequestersTruncated'), 1)
+
+    @patch.dict(os.environ, {'LIMIT_IP_ADDRESS_RANGES_PER_IP_MATCH_CONDITION': '10'})
+    def test_within_limit_is_unchanged(self):
+        self.assertIs(self.parser.truncate_list(self.requesters), self.requesters)
@@ -9,10 +9,10 @@ from aws_lambda_powertools import Logger
 from datetime import datetime
 from typing import List, Dict, Any
 from botocore.exceptions import ClientError
-from lib.boto3_util import create_client
+from lib.boto3_util import LazyClient
 
 logger = Logger(level=os.getenv('LOG_LEVEL'))
-cloudwatch_client = create_client('cloudwatch')
+cloudwatch_client = LazyClient('cloudwatch')
 
 def get_blocked_requests_batch(
     metric_queries: List[Dict[str, Any]],
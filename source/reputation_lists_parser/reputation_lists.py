@@ -7,13 +7,11 @@ import json
 import re
 import ssl
 from urllib.parse import urlparse
-from time import sleep
-from ipaddress import ip_address
-from ipaddress import ip_network
-from ipaddress import IPv4Network
-from ipaddress import IPv6Network
-from lib.waflibv2 import WAFLIBv2
+from lib.waflibv2 import WAFLIBv2, get_ip_set_shards
+from lib.ip_util import AddressSet
+from lib.cidr_index import get_allowlist_index
 from lib.cfn_response import send_response
+from lib.stage_metrics import StageTimer, record_ip_set_sync
 from aws_lambda_powertools import Logger, Tracer
 
 logger = Logger(
@@ -22,8 +20,6 @@ logger = Logger(
 tracer = Tracer()
 waflib = WAFLIBv2()
 
-delay_between_updates = 5
-
 HTTPS = 'https'
 
 TRUSTED_DOMAINS = [
@@ -70,50 +66,41 @@ def read_url_list(log, current_list, url, prefix=""):
     return current_list
 
 
-# Fully qualify each address with network cidr
+# Fully qualify each address with network cidr, in canonical form and without duplicates.
+# A CIDR with host bits set is rejected rather than widened.
 def process_url_list(log, current_list):
-    process_list = []
-    for source_ip in current_list:
-        try:
-            ip_type = "IPV%s" % ip_address(source_ip).version
-            if (ip_type == "IPV4"):
-                process_list.append(IPv4Network(source_ip).with_prefixlen)
-            elif (ip_type == "IPV6"):
-                process_list.append(IPv6Network(source_ip).with_prefixlen)
-        except Exception:
-            try:
-                if (ip_network(source_ip)):
-                    process_list.append(source_ip)
-            except Exception:
-                log.debug(source_ip + " not an IP address.")
-    return process_list
+    addresses = AddressSet(current_list, strict=True)
+    for source_ip in addresses.others:
+        log.debug(str(source_ip) + " not an IP address.")
+    return addresses.get_addresses('IPV4') + addresses.get_addresses('IPV6')
 
 
 # push each source_ip into the appropriate IPSet
-def populate_ipsets(log, scope, ipset_name_v4, ipset_name_v6, ipset_arn_v4, ipset_arn_v6, current_list):
-    addresses_v4 = []
-    addresses_v6 = []
-
-    for address in current_list:
-        try:
-            source_ip = address.split("/")[0]
-            ip_type = "IPV%s" % ip_address(source_ip).version
-            if ip_type == "IPV4":
-                addresses_v4.append(address)
-            elif ip_type == "IPV6":
-                addresses_v6.append(address)
-        except Exception as e:
-            log.error(e)
-
-    log.info("[populate_ipsets] Changes in WAF IP set v4")
-    waflib.update_ip_set(log, scope, ipset_name_v4, ipset_arn_v4, addresses_v4)
+def populate_ipsets(log, scope, ipset_name_v4, ipset_name_v6, ipset_arn_v4, ipset_arn_v6, current_list,
+                    stage_timer=None):
+    stage_timer = stage_timer or StageTimer(log, 'ReputationLists')
+    addresses = AddressSet(current_list)
+    for address in addresses.others:
+        log.error("%s is not IPV4 or IPV6." % str(address))
+    allowlist = get_allowlist_index(log, scope, waflib)
+    addresses_v4 = [address for address in addresses.get_addresses('IPV4') if not allowlist.covers(address)]
+    addresses_v6 = [address for address in addresses.get_addresses('IPV6') if not allowlist.covers(address)]
+    stage_timer.set_value('AllowlistedSkipped', len(addresses) - len(addresses.others)
+                          - len(addresses_v4) - len(addresses_v6))
+
+    stage_timer.set_value('IPSetSizeV4', len(addresses_v4))
+    stage_timer.set_value('IPSetSizeV6', len(addresses_v6))
+
+    # Each IPSet may be backed by shard IPSets, the addresses over their capacity are dropped
+    ip_range_limit = int(os.getenv('LIMIT_IP_ADDRESS_RANGES_PER_IP_MATCH_CONDITION', 10000))
+    log.info("[populate_ipsets] Changes in WAF IP sets v4 and v6")
+    with stage_timer.stage('WAFUpdate'):
+        result_v4, result_v6 = waflib.sync_sharded_ip_sets(log, scope, [
+            (get_ip_set_shards(ipset_name_v4, ipset_arn_v4, 'REPUTATIONV4'), addresses_v4),
+            (get_ip_set_shards(ipset_name_v6, ipset_arn_v6, 'REPUTATIONV6'), addresses_v6)], ip_range_limit)
+    record_ip_set_sync(stage_timer, result_v4, 'V4')
+    record_ip_set_sync(stage_timer, result_v6, 'V6')
     log.info("[populate_ipsets] Updated IPSet %s with %d IP addresses v4", ipset_name_v4, len(addresses_v4))
-
-    # Sleep for a few seconds to mitigate AWS WAF Update API call throttling issue
-    sleep(delay_between_updates)
-
-    log.info("[populate_ipsets] Changes in WAF IP set v6")
-    waflib.update_ip_set(log, scope, ipset_name_v6, ipset_arn_v6, addresses_v6)
     log.info("[populate_ipsets] Updated IPSet %s with %d IP addresses v6", ipset_name_v6, len(addresses_v6))
 
 
@@ -185,22 +172,29 @@ def lambda_handler(event, context):
         logger.error(e)
         raise
 
+    stage_timer = StageTimer(logger, 'ReputationLists')
     try:
-        for info in url_list:
-            try:
-                if("prefix" in info):
-                    current_list = read_url_list(logger, current_list, info["url"], info["prefix"])
-                else:
-                    current_list = read_url_list(logger, current_list, info["url"])
-            except Exception as e:
-                logger.error(e)
-                logger.error("URL info not valid %s", info)
-                
-
-        current_list = sorted(current_list, key=str)
-        current_list = process_url_list(logger, current_list)
-
-        populate_ipsets(logger, scope, ipset_name_v4, ipset_name_v6, ipset_arn_v4, ipset_arn_v6, current_list)
+        with stage_timer.stage('Download'):
+            for info in url_list:
+                try:
+                    if("prefix" in info):
+                        current_list = read_url_list(logger, current_list, info["url"], info["prefix"])
+                    else:
+                        current_list = read_url_list(logger, current_list, info["url"])
+                except Exception as e:
+                    logger.error(e)
+                    logger.error("URL info not valid %s", info)
+            stage_timer.track(current_list=current_list)
+        stage_timer.set_value('LinesProcessed', len(current_list))
+
+        with stage_timer.stage('Parse'):
+            current_list = sorted(current_list, key=str)
+            current_list = process_url_list(logger, current_list)
+            stage_timer.track(current_list=current_list)
+        stage_timer.add_rate('LinesPerSecond', stage_timer.get_value('LinesProcessed'), 'Parse')
+
+        populate_ipsets(logger, scope, ipset_name_v4, ipset_name_v6, ipset_arn_v4, ipset_arn_v6, current_list,
+                        stage_timer=stage_timer)
 
     except Exception as error:
         logger.error(str(error))
@@ -211,6 +205,7 @@ def lambda_handler(event, context):
             'body': {'message': reason}
         }
     finally:
+        stage_timer.publish()
         logger.info('[lambda_handler] End')
         if 'ResponseURL' in event:
             resource_id = event['PhysicalResourceId'] if 'PhysicalResourceId' in event else event['LogicalResourceId']
@@ -0,0 +1,57 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: Apache-2.0
+
+from unittest.mock import Mock
+from lib.ip_util import AddressSet, parse_address, format_cidr, canonicalize, get_cidr, get_ip_version
+from reputation_lists_parser import reputation_lists
+
+
+def test_parse_address():
+    assert parse_address('192.0.2.1') == (4, 3221225985, 32)
+    assert parse_address('192.0.2.77/24') == (4, 3221225984, 24)
+    assert parse_address('2001:db8::1')[0] == 6
+    assert parse_address('x.x.x.x/32') is None
+    assert parse_address('192.0.2.77/24', strict=True) is None
+    assert parse_address('192.0.2.0/255.255.255.0', strict=True) == (4, 3221225984, 24)
+    assert parse_address('192.0.2.1/33') is None
+    assert parse_address(None) is None
+
+
+def test_canonicalize():
+    assert canonicalize('2001:DB8:0::1') == '2001:db8::1/128'
+    assert canonicalize('192.0.2.77/24') == '192.0.2.0/24'
+    assert canonicalize('x.x.x.x/32') == 'x.x.x.x/32'
+    assert get_ip_version('2001:db8::/32') == 'IPV6'
+    assert get_ip_version('not an ip') is None
+
+
+def test_plain_addresses_match_the_parser():
+    # Plain addresses skip the parser: they are formatted as the parser would
+    for address in ['192.0.2.1', ' 192.0.2.1/32 ', '2001:DB8:0::1', '2001:db8::1/128', 'FE80::1%eth0',
+                    '::ffff:192.0.2.1', '::', '1:0:0:2:0:0:0:3']:
+        assert get_cidr(address) == format_cidr(parse_address(address))
+        assert get_ip_version(address) == ('IPV6' if ':' in address else 'IPV4')
+    for address in ['192.0.2.01', '192.0.2.1/', '192.0.2.1/128', '192.0.2', '2001:db8::1/', 'x', None]:
+        assert get_cidr(address) is None
+        assert get_ip_version(address) is None
+
+
+def test_address_set_operations():
+    left = AddressSet(['192.0.2.1', '192.0.2.2/32', '2001:DB8::1', 'x.x.x.x/32'])
+    right = AddressSet(['192.0.2.2', '2001:db8::1/128', '198.51.100.0/24'])
+
+    assert '2001:db8:0::1/128' in left
+    assert 'x.x.x.x/32' in left
+    assert '192.0.2.3' not in left
+    assert left.union(right).get_addresses() == ['192.0.2.1/32', '192.0.2.2/32', '198.51.100.0/24',
+                                                 '2001:db8::1/128', 'x.x.x.x/32']
+    assert left.difference(right).get_addresses() == ['192.0.2.1/32', 'x.x.x.x/32']
+    assert len(AddressSet(['192.0.2.1', '192.0.2.1/32'])) == 1
+
+
+def test_process_url_list_canonical():
+    result = reputation_lists.process_url_list(Mock(), ['192.0.2.1', '192.0.2.1/32', '198.51.100.0/24',
+                                                        '203.0.113.9/24', '2001:DB8::1', 'not an ip'])
+
+    # A CIDR with host bits set is not widened
+    assert result == ['192.0.2.1/32', '198.51.100.0/24', '2001:db8::1/128']
@@ -66,9 +66,8 @@ def test_lambda_handler_returns_success(mocker):
                 'RetryAttempts': 0
             }
         }
-        mocker.patch.object(reputation_lists.waflib, 'update_ip_set')
-        mocker.patch.object(reputation_lists.waflib, 'get_ip_set')
-        mocker.patch.object(reputation_lists.waflib, 'update_ip_set')
+        mocker.patch.object(reputation_lists.waflib, 'sync_ip_set',
+                            return_value={'Added': 0, 'Removed': 0, 'Updated': False, 'Response': None})
         mocker.patch.object(reputation_lists.waflib, 'get_ip_set')
         mocker.patch.object(WAFCloudWatchMetrics, 'add_waf_cw_metric_to_usage_data')
         reputation_lists.waflib.get_ip_set.return_value = ip_set